@@ -2,9 +2,17 @@ import config
 import json
 import numpy as np
 import os
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from Bio.Align.Applications import MafftCommandline
-import matplotlib.pyplot as plt
+from itertools import chain
+import mafft
+from catalog import catalog_entry
+from record_store import RecordStore, record_metadata
+from dedup import DuplicateTable, expand_alignment, sequence_hash
+from manifest import Manifest, file_checksum, hash_ids, hash_values
+import profiling
 
 
 class SequenceAligner:
@@ -13,40 +21,74 @@ class SequenceAligner:
 
     unaligned_pattern = '{tag}_{file_id}_unaligned'
     aligned_pattern = '{tag}_{file_id}_aligned'
+    insertions_pattern = '{tag}_{file_id}_insertions'
     information_pattern = '{tag}_information.txt'
+    duplicates_pattern = '{tag}_duplicates.json'
+    expanded_pattern = '{tag}_expanded'
+
+    # 'mafft' aligns new sequences to the whole previous alignment with mafft --add,
+    # 'reference' aligns every new sequence on its own to config.REFERENCE_FASTA_FNAME
+    # and appends it in reference coordinates
+    modes = ('mafft', 'reference')
 
     def __init__(self, tag, file_id, records=None, already_aligned_file_id=None,
-                 already_aligned_sequence_ids=None):
+                 already_aligned_sequence_ids=None, mode=None, deduplicate=None):
         """
         DESCRIPTION:
         Constructor of the SequenceAligner class
         :param tag: [string] desired name for the selection of sequences
         :param file_id: [string] id of this alignment
-        :param records: [list] list of records to align
+        :param records: [iterable] records to align, a list or a re-iterable stream
         :param already_aligned_file_id: [string] id of previous alignment we want to work with
         :param already_aligned_sequence_ids: [list] list of ids of sequences already aligned in mentioned previous alignment
+        :param mode: [string] one of SequenceAligner.modes, defaults to config.ALIGNMENT_MODE
+        :param deduplicate: [boolean] whether to align only one record of every group of records with
+        the same sequence, defaults to config.DEDUPLICATE_SEQUENCES. The others are kept in the
+        {tag}_duplicates.json table
         :return: [SequenceAligner] the created object
         """
         if already_aligned_sequence_ids is None:
             already_aligned_sequence_ids = []
+        mode = mode or config.ALIGNMENT_MODE
+        if mode not in SequenceAligner.modes:
+            raise ValueError(f'unknown alignment mode {mode}')
+        self.mode = mode
         self.filters = []
+        self._compiled_filter = None
+        self.query = None
+        self._catalogued_ids = None
+        self._query_ids = None
         self.tag = tag
         self.file_id = file_id
         self.unfiltered_records = records
         self.already_aligned_file_id = already_aligned_file_id
         self.already_aligned_sequence_ids = already_aligned_sequence_ids
+        self.aligned_index = AlignedIdIndex(already_aligned_sequence_ids)
+        if deduplicate is None:
+            deduplicate = config.DEDUPLICATE_SEQUENCES
+        config.ensure_dirs()
+        self.manifest = Manifest(tag)
+        self.duplicates = None
+        if deduplicate:
+            self.duplicates = DuplicateTable(config.FASTA_DIR / SequenceAligner.duplicates_pattern.format(tag=tag))
 
     @staticmethod
-    def from_tag(tag, data):
+    def from_tag(tag, data, mode=None):
         """
         DESCRIPTION:
         Creates a SequenceAligner object based on an already existing alignment or
         in case that doesn't exist creates a new one
         :param tag: [string] name of the alignment selection to build on
         :param data: [dictionary] the data including a timestamp and the records
+        :param mode: [string] alignment mode for a new alignment, an existing one keeps the mode
+        it was made with
         :return: [SequenceAligner] the created object
         """
         already_aligned_file_id, already_aligned_sequence_ids = SequenceAligner.get_actual(tag)
+        previous_mode = SequenceAligner._get_information(tag).get('mode')
+        if previous_mode is not None and mode is not None and previous_mode != mode:
+            print(f'alignment of {tag} was made in {previous_mode} mode, {mode} mode ignored')
+        mode = previous_mode or mode
         if already_aligned_file_id is None or already_aligned_sequence_ids == []:
             print(f'No previous alignment of {tag} found. Alignment will be done from scratch')
         else:
@@ -56,7 +98,7 @@ class SequenceAligner:
         timestamp = datetime.fromtimestamp(int(data.get('request_timestamp'))).strftime("%Y%m%d%H%M%S")
         records = data.get('seqrecords')
         return SequenceAligner(tag, timestamp, records=records, already_aligned_file_id=already_aligned_file_id,
-                               already_aligned_sequence_ids=already_aligned_sequence_ids)
+                               already_aligned_sequence_ids=already_aligned_sequence_ids, mode=mode)
 
     def add_filter(self, description_filter):
         """
@@ -65,53 +107,217 @@ class SequenceAligner:
         :param description_filter: [function] filter that will be added
         """
         self.filters.append(description_filter)
+        self._compiled_filter = None
+
+    def set_query(self, query):
+        """
+        DESCRIPTION:
+        Selects the records by their metadata, looked up in the catalog of the record store
+        when there is one, see select_records
+        :param query: [CatalogQuery] the query
+        """
+        self.query = query
+        self._catalogued_ids = None
+        self._query_ids = None
+
+    def set_catalog_selection(self, catalogued_ids, query_ids):
+        """
+        DESCRIPTION:
+        Sets the result of this object's query in the catalog, so that catalogued records are
+        accepted or rejected without reading their metadata
+        :param catalogued_ids: [set] ids of all the catalogued records
+        :param query_ids: [set] ids of the catalogued records the query selects
+        """
+        self._catalogued_ids = catalogued_ids
+        self._query_ids = query_ids
 
-    def make_alignment(self, make_copy=False):
+    def make_alignment(self, make_copy=False, threads=None):
         """
         DESCRIPTION:
         Aligns unaligned sequences and writes them to a file. Updates the information file
         that says which sequences have already been aligned
+        :param make_copy: [boolean] whether to copy the alignment to a file without timestamp
+        :param threads: [int] number of threads MAFFT may use, defaults to config.MAFFT_CPU_BUDGET
         """
+        records_hash = _records_hash(self.unfiltered_records)
+        if records_hash is not None and self.manifest.is_unchanged('filter', self._filter_inputs_hash(records_hash)):
+            print('records, filters and alignment unchanged, nothing to align')
+            return
+
         sequence_ids_written = self._write_filtered_records_to_file()
+        aligned = self._align_written_records(sequence_ids_written, make_copy=make_copy,
+                                              threads=threads or config.MAFFT_CPU_BUDGET)
+        if records_hash is not None and aligned:
+            self.manifest.record('filter', self._filter_inputs_hash(records_hash))
+
+    def filter_signature(self):
+        """
+        DESCRIPTION:
+        Describes this object's filters, so that changes to them can be detected
+        :return: [list] the name and key words of every filter
+        """
+        signature = []
+        for description_filter in self.filters:
+            key_word_filter = getattr(description_filter, '__self__', None)
+            name = getattr(description_filter, '__qualname__', repr(description_filter))
+            if isinstance(key_word_filter, Filter):
+                signature.append([name, sorted(key_word_filter.key_words)])
+            else:
+                signature.append([name])
+        if self.query is not None:
+            signature.append(['query', self.query.signature()])
+        return signature
+
+    def _filter_inputs_hash(self, records_hash):
+        """
+        DESCRIPTION:
+        Hash of everything deciding which records this object writes: the records, the filters
+        and the alignment they are added to
+        :param records_hash: [string] hash_ids of the uids of the records
+        :return: [string] the hash
+        """
+        return hash_values(records_hash, self.filter_signature(), self.already_aligned_file_id,
+                           self.mode, self.duplicates is not None)
+
+    def _align_written_records(self, sequence_ids_written, make_copy=False, threads=1):
+        """
+        DESCRIPTION:
+        Aligns the sequences already written to this object's unaligned file and updates
+        the information file. If MAFFT fails the exception is raised and neither the
+        previous alignment nor the information file are touched
+        :param sequence_ids_written: [list] ids of the sequences in the unaligned file
+        :param make_copy: [boolean] whether to copy the alignment to a file without timestamp
+        :param threads: [int] number of threads MAFFT may use
+        :return: [boolean] false if the sequences were left for a later run
+        """
         if len(sequence_ids_written) == 0:
             print('no unaligned sequences')
-            return
+            # any new entry of the duplicates table is a member of an aligned sequence
+            if self.duplicates is not None:
+                self.duplicates.save()
+                if make_copy and self.already_aligned_file_id is not None:
+                    self.write_expanded_alignment()
+            return True
 
-        if len(sequence_ids_written) == 1:
+        if len(sequence_ids_written) == 1 and self.already_aligned_file_id is None and self.mode != 'reference':
+            # MAFFT can't align a single sequence, it's aligned with the next ones
             print('only one sequence')
-            return
+            return False
 
         print(f'will align {len(sequence_ids_written)} new sequences')
 
-        if self.already_aligned_file_id is None:
+        output_file = config.FASTA_DIR / SequenceAligner.aligned_pattern.format(tag=self.tag, file_id=self.file_id)
+        align_inputs_hash = hash_values(file_checksum(config.FASTA_DIR / self.get_unaligned_filename()),
+                                        self.already_aligned_file_id, self.mode, config.MAFFT_DIR,
+                                        file_checksum(config.FASTA_DIR / config.REFERENCE_FASTA_FNAME)
+                                        if self.mode == 'reference' else None)
+        # the alignments are named after the run, so the output of a previous run with the same inputs
+        # (e.g. one interrupted before the information file was written) is looked up in the manifest
+        previous_outputs = self.manifest.outputs('align')
+        if previous_outputs and self.manifest.is_unchanged('align', align_inputs_hash, outputs=previous_outputs):
+            print('alignment inputs unchanged, reusing the previous alignment')
+            if previous_outputs[0] != output_file:
+                _link_or_copy(previous_outputs[0], output_file)
+        elif self.mode == 'reference':
+            print('aligning to the reference')
+            self._align_to_reference(threads=threads)
+        elif self.already_aligned_file_id is None:
             print('aligning from scratch')
-            self._align_from_scratch()
+            self._align_from_scratch(threads=threads)
         else:
             print('adding to previous alignment')
-            self._align_from_existing()
+            self._align_from_existing(threads=threads)
+        self.manifest.record('align', align_inputs_hash, outputs=[output_file],
+                             parameters={'mode': self.mode, 'mafft': config.MAFFT_DIR, 'threads': threads})
+        self._update_site_counts(sequence_ids_written)
+
+        # at this point the alignment was done successfully
+        self.already_aligned_file_id = self.file_id
+        if self.duplicates is not None:
+            self.duplicates.save()
+        self.already_aligned_sequence_ids = sequence_ids_written + self.already_aligned_sequence_ids
+        self.aligned_index.update(sequence_ids_written)
 
         if make_copy:
             self.copy_aligned_file_unstamped()
 
-        # at this point assume alignment done successfully
         # update meta information
-        sequence_ids_written += self.already_aligned_sequence_ids
         info_dict = {'last_id': self.file_id,
-                     'aligned_ids': sequence_ids_written
+                     'aligned_ids': self.already_aligned_sequence_ids,
+                     'mode': self.mode
                      }
         info_filename = SequenceAligner.information_pattern.format(tag=self.tag)
         with open(config.FASTA_DIR / info_filename, 'w') as file:
             file.write(json.dumps(info_dict))
+        return True
+
+    def _update_site_counts(self, sequence_ids_written):
+        """
+        DESCRIPTION:
+        Updates the per site counts of the tag with the sequences just aligned. The rows of the previous
+        alignment keep their columns in the 'reference' mode, where the new rows are appended at the end,
+        and in the 'mafft' mode as long as MAFFT didn't add columns; otherwise the counts are computed again
+        :param sequence_ids_written: [list] ids of the sequences just aligned
+        """
+        output_file = config.FASTA_DIR / SequenceAligner.aligned_pattern.format(tag=self.tag, file_id=self.file_id)
+        if self.already_aligned_file_id is None:
+            update_site_counts(self.tag, self.file_id, output_file)
+            return
+
+        offset = 0
+        if self.mode == 'reference':
+            offset = (config.FASTA_DIR / self.get_aligned_filename()).stat().st_size
+        update_site_counts(self.tag, self.file_id, output_file, previous_file_id=self.already_aligned_file_id,
+                           new_ids=set(sequence_ids_written), offset=offset)
 
     def copy_aligned_file_unstamped(self):
-        try:
-            in_filename = config.FASTA_DIR / self.get_aligned_filename()
-            out_filename = config.FASTA_DIR / f'{self.tag}_aligned'
-            with open(in_filename, 'r') as in_file, open(out_filename, 'w') as out_file:
-                content = in_file.read()
-                out_file.write(content)
-        except FileNotFoundError:
+        """
+        DESCRIPTION:
+        Makes {tag}_aligned point to the current alignment. The stamped alignments are never
+        modified, so a hard link (or a symbolic link if that's not possible) is made under a
+        temporary name and renamed over the previous one, instead of copying the content
+        """
+        in_filename = config.FASTA_DIR / self.get_aligned_filename()
+        out_filename = config.FASTA_DIR / f'{self.tag}_aligned'
+        if not in_filename.exists():
             print('warning file not found, nothing copied')
+            return
+
+        # renaming a link over another link to the same file does nothing, so check first
+        if not (out_filename.exists() and os.path.samefile(in_filename, out_filename)):
+            tmp_filename = out_filename.with_name(out_filename.name + '.tmp')
+            if os.path.lexists(tmp_filename):
+                os.unlink(tmp_filename)
+            try:
+                os.link(in_filename, tmp_filename)
+            except OSError:
+                os.symlink(in_filename.name, tmp_filename)
+            os.replace(tmp_filename, out_filename)
+
+        if not _alignment_matrix_is_current(out_filename):
+            write_alignment_matrix(out_filename)
+        self.write_expanded_alignment()
+
+    def write_expanded_alignment(self):
+        """
+        DESCRIPTION:
+        Writes {tag}_expanded, the alignment with a row for every duplicate of the aligned records,
+        if config.EXPAND_DUPLICATES and there are duplicates
+        """
+        expanded_filename = config.FASTA_DIR / SequenceAligner.expanded_pattern.format(tag=self.tag)
+        if self.duplicates is None or not self.duplicates.members or not config.EXPAND_DUPLICATES:
+            if expanded_filename.exists():
+                expanded_filename.unlink()
+            return
+        expand_alignment(config.FASTA_DIR / self.get_aligned_filename(), self.duplicates, expanded_filename)
+
+    def get_unaligned_filename(self):
+        """
+        DESCRIPTION:
+        Returns the name of the file with the sequences this object has to align
+        :return: [string] the name of the file
+        """
+        return SequenceAligner.unaligned_pattern.format(tag=self.tag, file_id=self.file_id)
 
     def get_aligned_filename(self):
         """
@@ -143,14 +349,79 @@ class SequenceAligner:
         :return: [string, list] id of the last alignment done with this tag
         and list of id's of sequences already aligned by that
         """
+        json_info = SequenceAligner._get_information(tag)
+        if not json_info:
+            return None, []
+        return json_info['last_id'], json_info['aligned_ids']
+
+    @staticmethod
+    def _get_information(tag):
+        """
+        DESCRIPTION:
+        Loads the information file of a tag
+        :param tag: [string] name of the alignment to check
+        :return: [dictionary] the information, empty if there is no alignment with that tag
+        """
         try:
             filename = SequenceAligner.information_pattern.format(tag=tag)
             with open(config.FASTA_DIR / filename, 'r') as file:
-                json_info = json.load(file)
-                return json_info['last_id'], json_info['aligned_ids']
+                return json.load(file)
         except FileNotFoundError:
-            return None, []
+            return {}
 
+    def iter_filtered_records(self):
+        """
+        DESCRIPTION:
+        Yields this object's records that fulfill the self.filters criteria and
+        haven't been aligned yet, one at a time, with the stored ones of earlier runs
+        that weren't aligned, see select_records
+        :return: [generator] the records that pass the filters
+        """
+        if self.unfiltered_records is None:
+            return
+
+        for record in select_records([self], self.unfiltered_records):
+            if self.accepts(record):
+                yield record
+
+    def accepts(self, record):
+        """
+        DESCRIPTION:
+        Checks whether a record fulfills the self.filters criteria and hasn't been aligned yet
+        :param record: [SeqRecord] the record to check
+        :return: [boolean] true iff the record has to be aligned by this object
+        """
+        if record.id in self.aligned_index:
+            return False
+
+        if self.duplicates is not None and record.id in self.duplicates:
+            return False
+
+        if self.query is not None:
+            if self._catalogued_ids is not None and record.id in self._catalogued_ids:
+                if record.id not in self._query_ids:
+                    return False
+            elif not self.query.matches(catalog_entry(None, record_metadata(record), str(record.seq))):
+                return False
+
+        if self._compiled_filter is None:
+            self._compiled_filter = CompiledFilter(self.filters)
+        return self._compiled_filter(record.description)
+
+    def is_representative(self, record, key=None):
+        """
+        DESCRIPTION:
+        Registers an accepted record in the duplicates table
+        :param record: [SeqRecord] the record
+        :param key: [string] sequence_hash of the record's sequence, computed if not given
+        :return: [boolean] true iff the record has to be written, i.e. there is no
+        deduplication or it's the first record with its sequence
+        """
+        if self.duplicates is None:
+            return True
+        return self.duplicates.add(record.id, key or sequence_hash(str(record.seq)))
+
+    @profiling.hot
     def get_filtered_records(self):
         """
         DESCRIPTION:
@@ -161,15 +432,7 @@ class SequenceAligner:
         if self.unfiltered_records is None:
             return None
 
-        result_records = []
-        for record in self.unfiltered_records:
-            if record.id in self.already_aligned_sequence_ids:
-                continue
-
-            if all([description_filter(record.description) for description_filter in self.filters]):
-                result_records.append(record)
-
-        return result_records
+        return list(self.iter_filtered_records())
 
     def set_records(self, records):
         """
@@ -182,48 +445,51 @@ class SequenceAligner:
         """
         DESCRIPTION:
         Filters self.unfiltered_records and writes the records that pass into a
-        file in the fasta format
+        file in the fasta format. The records are streamed, so they don't need to
+        fit in memory
         :return: [list] list of the record's ids that were written to the file
         """
-        records = self.get_filtered_records()
-        if len(records) == 0:
-            print('no records to write to file, done nothing')
-            return []
-
         sequence_ids_written = []
-        output_file = config.FASTA_DIR / SequenceAligner.unaligned_pattern.format(
-            tag=self.tag, file_id=self.file_id)
-        with open(output_file, 'w') as file:
-            for record in records:
+        output_file = config.FASTA_DIR / self.get_unaligned_filename()
+        file = None
+        try:
+            for record in self.iter_filtered_records():
+                if not self.is_representative(record):
+                    continue
+                if file is None:
+                    file = open(output_file, 'w')
                 file.write(record.format('fasta'))
                 sequence_ids_written.append(record.id)
+        finally:
+            if file is not None:
+                file.close()
+
+        if len(sequence_ids_written) == 0:
+            print('no records to write to file, done nothing')
 
         return sequence_ids_written
 
-    def _align_from_scratch(self):
+    def _align_from_scratch(self, threads=1):
         """
         DESCRIPTION:
         Aligns unaligned sequences in case there was no previous alignment and
         writes the alignment to a file
+        :param threads: [int] number of threads MAFFT may use
         """
         origname = config.FASTA_DIR / SequenceAligner.unaligned_pattern.format(
             tag=self.tag, file_id=self.file_id)
         destname = config.FASTA_DIR / SequenceAligner.aligned_pattern.format(
             tag=self.tag, file_id=self.file_id)
         print('Executing sequences alignment...')
-        mafft_cline = MafftCommandline(config.MAFFT_DIR, input=origname)
-        stdout, stderr = mafft_cline()
+        mafft.run_mafft([origname], destname, threads=threads)
         print('Alignment completed')
-        # Write result into file
-        with open(destname, 'w') as file:
-            file.write(stdout)
-        print('Alignment saved')
 
-    def _align_from_existing(self):
+    def _align_from_existing(self, threads=1):
         """
         DESCRIPTION:
         Add unaligned sequences to an existing alignment and writes the alignment
         to a file
+        :param threads: [int] number of threads MAFFT may use
         """
         unaligned_file = config.FASTA_DIR / SequenceAligner.unaligned_pattern.format(
             tag=self.tag, file_id=self.file_id)
@@ -232,10 +498,290 @@ class SequenceAligner:
         output_file = config.FASTA_DIR / SequenceAligner.aligned_pattern.format(
             tag=self.tag, file_id=self.file_id)
         print('Executing sequences alignment...')
-        command = f'mafft --add {unaligned_file} --reorder {aligned_file} > {output_file}'
-        os.system(command)
+        mafft.run_mafft(['--add', unaligned_file, '--reorder', aligned_file], output_file, threads=threads)
         print('Alignment completed')
 
+    def _align_to_reference(self, threads=1):
+        """
+        DESCRIPTION:
+        Aligns the unaligned sequences one by one to the reference and appends them to the
+        previous alignment, if any, without changing its rows
+        :param threads: [int] total number of threads the MAFFT jobs may use
+        """
+        unaligned_file = config.FASTA_DIR / self.get_unaligned_filename()
+        previous_file = None
+        if self.already_aligned_file_id is not None:
+            previous_file = config.FASTA_DIR / SequenceAligner.aligned_pattern.format(
+                tag=self.tag, file_id=self.already_aligned_file_id)
+        output_file = config.FASTA_DIR / SequenceAligner.aligned_pattern.format(
+            tag=self.tag, file_id=self.file_id)
+        insertions_file = config.FASTA_DIR / SequenceAligner.insertions_pattern.format(
+            tag=self.tag, file_id=self.file_id)
+        print('Executing sequences alignment...')
+        mafft.align_to_reference(unaligned_file, config.FASTA_DIR / config.REFERENCE_FASTA_FNAME, output_file,
+                                 insertions_file, previous_file=previous_file, cpu_budget=threads)
+        print('Alignment completed')
+
+
+def write_filtered_records_to_files(aligners, records):
+    """
+    DESCRIPTION:
+    Writes the unaligned files of several aligners in a single pass over the records.
+    Every record is checked against every aligner and formatted as fasta at most once
+    :param aligners: [list] the SequenceAligner objects
+    :param records: [iterable] the records to distribute
+    :return: [list] for every aligner, the list of the ids written to its unaligned file
+    """
+    sequence_ids_written = [[] for _ in aligners]
+    files = [None for _ in aligners]
+    try:
+        with profiling.stage('align.filter') as counters:
+            for record in records:
+                counters['records'] += 1
+                fasta = None
+                key = None
+                for i, aligner in enumerate(aligners):
+                    if not aligner.accepts(record):
+                        continue
+                    if aligner.duplicates is not None:
+                        if key is None:
+                            key = sequence_hash(str(record.seq))
+                        if not aligner.is_representative(record, key):
+                            continue
+                    if fasta is None:
+                        fasta = record.format('fasta')
+                    if files[i] is None:
+                        files[i] = open(config.FASTA_DIR / aligner.get_unaligned_filename(), 'w')
+                    files[i].write(fasta)
+                    sequence_ids_written[i].append(record.id)
+    finally:
+        for file in files:
+            if file is not None:
+                file.close()
+
+    return sequence_ids_written
+
+
+def _link_or_copy(in_filename, out_filename):
+    """
+    DESCRIPTION:
+    Makes out_filename a hard link to in_filename, or a copy of it where hard links can't be made
+    """
+    if os.path.lexists(out_filename):
+        os.unlink(out_filename)
+    try:
+        os.link(in_filename, out_filename)
+    except OSError:
+        shutil.copyfile(in_filename, out_filename)
+
+
+def _records_hash(records):
+    """
+    DESCRIPTION:
+    Hash of the uids of a record stream, None for records that aren't a stream of uids
+    """
+    uids = getattr(records, 'uids', None)
+    return None if uids is None else hash_ids(uids)
+
+
+def select_records(aligners, records):
+    """
+    DESCRIPTION:
+    Looks up the records of the aligners' queries in the catalog of the record store. If all the
+    aligners have a query, only the records they select and haven't aligned yet, and the ones not
+    stored yet, are read. The records selected are all those that aren't aligned yet, not only the
+    ones of records, so records of earlier searches that weren't aligned (MAFFT failed, the run was
+    interrupted, the tag is new) are aligned too. Opening the store catalogues the records stored
+    before the catalog existed, the ones that aren't stored yet are checked against the queries as
+    they are downloaded
+    :param aligners: [list] the SequenceAligner objects
+    :param records: [iterable] the records, a stream of uids with a cache to use the catalog
+    :return: [iterable] the records to read
+    """
+    cache_dir = getattr(records, 'cache_dir', None)
+    if cache_dir is None or not aligners or any(aligner.query is None for aligner in aligners):
+        return records
+
+    store_dir = cache_dir / config.RECORD_STORE_DIRNAME
+    if not store_dir.exists():
+        return records
+
+    with RecordStore(store_dir) as store:
+        catalog = store.catalog
+        catalogued = catalog.ids()
+        catalogued_ids = set(catalogued.values())
+        # uid of every selected record by its id
+        selected = {}
+        for aligner in aligners:
+            query_ids = catalog.select(aligner.query)
+            aligner.set_catalog_selection(catalogued_ids, set(query_ids.values()))
+            selected.update((sequence_id, uid) for uid, sequence_id in query_ids.items()
+                            if sequence_id not in aligner.aligned_index and
+                            (aligner.duplicates is None or sequence_id not in aligner.duplicates))
+
+    # a record stored under its GI has its accession.version as uid in later searches, and both
+    # can be listed, so the records are told apart by their id
+    uids = []
+    listed = set()
+    for uid in records.uids:
+        sequence_id = catalogued.get(uid, uid if uid in catalogued_ids else None)
+        if sequence_id is None:
+            uids.append(uid)
+        elif sequence_id in selected and sequence_id not in listed:
+            uids.append(uid)
+            listed.add(sequence_id)
+    earlier = sorted(uid for sequence_id, uid in selected.items() if sequence_id not in listed)
+    print(f'catalog: {len(uids)} of {len(records.uids)} records selected or not stored yet, '
+          f'{len(earlier)} stored records not aligned yet')
+    return records.subset(uids + earlier)
+
+
+def make_alignments(aligners, records, make_copy=False, cpu_budget=None):
+    """
+    DESCRIPTION:
+    Filters the records for several aligners at once and then runs their
+    alignments in parallel, sharing a CPU budget among the MAFFT jobs. Aligners whose
+    records, filters and alignment are the same as in a previous run are skipped, and
+    if all of them are the records aren't read at all
+    :param aligners: [list] the SequenceAligner objects
+    :param records: [iterable] the records to align, walked only once
+    :param make_copy: [boolean] whether to copy every alignment to a file without timestamp
+    :param cpu_budget: [int] total number of MAFFT threads, defaults to config.MAFFT_CPU_BUDGET
+    """
+    records_hash = _records_hash(records)
+    changed = [aligner for aligner in aligners if records_hash is None or
+               not aligner.manifest.is_unchanged('filter', aligner._filter_inputs_hash(records_hash))]
+    sequence_ids_written = {}
+    if changed:
+        records = select_records(changed, records)
+        sequence_ids_written = dict(zip(changed, write_filtered_records_to_files(changed, records)))
+
+    def align_job(aligner, ids):
+        def align(threads):
+            print(f'{aligner.tag}: {len(ids)} new sequences')
+            aligned = aligner._align_written_records(ids, threads=threads)
+            if records_hash is not None and aligned:
+                aligner.manifest.record('filter', aligner._filter_inputs_hash(records_hash))
+            if make_copy:
+                aligner.copy_aligned_file_unstamped()
+        return align
+
+    for aligner in aligners:
+        if aligner not in sequence_ids_written:
+            print(f'{aligner.tag}: records, filters and alignment unchanged')
+            if make_copy:
+                aligner.copy_aligned_file_unstamped()
+
+    jobs = [align_job(aligner, ids) for aligner, ids in sequence_ids_written.items()]
+    mafft.run_jobs(jobs, cpu_budget=cpu_budget)
+
+
+class AlignedIdIndex:
+    """
+    DESCRIPTION:
+    Membership index of the ids of the sequences already aligned. Uses a hash set, or a
+    sorted byte string array when there are more than config.ALIGNED_ID_SET_LIMIT ids,
+    which takes a fraction of the memory at the cost of a binary search per lookup
+    """
+
+    def __init__(self, ids=None, set_limit=None):
+        """
+        DESCRIPTION:
+        Constructor of the AlignedIdIndex class
+        :param ids: [iterable] ids to index
+        :param set_limit: [int] number of ids from which a sorted array is used,
+        defaults to config.ALIGNED_ID_SET_LIMIT
+        :return: [AlignedIdIndex] the created object
+        """
+        self.set_limit = set_limit or config.ALIGNED_ID_SET_LIMIT
+        self._ids = set()
+        self._sorted_ids = np.array([], dtype='S1')
+        self.update(ids or [])
+
+    def __contains__(self, sequence_id):
+        if sequence_id in self._ids:
+            return True
+        if len(self._sorted_ids) == 0:
+            return False
+        key = sequence_id.encode()
+        position = np.searchsorted(self._sorted_ids, key)
+        return position < len(self._sorted_ids) and self._sorted_ids[position] == key
+
+    def __len__(self):
+        return len(self._ids) + len(self._sorted_ids)
+
+    def update(self, ids):
+        """
+        DESCRIPTION:
+        Adds ids to the index
+        :param ids: [iterable] the ids to add
+        """
+        self._ids.update(ids)
+        if self._ids and len(self) > self.set_limit:
+            new_ids = np.array([sequence_id.encode() for sequence_id in self._ids])
+            self._sorted_ids = np.unique(np.concatenate([self._sorted_ids, new_ids]))
+            self._ids = set()
+
+
+class CompiledFilter:
+    """
+    DESCRIPTION:
+    Combines the all/any/none filters of several Filter objects into one flat set of
+    key word checks evaluated in a single call, cheapest rejections first
+    """
+
+    def __init__(self, filters):
+        """
+        DESCRIPTION:
+        Constructor of the CompiledFilter class
+        :param filters: [list] filter functions as added to a SequenceAligner. Methods of Filter
+        objects are compiled, any other function is just called
+        :return: [CompiledFilter] the created object
+        """
+        all_key_words = []
+        none_key_words = []
+        any_key_words = []
+        self.other_filters = []
+        for description_filter in filters:
+            key_word_filter = getattr(description_filter, '__self__', None)
+            name = getattr(description_filter, '__name__', None)
+            if not isinstance(key_word_filter, Filter):
+                self.other_filters.append(description_filter)
+            elif name == 'all_filter':
+                all_key_words += key_word_filter.key_words
+            elif name == 'none_filter':
+                none_key_words += key_word_filter.key_words
+            elif name == 'any_filter':
+                any_key_words.append(tuple(key_word_filter.key_words))
+            else:
+                self.other_filters.append(description_filter)
+
+        # dict.fromkeys drops repeated key words keeping their order
+        self.all_key_words = tuple(dict.fromkeys(all_key_words))
+        self.none_key_words = tuple(dict.fromkeys(none_key_words))
+        self.any_key_words = tuple(dict.fromkeys(any_key_words))
+
+    def __call__(self, string_to_check):
+        """
+        DESCRIPTION:
+        Checks a string against all the compiled filters
+        :param string_to_check: [string] the string to check
+        :return: [boolean] true iff the string passes all the filters
+        """
+        for key_word in self.all_key_words:
+            if key_word not in string_to_check:
+                return False
+        for key_word in self.none_key_words:
+            if key_word in string_to_check:
+                return False
+        for key_words in self.any_key_words:
+            if not any(key_word in string_to_check for key_word in key_words):
+                return False
+        for description_filter in self.other_filters:
+            if not description_filter(string_to_check):
+                return False
+        return True
+
 
 class Filter:
     def __init__(self, key_words):
@@ -254,7 +800,7 @@ class Filter:
         :param string_to_check: [string] the string to check
         :return: [boolean] true iff the string to check contains all the keywords
         """
-        return all([key_word in string_to_check for key_word in self.key_words])
+        return all(key_word in string_to_check for key_word in self.key_words)
 
     def any_filter(self, string_to_check):
         """
@@ -263,7 +809,7 @@ class Filter:
         :param string_to_check: [string] the string to check
         :return: [boolean] true iff the string to check contains at least one of the keywords
         """
-        return any([key_word in string_to_check for key_word in self.key_words])
+        return any(key_word in string_to_check for key_word in self.key_words)
 
     def none_filter(self, string_to_check):
         """
@@ -272,7 +818,7 @@ class Filter:
         :param string_to_check: [string] the string to check
         :return: [boolean] true iff the string to check contains none of the keywords
         """
-        return not any([key_word in string_to_check for key_word in self.key_words])
+        return not any(key_word in string_to_check for key_word in self.key_words)
 
 
 def _get_aligned_content_by_tag(tag):
@@ -300,30 +846,603 @@ def aligned_records_by_tag(tag):
     return records
 
 
-def analyse_alignment(aligned_records):
+class AlignmentMatrix:
+    """
+    DESCRIPTION:
+    Alignment stored as a fixed width binary file that can be memory mapped:
+    a header with the number of sequences and sites, the table of the fasta headers
+    and the N x L matrix with one byte per site
+    """
+
+    magic = b'CPALNMAT'
+    version = 1
+    header_format = '<8sIIQQQ'
+    extension = '.alnmat'
+
+    def __init__(self, headers, matrix):
+        """
+        DESCRIPTION:
+        Constructor of the AlignmentMatrix class
+        :param headers: [list] fasta headers of the sequences
+        :param matrix: [np.ndarray] N x L uint8 matrix, usually a np.memmap
+        :return: [AlignmentMatrix] the created object
+        """
+        self.headers = headers
+        self.matrix = matrix
+
+    def __len__(self):
+        return len(self.headers)
+
+    def sequence(self, i):
+        """
+        DESCRIPTION:
+        Returns the i-th sequence as a string
+        """
+        return self.matrix[i].tobytes().decode('ascii')
+
+    def records(self):
+        """
+        DESCRIPTION:
+        Returns the alignment in the format of aligned_records_by_tag
+        :return: [list] list of dictionaries with header and sequence
+        """
+        return [{'header': header, 'sequence': self.sequence(i)} for i, header in enumerate(self.headers)]
+
+    @staticmethod
+    def _table_size(header_bytes):
+        # keep the matrix 8 byte aligned
+        return -(-header_bytes // 8) * 8
+
+    @staticmethod
+    def write(path, headers, rows, length):
+        """
+        DESCRIPTION:
+        Writes an alignment matrix file. The file is written under a temporary name
+        and renamed when complete
+        :param path: [pathlib] the file to write
+        :param headers: [list] fasta headers of the sequences
+        :param rows: [iterable] the sequences, as strings of the given length, in the order of headers
+        :param length: [int] number of sites of the alignment
+        """
+        header_table = '\n'.join(headers).encode('utf-8')
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as file:
+            file.write(struct.pack(AlignmentMatrix.header_format, AlignmentMatrix.magic, AlignmentMatrix.version,
+                                   0, len(headers), length, len(header_table)))
+            file.write(header_table.ljust(AlignmentMatrix._table_size(len(header_table)), b'\0'))
+            n_rows = 0
+            for row in rows:
+                if len(row) != length:
+                    raise ValueError('sequences don\'t have same length')
+                file.write(row.encode('ascii'))
+                n_rows += 1
+        if n_rows != len(headers):
+            raise ValueError(f'{len(headers)} headers but {n_rows} sequences')
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def open(path):
+        """
+        DESCRIPTION:
+        Opens an alignment matrix file, the matrix is memory mapped, not read
+        :param path: [pathlib] the file
+        :return: [AlignmentMatrix] the alignment
+        """
+        header_size = struct.calcsize(AlignmentMatrix.header_format)
+        with open(path, 'rb') as file:
+            magic, version, _, n_sequences, length, header_bytes = struct.unpack(
+                AlignmentMatrix.header_format, file.read(header_size))
+            if magic != AlignmentMatrix.magic or version != AlignmentMatrix.version:
+                raise ValueError(f'{path} is not an alignment matrix file')
+            header_table = file.read(header_bytes).decode('utf-8')
+
+        headers = header_table.split('\n') if n_sequences > 0 else []
+        offset = header_size + AlignmentMatrix._table_size(header_bytes)
+        if n_sequences == 0 or length == 0:
+            matrix = np.zeros((n_sequences, length), dtype=np.uint8)
+        else:
+            matrix = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(n_sequences, length))
+        return AlignmentMatrix(headers, matrix)
+
+
+def iter_fasta_records(path, offset=0):
+    """
+    DESCRIPTION:
+    Reads a fasta file one record at a time
+    :param path: [pathlib] the fasta file
+    :param offset: [int] position of the file where a record starts to read from
+    :return: [generator] yields (header, sequence) tuples
+    """
+    header = None
+    chunks = []
+    with open(path, 'r') as file:
+        file.seek(offset)
+        for line in file:
+            line = line.strip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(chunks)
+                header = line[1:]
+                chunks = []
+            elif header is not None:
+                chunks.append(line)
+
+    if header is not None:
+        yield header, ''.join(chunks)
+
+
+def write_alignment_matrix(fasta_path):
+    """
+    DESCRIPTION:
+    Converts an aligned fasta file to an alignment matrix file next to it, reading the
+    fasta file twice instead of loading it
+    :param fasta_path: [pathlib] the aligned fasta file
+    :return: [pathlib] the alignment matrix file or None if the sequences don't have the same length
+    """
+    headers = []
+    lengths = set()
+    for header, sequence in iter_fasta_records(fasta_path):
+        headers.append(header)
+        lengths.add(len(sequence))
+    if len(lengths) > 1:
+        print('sequences don\'t have same length')
+        return None
+
+    matrix_path = fasta_path.with_name(fasta_path.name + AlignmentMatrix.extension)
+    rows = (sequence for _, sequence in iter_fasta_records(fasta_path))
+    AlignmentMatrix.write(matrix_path, headers, rows, lengths.pop() if lengths else 0)
+    return matrix_path
+
+
+def open_alignment_matrix(fasta_path):
+    """
+    DESCRIPTION:
+    Opens the alignment matrix of an aligned fasta file, converting the fasta file first
+    if the matrix file doesn't exist or is older
+    :param fasta_path: [pathlib] the aligned fasta file
+    :return: [AlignmentMatrix] the alignment or None if there is no such alignment
+    """
+    matrix_path = fasta_path.with_name(fasta_path.name + AlignmentMatrix.extension)
+    if not _alignment_matrix_is_current(fasta_path):
+        if not fasta_path.exists():
+            if not matrix_path.exists():
+                return None
+        else:
+            matrix_path = write_alignment_matrix(fasta_path)
+            if matrix_path is None:
+                return None
+
+    return AlignmentMatrix.open(matrix_path)
+
+
+def _alignment_matrix_is_current(fasta_path):
+    """
+    DESCRIPTION:
+    Checks whether the alignment matrix of an aligned fasta file exists and isn't older than it
+    """
+    matrix_path = fasta_path.with_name(fasta_path.name + AlignmentMatrix.extension)
+    try:
+        matrix_mtime = matrix_path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    try:
+        return matrix_mtime >= fasta_path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def aligned_matrix_by_tag(tag):
+    """
+    DESCRIPTION:
+    Memory mapped counterpart of aligned_records_by_tag
+    :param tag: [string] tag of the alignment
+    :return: [AlignmentMatrix] the alignment or None if there is no alignment with that tag
+    """
+    alignment = open_alignment_matrix(config.FASTA_DIR / f'{tag}_aligned')
+    if alignment is None:
+        print(f'no alignment with tag {tag}')
+    return alignment
+
+
+def alignment_matrix(aligned_records):
+    """
+    DESCRIPTION:
+    Builds the matrix of an alignment, one row per record and one byte per site
+    :param aligned_records: [list or AlignmentMatrix] records as returned by aligned_records_by_tag
+    or aligned_matrix_by_tag
+    :return: [np.ndarray] the N x L uint8 matrix, or None if the sequences don't have the same length
+    """
+    if isinstance(aligned_records, AlignmentMatrix):
+        return aligned_records.matrix
+
     sequences = [record['sequence'] for record in aligned_records]
     lengths = [len(seq) for seq in sequences]
     if max(lengths) != min(lengths):
         print('sequences don\'t have same length')
-        return
+        return None
 
-    num_gaps = np.zeros(lengths[0], dtype=int)
-    num_variation_det = np.zeros(lengths[0], dtype=int)
-    num_variation_all = np.zeros(lengths[0], dtype=int)
-    for site in range(lengths[0]):
-        num_nucleotides_det = {}
-        num_nucleotides_undet = {}
-        for seq in sequences:
-            c = seq[site]
-            if c == '-':
-                num_gaps[site] += 1
-            elif c == 'a' or c == 't' or c == 'g' or c == 'c':
-                num_nucleotides_det[c] = True
-            else:
-                num_nucleotides_undet[c] = True
+    matrix = np.empty((len(sequences), lengths[0]), dtype=np.uint8)
+    for i, seq in enumerate(sequences):
+        matrix[i] = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+
+    return matrix
+
+
+def site_symbol_counts(matrix, block_size=None):
+    """
+    DESCRIPTION:
+    Counts how many times every symbol appears in every column of an alignment matrix.
+    The columns are processed in blocks so the temporary arrays stay small
+    :param matrix: [np.ndarray] N x L uint8 alignment matrix
+    :param block_size: [int] number of matrix cells processed at once, defaults to config.ANALYSIS_BLOCK_SIZE
+    :return: [np.ndarray] 256 x L array, counts[symbol, site]
+    """
+    block_size = block_size or config.ANALYSIS_BLOCK_SIZE
+    n_sequences, length = matrix.shape
+    block_columns = max(1, block_size // max(1, n_sequences))
+    counts = np.zeros((256, length), dtype=np.int64)
+    for start in range(0, length, block_columns):
+        block = matrix[:, start:start + block_columns]
+        width = block.shape[1]
+        # symbol * width + column is a distinct bin for every (symbol, column) pair
+        bins = block.astype(np.int64) * width + np.arange(width)
+        counts[:, start:start + width] = np.bincount(bins.ravel(), minlength=256 * width).reshape(256, width)
+
+    return counts
+
+
+SITE_COUNTS_PATTERN = '{tag}_site_counts'
+
+
+class SiteCounts:
+    """
+    DESCRIPTION:
+    Counts of every symbol in every column of an alignment, kept only for the symbols that appear in it
+    (a few of the 256 byte values), as uint32
+    """
+
+    def __init__(self, symbols, counts):
+        """
+        DESCRIPTION:
+        Constructor of the SiteCounts class
+        :param symbols: [np.ndarray] the symbols that appear, sorted uint8 codes
+        :param counts: [np.ndarray] K x L uint32 array, counts[k, site] is the number of symbols[k] in the column
+        :return: [SiteCounts] the created object
+        """
+        self.symbols = symbols
+        self.counts = counts
+
+    @staticmethod
+    def from_array(counts):
+        """
+        DESCRIPTION:
+        Keeps the rows of the symbols that appear in a 256 x L array of counts
+        :param counts: [np.ndarray] 256 x L array, as returned by site_symbol_counts
+        :return: [SiteCounts] the counts
+        """
+        symbols = np.flatnonzero(counts.any(axis=1)).astype(np.uint8)
+        return SiteCounts(symbols, counts[symbols].astype(np.uint32))
+
+    @property
+    def n_sites(self):
+        return self.counts.shape[1]
+
+    def __getitem__(self, symbol):
+        """
+        DESCRIPTION:
+        Returns the counts of a symbol in every column
+        :param symbol: [int or string] the symbol or its code, e.g. '-' or ord('-')
+        :return: [np.ndarray] the counts, zero for a symbol that doesn't appear
+        """
+        code = ord(symbol) if isinstance(symbol, str) else symbol
+        k = np.searchsorted(self.symbols, code)
+        if k < len(self.symbols) and self.symbols[k] == code:
+            return self.counts[k]
+        return np.zeros(self.n_sites, dtype=np.uint32)
 
-        num_variation_det[site] = len(num_nucleotides_det)
-        num_variation_all[site] = num_variation_det[site] + len(num_nucleotides_undet)
+    def add(self, counts):
+        """
+        DESCRIPTION:
+        Adds counts of the same columns, e.g. of the rows added to the alignment
+        :param counts: [np.ndarray] 256 x L array, as returned by site_symbol_counts
+        """
+        added = SiteCounts.from_array(counts)
+        symbols = np.union1d(self.symbols, added.symbols).astype(np.uint8)
+        merged = np.zeros((len(symbols), self.n_sites), dtype=np.uint32)
+        merged[np.searchsorted(symbols, self.symbols)] = self.counts
+        merged[np.searchsorted(symbols, added.symbols)] += added.counts
+        self.symbols = symbols
+        self.counts = merged
+
+    def to_array(self):
+        """
+        DESCRIPTION:
+        Inverse of from_array
+        :return: [np.ndarray] 256 x L array, counts[symbol, site]
+        """
+        counts = np.zeros((256, self.n_sites), dtype=np.int64)
+        counts[self.symbols] = self.counts
+        return counts
+
+
+def _load_site_counts(tag):
+    """
+    DESCRIPTION:
+    Loads the per site counts saved for a tag
+    :return: [SiteCounts, dictionary] the counts and their information, or None, None
+    """
+    path = config.FASTA_DIR / SITE_COUNTS_PATTERN.format(tag=tag)
+    try:
+        with open(path.with_suffix('.json'), 'r') as file:
+            info = json.load(file)
+        counts = np.load(path.with_suffix('.npy'))
+    except (FileNotFoundError, ValueError):
+        return None, None
+    return SiteCounts(np.array(info['symbols'], dtype=np.uint8), counts), info
+
+
+def _save_site_counts(tag, counts, info):
+    path = config.FASTA_DIR / SITE_COUNTS_PATTERN.format(tag=tag)
+    tmp_path = path.with_name(path.name + '_tmp.npy')
+    np.save(tmp_path, counts.counts)
+    os.replace(tmp_path, path.with_suffix('.npy'))
+    with open(path.with_suffix('.json'), 'w') as file:
+        file.write(json.dumps(dict(info, symbols=counts.symbols.tolist())))
+
+
+def _count_rows(rows, length, counts=None, block_size=None):
+    """
+    DESCRIPTION:
+    Adds the symbols of every column of a number of aligned sequences to per site counts,
+    reading a block of sequences at a time
+    :param rows: [iterable] the sequences, as strings
+    :param length: [int] number of sites of the alignment
+    :param counts: [np.ndarray] 256 x L counts to add to, None to start from zero
+    :return: [np.ndarray, int] the counts and the number of sequences counted
+    """
+    block_size = block_size or config.ANALYSIS_BLOCK_SIZE
+    counts = np.zeros((256, length), dtype=np.int64) if counts is None else counts
+    block_rows = max(1, block_size // max(1, length))
+    block = []
+    n_rows = 0
+
+    def add_block():
+        matrix = np.frombuffer(''.join(block).encode('ascii'), dtype=np.uint8)
+        counts[:] += site_symbol_counts(matrix.reshape(len(block), length), block_size=block_size)
+
+    for row in rows:
+        if len(row) != length:
+            raise ValueError('sequences don\'t have same length')
+        block.append(row)
+        n_rows += 1
+        if len(block) == block_rows:
+            add_block()
+            block = []
+    if block:
+        add_block()
+    return counts, n_rows
+
+
+def update_site_counts(tag, file_id, fasta_path, previous_file_id=None, new_ids=None, offset=0):
+    """
+    DESCRIPTION:
+    Updates the counts of every symbol in every column saved for a tag, {tag}_site_counts.npy in the
+    fasta folder, to those of a new alignment. If the saved counts are those of previous_file_id, the new
+    alignment has the same columns and only adds the rows of new_ids, only these rows are counted.
+    Otherwise all the rows are counted
+    :param tag: [string] tag of the alignment
+    :param file_id: [string] id of the new alignment
+    :param fasta_path: [pathlib] the aligned fasta file
+    :param previous_file_id: [string] id of the alignment the new one extends
+    :param new_ids: [set] ids of the rows added by the new alignment
+    :param offset: [int] position of fasta_path where the added rows start, if they are at its end
+    :return: [SiteCounts] the counts, or None if the sequences don't have the same length
+    """
+    counts, info = _load_site_counts(tag)
+    if counts is not None and info['file_id'] == file_id:
+        return counts
+
+    if counts is not None and new_ids is not None and info['file_id'] == previous_file_id:
+        rows = (sequence for header, sequence in iter_fasta_records(fasta_path, offset=offset)
+                if (header.split(maxsplit=1) or [''])[0] in new_ids)
+        first_row = next(rows, None)
+        # MAFFT --add inserts columns in the previous rows when a new sequence needs them
+        if first_row is None or len(first_row) == counts.n_sites:
+            try:
+                added, n_rows = _count_rows(chain([first_row] if first_row is not None else [], rows),
+                                            counts.n_sites)
+                counts.add(added)
+                _save_site_counts(tag, counts, {'file_id': file_id, 'n_rows': info['n_rows'] + n_rows})
+                return counts
+            except ValueError:
+                pass
+
+    records = iter_fasta_records(fasta_path)
+    first_record = next(records, None)
+    if first_record is None:
+        return None
+    try:
+        counts, n_rows = _count_rows(chain([first_record[1]], (sequence for _, sequence in records)),
+                                     len(first_record[1]))
+    except ValueError:
+        print('sequences don\'t have same length')
+        return None
+    counts = SiteCounts.from_array(counts)
+    _save_site_counts(tag, counts, {'file_id': file_id, 'n_rows': n_rows})
+    return counts
+
+
+def site_counts_by_tag(tag):
+    """
+    DESCRIPTION:
+    Returns the counts of every symbol in every column of the alignment of a tag. They are kept up to
+    date as sequences are aligned, so this only reads them unless they are missing or older than the alignment
+    :param tag: [string] tag of the alignment
+    :return: [SiteCounts] the counts, or None if there is no alignment with that tag
+    """
+    fasta_path = config.FASTA_DIR / f'{tag}_aligned'
+    counts_path = config.FASTA_DIR / (SITE_COUNTS_PATTERN.format(tag=tag) + '.npy')
+    try:
+        is_current = counts_path.stat().st_mtime >= fasta_path.stat().st_mtime
+    except FileNotFoundError:
+        is_current = False
+
+    if is_current:
+        counts, _ = _load_site_counts(tag)
+        if counts is not None:
+            return counts
+
+    if not fasta_path.exists():
+        print(f'no alignment with tag {tag}')
+        return None
+    file_id, _ = SequenceAligner.get_actual(tag)
+    return update_site_counts(tag, file_id, fasta_path)
+
+
+def site_statistics(counts):
+    """
+    DESCRIPTION:
+    Computes per site statistics from the counts of every symbol in every column
+    :param counts: [SiteCounts or np.ndarray] the counts, as returned by site_counts_by_tag, or a
+    256 x L array as returned by site_symbol_counts
+    :return: [np.ndarray, np.ndarray, np.ndarray] per site, the number of gaps, the number of distinct
+    determined bases (a, t, g, c) and the number of distinct symbols other than the gap
+    """
+    if isinstance(counts, np.ndarray):
+        counts = SiteCounts.from_array(counts)
+    num_gaps = counts['-'].astype(int)
+    num_variation_det = sum((counts[c] > 0).astype(int) for c in 'atgc')
+    num_variation_all = (counts.counts > 0).sum(axis=0).astype(int) - (num_gaps > 0)
 
     return num_gaps, num_variation_det, num_variation_all
 
+
+@profiling.hot
+def analyse_alignment(aligned_records, block_size=None):
+    """
+    DESCRIPTION:
+    Computes per site statistics of an alignment
+    :param aligned_records: [list or AlignmentMatrix] records as returned by aligned_records_by_tag
+    or aligned_matrix_by_tag
+    :param block_size: [int] number of matrix cells processed at once, defaults to config.ANALYSIS_BLOCK_SIZE
+    :return: [np.ndarray, np.ndarray, np.ndarray] per site, the number of gaps, the number of distinct
+    determined bases (a, t, g, c) and the number of distinct symbols other than the gap
+    """
+    matrix = alignment_matrix(aligned_records)
+    if matrix is None:
+        return
+
+    return site_statistics(site_symbol_counts(matrix, block_size=block_size))
+
+
+SNP_DISTANCES_PATTERN = '{tag}_snp_distances'
+
+# codes of the symbols for the SNP distances, 0 to 3 for the determined bases, 4 for anything else
+_SNP_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    _SNP_CODES[[ord(base) for base in _bases]] = _code
+
+
+def _snp_encoding(codes, sign):
+    """
+    DESCRIPTION:
+    Encodes the rows of a block of SNP codes as [determined | one-hot of the base] vectors, so that
+    the product of the encodings of two rows, one of them with sign -1, is their SNP distance
+    """
+    determined = (codes < 4).astype(np.float32)
+    one_hot = (codes[:, :, None] == np.arange(4, dtype=np.uint8)).reshape(len(codes), -1).astype(np.float32)
+    return np.concatenate([determined, sign * one_hot], axis=1)
+
+
+@profiling.hot
+def snp_distance_matrix(aligned_records, path=None, block_rows=None, block_size=None, threads=None):
+    """
+    DESCRIPTION:
+    Computes the number of SNPs between every pair of aligned genomes, counting only the sites where both
+    have a determined base (gaps and ambiguous bases are ignored). The matrix is computed by tiles of
+    block_rows genomes running on several threads, every tile as matrix products of one-hot encoded
+    blocks of columns, so the memory used doesn't depend on the size of the alignment
+    :param aligned_records: [list or AlignmentMatrix] records as returned by aligned_records_by_tag
+    or aligned_matrix_by_tag
+    :param path: [pathlib] .npy file for the matrix, which is then written as it is computed. None to
+    keep it in memory
+    :param block_rows: [int] number of genomes per tile, defaults to config.SNP_DISTANCE_BLOCK_ROWS
+    :param block_size: [int] number of matrix cells encoded at once per tile, defaults to config.ANALYSIS_BLOCK_SIZE
+    :param threads: [int] number of tiles computed at the same time, defaults to config.ANALYSIS_THREADS
+    :return: [np.ndarray] the N x N matrix of distances, memory mapped if path is given, or None if the
+    sequences don't have the same length
+    """
+    matrix = alignment_matrix(aligned_records)
+    if matrix is None:
+        return None
+
+    block_rows = block_rows or config.SNP_DISTANCE_BLOCK_ROWS
+    block_size = block_size or config.ANALYSIS_BLOCK_SIZE
+    n_sequences, length = matrix.shape
+    dtype = np.uint16 if length < 2 ** 16 else np.uint32
+    if path is not None:
+        distances = np.lib.format.open_memmap(path.with_name(path.name + '.tmp'), mode='w+', dtype=dtype,
+                                              shape=(n_sequences, n_sequences))
+    else:
+        distances = np.zeros((n_sequences, n_sequences), dtype=dtype)
+
+    # float32 products are exact as long as a block has less than 2 ** 24 columns
+    block_columns = max(1, min(2 ** 24, block_size // (10 * block_rows)))
+
+    def tile(start_i, start_j):
+        rows_i = slice(start_i, start_i + block_rows)
+        rows_j = slice(start_j, start_j + block_rows)
+        total = np.zeros((min(block_rows, n_sequences - start_i), min(block_rows, n_sequences - start_j)),
+                         dtype=np.int64)
+        for start in range(0, length, block_columns):
+            columns = slice(start, start + block_columns)
+            encoded_i = _snp_encoding(_SNP_CODES[matrix[rows_i, columns]], 1)
+            encoded_j = _snp_encoding(_SNP_CODES[matrix[rows_j, columns]], -1)
+            total += np.rint(encoded_i @ encoded_j.T).astype(np.int64)
+        distances[rows_i, rows_j] = total
+        distances[rows_j, rows_i] = total.T
+
+    starts = range(0, n_sequences, block_rows)
+    with ThreadPoolExecutor(max_workers=threads or config.ANALYSIS_THREADS) as executor:
+        futures = [executor.submit(tile, start_i, start_j) for start_i in starts for start_j in starts if start_j >= start_i]
+    for future in futures:
+        future.result()
+
+    if path is not None:
+        distances.flush()
+        del distances
+        os.replace(path.with_name(path.name + '.tmp'), path)
+        distances = np.load(path, mmap_mode='r')
+    return distances
+
+
+def snp_distances_by_tag(tag):
+    """
+    DESCRIPTION:
+    Returns the SNP distance matrix of the alignment of a tag, computed with snp_distance_matrix and kept
+    in the fasta folder as {tag}_snp_distances.npy, with the headers of its rows in {tag}_snp_distances.txt.
+    It is only computed again if the alignment changed
+    :param tag: [string] tag of the alignment
+    :return: [list, np.ndarray] headers of the rows and memory mapped matrix, or None if there is no
+    alignment with that tag
+    """
+    fasta_path = config.FASTA_DIR / f'{tag}_aligned'
+    path = config.FASTA_DIR / (SNP_DISTANCES_PATTERN.format(tag=tag) + '.npy')
+    headers_path = config.FASTA_DIR / (SNP_DISTANCES_PATTERN.format(tag=tag) + '.txt')
+    try:
+        is_current = path.stat().st_mtime >= fasta_path.stat().st_mtime and headers_path.exists()
+    except FileNotFoundError:
+        is_current = False
+
+    if not is_current:
+        alignment = aligned_matrix_by_tag(tag)
+        if alignment is None:
+            return None
+        with open(headers_path, 'w') as file:
+            file.write('\n'.join(alignment.headers))
+        if snp_distance_matrix(alignment, path=path) is None:
+            return None
+
+    with open(headers_path, 'r') as file:
+        headers = file.read().split('\n')
+    return headers, np.load(path, mmap_mode='r')
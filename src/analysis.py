@@ -1,5 +1,4 @@
 import align_tools as at
-import matplotlib.pyplot as plt
 import numpy as np
 from collections import Counter
 
@@ -23,6 +22,7 @@ def get_counter(arr, lower_sat=None, upper_sat=None):
 
 
 def analyse_gaps(num_gaps, collaps_factor=1):
+    import matplotlib.pyplot as plt
     print(get_counter(num_gaps, upper_sat=1))
     has_gaps = [h(num_gap) for num_gap in num_gaps]
     num_gaps_collaps = [sum(has_gaps[max([collaps_factor*i, 0]):min([collaps_factor*(i+1), len(has_gaps)])]) for i in range(int(len(has_gaps)/collaps_factor)+1)]
@@ -37,6 +37,7 @@ def analyse_gaps(num_gaps, collaps_factor=1):
 
 
 def analyse_changes(num_vars_det, num_vars_all):
+    import matplotlib.pyplot as plt
     vars_det_sites = get_counter(num_vars_det, 0, 4)
     vars_all_sites = get_counter(num_vars_all, 0, 4)
     print('only determined')
@@ -60,8 +61,8 @@ def analyse_changes(num_vars_det, num_vars_all):
 
 
 def main():
-    records = at.aligned_records_by_tag("complete")
-    num_gaps, num_vars_det, num_vars_all = at.analyse_alignment(records)
+    counts = at.site_counts_by_tag("complete")
+    num_gaps, num_vars_det, num_vars_all = at.site_statistics(counts)
     print("done anaylsis")
 
     analyse_gaps(num_gaps, collaps_factor=300)
@@ -0,0 +1,485 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# the stages change settings and urls of the pipeline modules, so they run in a process of their own,
+# with the data folder of the benchmark given by the environment
+
+SRC_DIR = Path(__file__).resolve().parent
+# results of the runs, in the data folder of the pipeline, see config.BASE_DIR
+RESULTS_FNAME = 'benchmarks.jsonl'
+FIRST_UID = 2000000
+COUNTRIES = ['USA', 'United Kingdom', 'Spain', 'China', 'India', 'Brazil', 'South Africa', 'Japan']
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+AMBIGUOUS = np.frombuffer(b'RYKMSW', dtype=np.uint8)
+
+DEFAULT_PARAMETERS = {'genomes': 1000,
+                      'length': 29903,
+                      'lineages': 20,
+                      'lineage_snps': 30,
+                      'snp_rate': 0.0003,
+                      'n_runs': 2,
+                      'n_run_length': 250,
+                      'ambiguous_rate': 0.00005,
+                      'deletion_rate': 0.3,
+                      'partial_rate': 0.05,
+                      'seed': 0,
+                      'select': 100,
+                      'snp_distance_limit': 20000,
+                      }
+
+
+class SyntheticCorpus:
+    """
+    DESCRIPTION:
+    Deterministic corpus of SARS-CoV-2-like genomes: a random ancestor, a number of lineages with
+    their own SNPs and genomes that add private SNPs, runs of N (amplicon dropouts), a few ambiguous
+    bases and deletions. Every genome only depends on its uid, so any part of the corpus can be
+    generated on demand
+    """
+
+    def __init__(self, parameters):
+        """
+        DESCRIPTION:
+        Constructor of the SyntheticCorpus class
+        :param parameters: [dictionary] parameters of the corpus, see DEFAULT_PARAMETERS
+        :return: [SyntheticCorpus] the created object
+        """
+        self.parameters = parameters
+        rng = np.random.default_rng(parameters['seed'])
+        length = parameters['length']
+        self.ancestor = rng.choice(BASES, length)
+        self.lineages = []
+        for _ in range(parameters['lineages']):
+            sites = rng.choice(length, parameters['lineage_snps'], replace=False)
+            self.lineages.append((sites, rng.choice(BASES, len(sites))))
+        self.uids = [str(FIRST_UID + k) for k in range(parameters['genomes'])]
+
+    def accession(self, uid):
+        """
+        DESCRIPTION:
+        Accession.version of a uid, the id esearch returns for it with idtype=acc
+        :param uid: [string] the uid
+        :return: [string] the accession.version
+        """
+        return f'MW{int(uid) - FIRST_UID:06d}.1'
+
+    def uid(self, record_id):
+        """
+        DESCRIPTION:
+        Inverse of accession, uids are returned as they are
+        :param record_id: [string] a uid or an accession, with or without version
+        :return: [string] the uid
+        """
+        if record_id.isdigit():
+            return record_id
+        return str(FIRST_UID + int(record_id.split('.')[0][2:]))
+
+    def genome(self, uid):
+        """
+        DESCRIPTION:
+        Generates the genome of a uid
+        :param uid: [string] the uid
+        :return: [dictionary] accession, sequence, country, collection date and whether it's complete
+        """
+        parameters = self.parameters
+        index = int(uid) - FIRST_UID
+        rng = np.random.default_rng((parameters['seed'], index))
+        sequence = self.ancestor.copy()
+        sites, bases = self.lineages[index % len(self.lineages)]
+        sequence[sites] = bases
+        length = len(sequence)
+
+        snps = rng.choice(length, rng.poisson(parameters['snp_rate'] * length), replace=False)
+        sequence[snps] = rng.choice(BASES, len(snps))
+        ambiguous = rng.choice(length, rng.poisson(parameters['ambiguous_rate'] * length), replace=False)
+        sequence[ambiguous] = rng.choice(AMBIGUOUS, len(ambiguous))
+        for _ in range(rng.poisson(parameters['n_runs'])):
+            start = rng.integers(length)
+            sequence[start:start + rng.geometric(1 / parameters['n_run_length'])] = ord('N')
+        if rng.random() < parameters['deletion_rate']:
+            start = rng.integers(length - 30)
+            sequence = np.delete(sequence, np.arange(start, start + 3 * rng.integers(1, 10)))
+
+        complete = rng.random() >= parameters['partial_rate']
+        if not complete:
+            start = rng.integers(length // 2)
+            sequence = sequence[start:start + length // 4]
+        return {'accession': self.accession(uid).split('.')[0],
+                'sequence': sequence.tobytes().decode('ascii'),
+                'country': COUNTRIES[index % len(COUNTRIES)],
+                'collection_date': f'2020-{index % 12 + 1:02d}-{index % 28 + 1:02d}',
+                'complete': complete}
+
+    def genbank(self, uid):
+        """
+        DESCRIPTION:
+        Formats the genome of a uid as a GenBank record like the ones of NCBI's efetch
+        :param uid: [string] the uid
+        :return: [string] the record
+        """
+        genome = self.genome(uid)
+        sequence = genome['sequence'].lower()
+        length = len(sequence)
+        accession = genome['accession']
+        kind = 'complete genome' if genome['complete'] else 'partial genome'
+        origin = '\n'.join(f'{start + 1:>9} ' + ' '.join(sequence[k:k + 10] for k in range(start, min(start + 60, length), 10))
+                           for start in range(0, length, 60))
+        return (f'LOCUS       {accession:<16}{length:>12} bp    RNA     linear   VRL 01-JAN-2021\n'
+                f'DEFINITION  Severe acute respiratory syndrome coronavirus 2 isolate\n'
+                f'            SARS-CoV-2/human/{genome["country"]}/{uid}/2020, {kind}.\n'
+                f'ACCESSION   {accession}\n'
+                f'VERSION     {accession}.1\n'
+                f'FEATURES             Location/Qualifiers\n'
+                f'     source          1..{length}\n'
+                f'                     /organism="Severe acute respiratory syndrome coronavirus 2"\n'
+                f'                     /country="{genome["country"]}"\n'
+                f'                     /collection_date="{genome["collection_date"]}"\n'
+                f'ORIGIN      \n{origin}\n//\n\n')
+
+
+class _EntrezStubHandler(BaseHTTPRequestHandler):
+    """
+    DESCRIPTION:
+    Answers esearch (json, with retstart, retmax and idtype) and efetch (by id list, of uids or
+    accessions, or by retstart and retmax of the search) requests with the records of the server's corpus
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        corpus = self.server.corpus
+        retstart = int(query.get('retstart', 0))
+        retmax = int(query.get('retmax', len(corpus.uids)))
+        if url.path.endswith('esearch'):
+            uids = corpus.uids[retstart:retstart + retmax]
+            if query.get('idtype') == 'acc':
+                uids = [corpus.accession(uid) for uid in uids]
+            result = {'count': str(len(corpus.uids)), 'retstart': str(retstart), 'retmax': str(retmax),
+                      'idlist': uids, 'webenv': 'BENCHMARK', 'querykey': '1'}
+            body = json.dumps({'esearchresult': result})
+        elif url.path.endswith('efetch'):
+            uids = query['id'].split(',') if 'id' in query else corpus.uids[retstart:retstart + retmax]
+            body = ''.join(corpus.genbank(corpus.uid(uid)) for uid in uids)
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_entrez_stub(corpus):
+    """
+    DESCRIPTION:
+    Starts a local server that stands in for NCBI's E-utilities, on a thread of its own
+    :param corpus: [SyntheticCorpus] the records it serves
+    :return: [ThreadingHTTPServer, string] the server and its base url
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _EntrezStubHandler)
+    server.daemon_threads = True
+    server.corpus = corpus
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def _read_fasta(path):
+    records = []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('>'):
+                records.append([line, []])
+            elif records:
+                records[-1][1].append(line)
+    return [(header, ''.join(chunks)) for header, chunks in records]
+
+
+def _write_fasta(records, out_file):
+    for header, sequence in records:
+        out_file.write(header + '\n')
+        for start in range(0, len(sequence), 60):
+            out_file.write(sequence[start:start + 60] + '\n')
+
+
+def _fit(sequence, length):
+    return (sequence.lower() + '-' * length)[:length]
+
+
+def stub_mafft(arguments):
+    """
+    DESCRIPTION:
+    Stands in for MAFFT: instead of aligning it pads (or cuts) the sequences with gaps to the length of
+    the alignment. Understands the plain, --add and --addfragments --keeplength --mapout forms the
+    pipeline uses and writes the alignment to stdout, wrapped like MAFFT's
+    :param arguments: [list] MAFFT's arguments
+    """
+    def option(name):
+        return arguments[arguments.index(name) + 1] if name in arguments else None
+
+    existing = _read_fasta(arguments[-1])
+    if '--addfragments' in arguments:
+        fragments_file = option('--addfragments')
+        length = len(existing[0][1])
+        fragments = _read_fasta(fragments_file)
+        if '--mapout' in arguments:
+            with open(fragments_file + '.map', 'w') as file:
+                file.writelines(f'{header}\n# no insertions\n' for header, _ in fragments)
+        records = existing + [(header, _fit(sequence, length)) for header, sequence in fragments]
+    elif '--add' in arguments:
+        length = max(len(sequence) for _, sequence in existing)
+        records = existing + [(header, _fit(sequence, length)) for header, sequence in _read_fasta(option('--add'))]
+    else:
+        length = max(len(sequence) for _, sequence in existing)
+        records = [(header, _fit(sequence, length)) for header, sequence in existing]
+    _write_fasta(records, sys.stdout)
+
+
+def _balanced_newick(names, rng):
+    if len(names) == 1:
+        return f'{names[0]}:{rng.random() * 0.001:.6f}'
+    middle = len(names) // 2
+    return f'({_balanced_newick(names[:middle], rng)},{_balanced_newick(names[middle:], rng)}):{rng.random() * 0.001:.6f}'
+
+
+def stub_iqtree(arguments):
+    """
+    DESCRIPTION:
+    Stands in for IQ-TREE: writes a balanced tree of the sequences of the alignment with random branch
+    lengths, bootstrap trees for -bo and the consensus for -con, under the -pre prefix
+    :param arguments: [list] IQ-TREE's arguments
+    """
+    def option(name, default=None):
+        return arguments[arguments.index(name) + 1] if name in arguments else default
+
+    prefix = option('-pre')
+    rng = np.random.default_rng(int(option('-seed', 0)))
+    if '-con' in arguments:
+        with open(option('-t'), 'r') as in_file, open(prefix + '.contree', 'w') as out_file:
+            out_file.write(in_file.readline())
+        return
+
+    names = [header[1:].split()[0] for header, _ in _read_fasta(option('-s'))]
+    if '-bo' in arguments:
+        with open(prefix + '.boottrees', 'w') as file:
+            for _ in range(int(option('-bo'))):
+                file.write(_balanced_newick(list(rng.permutation(names)), rng) + ';\n')
+        return
+
+    with open(prefix + '.treefile', 'w') as file:
+        file.write(_balanced_newick(names, rng) + ';\n')
+    with open(prefix + '.log', 'w') as file:
+        file.write(f'BEST SCORE FOUND : {-1000 * len(names) - rng.random():.4f}\n')
+
+
+def write_stub_executables(bin_dir):
+    """
+    DESCRIPTION:
+    Writes mafft and iqtree executables that run stub_mafft and stub_iqtree
+    :param bin_dir: [pathlib] folder for the executables
+    :return: [pathlib, pathlib] the mafft and iqtree executables
+    """
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    executables = []
+    for name, function in [('mafft', 'stub_mafft'), ('iqtree', 'stub_iqtree')]:
+        path = bin_dir / name
+        with open(path, 'w') as file:
+            file.write(f'#!{sys.executable}\nimport sys\nsys.path.insert(0, {str(SRC_DIR)!r})\n'
+                       f'import benchmark\nbenchmark.{function}(sys.argv[1:])\n')
+        path.chmod(0o755)
+        executables.append(path)
+    return executables
+
+
+def _current_rss_peak_kb():
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_rss_peak():
+    # Linux resets the peak RSS of the process when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def run_stages(parameters, output_path):
+    """
+    DESCRIPTION:
+    Runs the pipeline on a synthetic corpus served by the E-utilities stub, with the stub MAFFT and
+    IQ-TREE, and writes the measures of every stage as json. Has to run in its own process, with
+    the benchmark folder as working directory
+    :param parameters: [dictionary] parameters of the corpus and the stages, see DEFAULT_PARAMETERS
+    :param output_path: [pathlib] json file for the measures
+    """
+    import align_tools as at
+    import config
+    from catalog import CatalogQuery
+    import iqtree
+    import ncbi
+    import profiling
+
+    config.ensure_dirs()
+    corpus = SyntheticCorpus(parameters)
+    server, base_url = start_entrez_stub(corpus)
+    config.MAFFT_DIR, config.IQTREE_DIR = [str(path) for path in write_stub_executables(Path('bin').resolve())]
+    config.NCBI_MAX_REQUESTS_PER_SECOND = 0
+    ncbi.ENTREZ_SEARCH_URL = f'{base_url}/esearch'
+    ncbi.ENTREZ_NUCL_DOWNLOAD_URL = f'{base_url}/efetch?db=nucleotide&id={{uids}}&retmode=text&rettype={{format}}'
+    ncbi.update_progress = lambda progress: None
+
+    stages = {}
+
+    def measure(name, function, records=0):
+        _reset_rss_peak()
+        with profiling.stage(f'benchmark.{name}', records=records):
+            result = function()
+        stages[name] = dict(profiling.report()['stages'][f'benchmark.{name}'], peak_rss_kb=_current_rss_peak_kb())
+        print(f'{name}: {stages[name]["wall"]:.3f} s, peak RSS {stages[name]["peak_rss_kb"]} kB')
+        return result
+
+    def align():
+        aligner = at.SequenceAligner.from_tag(tag='complete', data=data)
+        aligner.set_query(CatalogQuery(complete=True))
+        at.make_alignments([aligner], data['seqrecords'], make_copy=True)
+
+    n_genomes = len(corpus.uids)
+    data = measure('search', lambda: ncbi.get_all_covid_nucleotide_seqs(cache_dir=config.CACHE_DIR, stream=True))
+    measure('fetch', lambda: sum(1 for _ in data['seqrecords']), records=n_genomes)
+    measure('align', align, records=n_genomes)
+    records = measure('aligned_records_by_tag', lambda: at.aligned_records_by_tag('complete'))
+    measure('analyse_alignment', lambda: at.analyse_alignment(records), records=len(records))
+    del records
+    alignment = measure('aligned_matrix_by_tag', lambda: at.aligned_matrix_by_tag('complete'))
+    measure('analyse_alignment_matrix', lambda: at.analyse_alignment(alignment), records=len(alignment))
+    measure('site_counts_by_tag', lambda: at.site_counts_by_tag('complete'))
+    if len(alignment) <= parameters['snp_distance_limit']:
+        measure('snp_distances_by_tag', lambda: at.snp_distances_by_tag('complete'), records=len(alignment))
+    measure('align_selector', lambda: iqtree.align_selector('complete_aligned', 'complete.txt', parameters['select']),
+            records=len(alignment))
+    measure('tree_creator', lambda: iqtree.tree_creator('complete.txt', placement='parsimony'))
+    # a tenth more genomes are placed onto the tree
+    iqtree.align_selector('complete_aligned', 'complete.txt', parameters['select'] + parameters['select'] // 10)
+    measure('tree_update', lambda: iqtree.tree_creator('complete.txt', placement='parsimony'))
+    server.shutdown()
+
+    with open(output_path, 'w') as file:
+        file.write(json.dumps({'stages': stages, 'report': profiling.report()}))
+
+
+def _commit():
+    def git(*arguments):
+        return subprocess.run(['git'] + list(arguments), cwd=SRC_DIR, capture_output=True, text=True).stdout.strip()
+    return git('rev-parse', '--short', 'HEAD') or None, bool(git('status', '--porcelain', '--', '.'))
+
+
+def _results_path(results_path):
+    import config
+    return results_path or config.BASE_DIR / RESULTS_FNAME
+
+
+def run_benchmark(parameters=None, results_path=None, work_dir=None):
+    """
+    DESCRIPTION:
+    Runs the benchmark in a new folder and appends its results, with the commit of the code, to a
+    json lines file so that runs of different commits can be compared
+    :param parameters: [dictionary] parameters that change DEFAULT_PARAMETERS
+    :param results_path: [pathlib] json lines file of the results, defaults to RESULTS_FNAME in
+    config.BASE_DIR
+    :param work_dir: [pathlib] folder for the data of the run, a temporary folder by default
+    :return: [dictionary] the results of the run
+    """
+    parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+    results_path = _results_path(results_path)
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix='covid_phylo_benchmark_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    output_path = work_dir / 'stages.json'
+
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([str(SRC_DIR), os.environ.get('PYTHONPATH', '')]),
+                       COVID_PHYLO_BASE_DIR=str(work_dir / 'covid_phylo_data'))
+    command = [sys.executable, str(SRC_DIR / 'benchmark.py'), '--stages', json.dumps(parameters), str(output_path)]
+    subprocess.run(command, cwd=work_dir, env=environment, check=True)
+
+    with open(output_path, 'r') as file:
+        measures = json.load(file)
+    commit, dirty = _commit()
+    results = {'commit': commit, 'dirty': dirty, 'timestamp': time.time(), 'parameters': parameters,
+               'work_dir': str(work_dir), **measures}
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, 'a') as file:
+        file.write(json.dumps(results) + '\n')
+    return results
+
+
+def compare(results_path=None, parameters=None):
+    """
+    DESCRIPTION:
+    Prints the wall time of every stage in the runs of a results file with the same parameters,
+    one column per run
+    :param results_path: [pathlib] json lines file of the results, defaults to RESULTS_FNAME in
+    config.BASE_DIR
+    :param parameters: [dictionary] parameters that change DEFAULT_PARAMETERS, runs with other
+    parameters are left out
+    """
+    parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+    with open(_results_path(results_path), 'r') as file:
+        runs = [json.loads(line) for line in file]
+    runs = [run for run in runs if run['parameters'] == parameters]
+    if not runs:
+        print('no runs with these parameters')
+        return
+
+    names = list(dict.fromkeys(name for run in runs for name in run['stages']))
+    print(f'{"stage":<28}' + ''.join(f'{run["commit"] + ("+" if run["dirty"] else ""):>12}' for run in runs))
+    for name in names:
+        print(f'{name:<28}' + ''.join(f'{run["stages"][name]["wall"]:>12.3f}' if name in run['stages'] else f'{"-":>12}'
+                                      for run in runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline on a synthetic corpus')
+    parser.add_argument('--stages', nargs=2, metavar=('PARAMETERS', 'OUTPUT'), help=argparse.SUPPRESS)
+    parser.add_argument('--compare', action='store_true', help='compare the stored runs instead of running')
+    parser.add_argument('--results', type=Path, help='json lines file of the results')
+    parser.add_argument('--work-dir', type=Path, help='folder for the data of the run')
+    for name, default in DEFAULT_PARAMETERS.items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=type(default), default=default)
+    arguments = parser.parse_args()
+
+    if arguments.stages:
+        run_stages(json.loads(arguments.stages[0]), Path(arguments.stages[1]))
+        return
+
+    parameters = {name: getattr(arguments, name) for name in DEFAULT_PARAMETERS}
+    if arguments.compare:
+        compare(arguments.results, parameters)
+    else:
+        run_benchmark(parameters, arguments.results, arguments.work_dir)
+
+
+if __name__ == '__main__':
+    main()
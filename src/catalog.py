@@ -0,0 +1,240 @@
+import sqlite3
+from datetime import datetime
+
+CATALOG_FNAME = 'catalog.sqlite'
+
+# columns of the catalog, every one but uid has its own index
+COLUMNS = ('uid', 'id', 'accession', 'country', 'collection_date', 'length', 'n_count', 'complete')
+
+# formats of the GenBank collection_date qualifier and the precision they are stored with
+_DATE_FORMATS = [('%Y-%m-%d', '%Y-%m-%d'), ('%Y-%m', '%Y-%m'), ('%Y', '%Y'),
+                 ('%d-%b-%Y', '%Y-%m-%d'), ('%b-%Y', '%Y-%m')]
+
+
+def normalize_country(country):
+    """
+    DESCRIPTION:
+    Keeps the country of a GenBank country qualifier, e.g. 'Spain' from 'Spain: Madrid'
+    :param country: [string] the qualifier
+    :return: [string] the country or None
+    """
+    if not country:
+        return None
+    return country.split(':')[0].strip()
+
+
+def normalize_date(date):
+    """
+    DESCRIPTION:
+    Converts a GenBank collection_date qualifier to ISO format, keeping its precision, so that
+    dates compare as strings: '15-Mar-2020' -> '2020-03-15', 'Mar-2020' -> '2020-03'
+    :param date: [string] the qualifier
+    :return: [string] the date or None if it can't be read
+    """
+    if not date:
+        return None
+    for in_format, out_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(date.strip(), in_format).strftime(out_format)
+        except ValueError:
+            pass
+    return None
+
+
+def catalog_entry(uid, metadata, sequence):
+    """
+    DESCRIPTION:
+    Builds the catalog row of a record
+    :param uid: [string] uid of the record
+    :param metadata: [dictionary] metadata of the record, see record_store.record_metadata
+    :param sequence: [string] sequence of the record, only used for the number of N if
+    metadata has no n_count
+    :return: [dictionary] the row, with a value for every column in COLUMNS
+    """
+    n_count = metadata.get('n_count')
+    if n_count is None:
+        n_count = sequence.upper().count('N')
+    return {'uid': uid,
+            'id': metadata['id'],
+            'accession': metadata['id'].split('.')[0],
+            'country': normalize_country(metadata.get('country')),
+            'collection_date': normalize_date(metadata.get('collection_date')),
+            'length': metadata.get('length', len(sequence)),
+            'n_count': n_count,
+            'complete': 'complete genome' in (metadata.get('description') or '')}
+
+
+class CatalogQuery:
+    """
+    DESCRIPTION:
+    Selection of records by their catalog columns. Conditions left as None aren't checked.
+    Dates are compared as ISO strings, so a record dated only by month or year is before any
+    day of that month or year
+    """
+
+    def __init__(self, country=None, complete=None, date_from=None, date_to=None, min_length=None, max_n=None):
+        """
+        DESCRIPTION:
+        Constructor of the CatalogQuery class
+        :param country: [string or list] country or countries of the records, e.g. 'Spain'
+        :param complete: [boolean] whether the records have to be complete genomes or partial ones
+        :param date_from: [string] first collection date, 'YYYY-MM-DD'
+        :param date_to: [string] last collection date, 'YYYY-MM-DD'
+        :param min_length: [int] minimum length of the sequences
+        :param max_n: [int] maximum number of N in the sequences
+        :return: [CatalogQuery] the created object
+        """
+        self.countries = [country] if isinstance(country, str) else country
+        self.complete = complete
+        self.date_from = date_from
+        self.date_to = date_to
+        self.min_length = min_length
+        self.max_n = max_n
+
+    def signature(self):
+        """
+        DESCRIPTION:
+        Describes the query, so that changes to it can be detected
+        :return: [dictionary] the conditions of the query
+        """
+        return {'countries': self.countries, 'complete': self.complete, 'date_from': self.date_from,
+                'date_to': self.date_to, 'min_length': self.min_length, 'max_n': self.max_n}
+
+    def where(self):
+        """
+        DESCRIPTION:
+        Translates the query to SQL
+        :return: [string, list] the WHERE clause and its parameters
+        """
+        conditions = []
+        parameters = []
+        if self.countries is not None:
+            conditions.append(f'country IN ({",".join("?" * len(self.countries))})')
+            parameters += self.countries
+        if self.complete is not None:
+            conditions.append('complete = ?')
+            parameters.append(int(self.complete))
+        if self.date_from is not None:
+            conditions.append('collection_date >= ?')
+            parameters.append(self.date_from)
+        if self.date_to is not None:
+            conditions.append('collection_date <= ?')
+            parameters.append(self.date_to)
+        if self.min_length is not None:
+            conditions.append('length >= ?')
+            parameters.append(self.min_length)
+        if self.max_n is not None:
+            conditions.append('n_count <= ?')
+            parameters.append(self.max_n)
+        return ' AND '.join(conditions) or '1', parameters
+
+    def matches(self, entry):
+        """
+        DESCRIPTION:
+        Checks a catalog row against the query, for records that aren't in a catalog
+        :param entry: [dictionary] the row, see catalog_entry
+        :return: [boolean] true iff the record is selected
+        """
+        date = entry['collection_date']
+        return ((self.countries is None or entry['country'] in self.countries) and
+                (self.complete is None or entry['complete'] == self.complete) and
+                (self.date_from is None or (date is not None and date >= self.date_from)) and
+                (self.date_to is None or (date is not None and date <= self.date_to)) and
+                (self.min_length is None or entry['length'] >= self.min_length) and
+                (self.max_n is None or entry['n_count'] <= self.max_n))
+
+
+class Catalog:
+    """
+    DESCRIPTION:
+    SQLite table with the metadata of the stored records, indexed by every column, so that
+    the records of a selection are found without reading any sequence
+    """
+
+    def __init__(self, path):
+        """
+        DESCRIPTION:
+        Constructor of the Catalog class, creates the table if it doesn't exist
+        :param path: [pathlib] the database file
+        :return: [Catalog] the created object
+        """
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records (uid TEXT PRIMARY KEY, id TEXT, accession TEXT, '
+                                'country TEXT, collection_date TEXT, length INTEGER, n_count INTEGER, complete INTEGER)')
+        for column in COLUMNS[1:]:
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS records_{column} ON records ({column})')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def ids(self):
+        """
+        DESCRIPTION:
+        Returns the ids of the catalogued records
+        :return: [dictionary] the ids by uid
+        """
+        return dict(self.connection.execute('SELECT uid, id FROM records'))
+
+    def values(self, columns):
+        """
+        DESCRIPTION:
+        Returns some columns of every catalogued record
+        :param columns: [list] names of the columns, from COLUMNS
+        :return: [dictionary] tuples of the values by record id
+        """
+        unknown = [column for column in columns if column not in COLUMNS]
+        if unknown:
+            raise ValueError(f'unknown catalog columns {unknown}')
+        return {row[0]: row[1:] for row in self.connection.execute(f'SELECT id, {", ".join(columns)} FROM records')}
+
+    def add(self, entry):
+        """
+        DESCRIPTION:
+        Adds a record to the catalog, or replaces it. It's saved by the next flush
+        :param entry: [dictionary] the row, see catalog_entry
+        """
+        self.add_many([entry])
+
+    def add_many(self, entries):
+        """
+        DESCRIPTION:
+        Adds several records to the catalog. They are saved by the next flush
+        :param entries: [iterable] the rows, see catalog_entry
+        """
+        self.connection.executemany(f'INSERT OR REPLACE INTO records VALUES ({",".join("?" * len(COLUMNS))})',
+                                    ([entry[column] for column in COLUMNS] for entry in entries))
+
+    def select(self, query):
+        """
+        DESCRIPTION:
+        Finds the records of a query
+        :param query: [CatalogQuery] the query
+        :return: [dictionary] ids of the records selected by their uids
+        """
+        where, parameters = query.where()
+        return dict(self.connection.execute(f'SELECT uid, id FROM records WHERE {where}', parameters))
+
+    def flush(self):
+        """
+        DESCRIPTION:
+        Saves the added records
+        """
+        self.connection.commit()
+
+    def close(self):
+        """
+        DESCRIPTION:
+        Saves the added records and closes the database
+        """
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
@@ -1,23 +1,196 @@
 
+import json
+import os
+import sys
 from pathlib import Path
 
+# Settings of the pipeline. Every module reads them as attributes of this module when they are
+# used, so they can be changed at run time with configure, from the environment with
+# COVID_PHYLO_<NAME> variables (read on import) or from the command line with --set NAME=VALUE.
+# Importing this module doesn't touch the file system, the data folders are created by
+# ensure_dirs before the pipeline writes to them
+
+# prefix of the environment variables that override settings
+ENVIRONMENT_PREFIX = 'COVID_PHYLO_'
+
 PROJECT_DIR = Path('.').resolve().parent
 
 BASE_DIR = PROJECT_DIR / 'covid_phylo_data'
-BASE_DIR.mkdir(exist_ok=True)
-
 CACHE_DIR = BASE_DIR / 'cache'
-CACHE_DIR.mkdir(exist_ok=True)
-
 FASTA_DIR = BASE_DIR / 'fasta'
-FASTA_DIR.mkdir(exist_ok=True)
-
 MEDIA_DIR = BASE_DIR / 'media'
-MEDIA_DIR.mkdir(exist_ok=True)
-
 TREE_DIR = BASE_DIR / 'tree'
-TREE_DIR.mkdir(exist_ok=True)
 
 RAW_SEQUENCE_SHELVE_FNAME = 'raw_seqs.shelve'
+RAW_SEQUENCE_CACHE_WRITE_BATCH = 1000
+RECORD_STORE_DIRNAME = 'record_store'
 
 MAFFT_DIR = '/usr/bin/mafft'
+# total number of threads of the MAFFT jobs running at the same time
+MAFFT_CPU_BUDGET = os.cpu_count() or 1
+
+IQTREE_DIR = 'iqtree'
+# total number of threads of the IQ-TREE jobs running at the same time
+IQTREE_CPU_BUDGET = os.cpu_count() or 1
+# arguments of the tree searches, besides the alignment, seed, prefix and threads
+IQTREE_ARGUMENTS = ['-bnni']
+# number of independent tree searches per tree, each with its own seed, the best one is kept
+IQTREE_SEARCHES = 1
+IQTREE_SEED = 1
+# how align_selector picks the genomes of a tree: 'quality' the ones with fewest gaps, 'diverse' a diverse
+# set of the genomes with few gaps and ambiguous bases, by farthest point sampling on their variants
+TREE_SELECTION = 'diverse'
+# genomes with more gaps and ambiguous bases than this fraction of their sites aren't candidates of 'diverse'
+TREE_SELECTION_MAX_MISSING = 0.02
+# number of most variable sites the genomes are compared on by 'diverse'
+TREE_SELECTION_MAX_SITES = 4096
+# metadata 'diverse' shares the genomes by, in proportion: ('country',), ('month',), ('country', 'month') or ()
+TREE_SELECTION_STRATIFY = ()
+# drop the constant and all-gap columns of the selections, IQ-TREE gets their counts with -fconst
+TREE_COMPRESS_SITES = True
+# number of bootstrap replicates per tree, split in batches run as separate jobs, 0 for none
+IQTREE_BOOTSTRAP = 0
+IQTREE_BOOTSTRAP_BATCHES = 4
+# how a tree that changed little is updated instead of inferred again, 'none' always infers it with IQ-TREE.
+# 'iqtree' runs the searches constrained to the previous topology: a maximum likelihood tree that keeps the
+# relationships of the previous tips. 'parsimony' places the new genomes in-process onto the previous tree:
+# only the placed tips are new, attached by maximum parsimony with their number of substitutions per site as
+# branch length, the rest of the tree and its branch lengths aren't optimized again
+TREE_PLACEMENT = 'none'
+# a tree is inferred again when the tips placed and removed since its inference exceed this fraction of it
+TREE_PLACEMENT_MAX_DRIFT = 0.2
+# or after this many updates
+TREE_PLACEMENT_MAX_UPDATES = 10
+
+# trees are drawn with at most this many tips, the shallowest clades are collapsed into summary tips
+TREE_RENDER_MAX_TIPS = 1000
+# internal nodes with lower support are removed before drawing, 0 to keep them all
+TREE_RENDER_MIN_SUPPORT = 0
+# clades with all their tips within this distance are always collapsed, 0 for identical genomes only
+TREE_RENDER_COLLAPSE_HEIGHT = 0.0
+TREE_RENDER_FORMAT = 'png'
+# numbers of tips of additional renders of every tree, e.g. (100, 10000) for an overview and a detailed svg
+TREE_RENDER_ZOOM_LEVELS = ()
+
+# alignment mode of new tags, see SequenceAligner.modes
+ALIGNMENT_MODE = 'mafft'
+# reference sequence (Wuhan-Hu-1, MN908947.3) in the fasta folder for the 'reference' mode
+REFERENCE_FASTA_FNAME = 'reference.fasta'
+# number of sequences per MAFFT job in the 'reference' mode
+REFERENCE_CHUNK_SIZE = 200
+# align only one of the records with identical sequences
+DEDUPLICATE_SEQUENCES = True
+# write the alignments and trees of representatives again with their duplicates, as {tag}_expanded
+# and {selection}.expanded.treefile
+EXPAND_DUPLICATES = True
+
+# number of aligned ids from which they are indexed with a sorted array instead of a set
+ALIGNED_ID_SET_LIMIT = 5000000
+
+# number of alignment matrix cells processed at once by the analysis functions
+ANALYSIS_BLOCK_SIZE = 16000000
+# number of threads of the analysis functions
+ANALYSIS_THREADS = os.cpu_count() or 1
+# number of genomes per tile of the SNP distance matrix
+SNP_DISTANCE_BLOCK_ROWS = 512
+
+NCBI_BATCH_SIZE = 200
+# number of uids per esearch request, at most 10000
+NCBI_SEARCH_PAGE_SIZE = 10000
+# date field of the searches of new sequences: PDAT (publication) or MDAT (modification)
+NCBI_DATE_FIELD = 'PDAT'
+# whether main only searches the sequences published since its last run
+NCBI_SEARCH_SINCE_LAST_RUN = True
+NCBI_MAX_CONCURRENT = 3
+NCBI_MAX_REQUESTS_PER_SECOND = 3
+# retries of a failed request, the first one after NCBI_RETRY_BACKOFF seconds and each next one after twice as long
+NCBI_MAX_RETRIES = 5
+NCBI_RETRY_BACKOFF = 1.0
+
+# functions decorated with profiling.hot that run under cProfile and tracemalloc,
+# e.g. ('analyse_alignment', 'get_filtered_records')
+PROFILE_HOT_FUNCTIONS = ()
+# number of functions of every cProfile run kept in the report
+PROFILE_TOP_FUNCTIONS = 20
+
+
+# folders of the data, moved with BASE_DIR unless they are set too
+_DATA_DIRS = {'CACHE_DIR': 'cache', 'FASTA_DIR': 'fasta', 'MEDIA_DIR': 'media', 'TREE_DIR': 'tree'}
+
+
+def _parse(name, value):
+    """
+    DESCRIPTION:
+    Converts the text of a setting, from the environment or the command line, to the type of its default
+    :param name: [string] name of the setting
+    :param value: [string] the text
+    :return: the value
+    """
+    default = globals()[name]
+    if isinstance(default, Path):
+        return Path(value).resolve()
+    if isinstance(default, bool):
+        if value.lower() not in ('1', 'true', 'yes', '0', 'false', 'no'):
+            raise ValueError(f'{name} has to be true or false, not {value}')
+        return value.lower() in ('1', 'true', 'yes')
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    if isinstance(default, (list, tuple)):
+        return type(default)(json.loads(value))
+    return value
+
+
+def configure(**settings):
+    """
+    DESCRIPTION:
+    Changes settings, e.g. configure(BASE_DIR=Path('/data'), MAFFT_CPU_BUDGET=8). Changing BASE_DIR
+    moves the data folders that aren't changed too
+    :param settings: the settings by name
+    """
+    module = sys.modules[__name__]
+    for name in settings:
+        if not name.isupper() or not hasattr(module, name):
+            raise ValueError(f'unknown setting {name}')
+    if 'BASE_DIR' in settings:
+        for name, dirname in _DATA_DIRS.items():
+            settings.setdefault(name, Path(settings['BASE_DIR']) / dirname)
+    for name, value in settings.items():
+        setattr(module, name, value)
+
+
+def configure_from_strings(assignments):
+    """
+    DESCRIPTION:
+    Changes settings given as text, e.g. the --set options of the command line
+    :param assignments: [list] strings 'NAME=VALUE'
+    """
+    settings = {}
+    for assignment in assignments:
+        name, separator, value = assignment.partition('=')
+        if not separator or name not in globals():
+            raise ValueError(f'settings are given as NAME=VALUE, with a known NAME: {assignment}')
+        settings[name] = _parse(name, value)
+    configure(**settings)
+
+
+def configure_from_environment(environment=None):
+    """
+    DESCRIPTION:
+    Changes the settings that have a COVID_PHYLO_<NAME> environment variable
+    :param environment: [dictionary] the environment, defaults to os.environ
+    """
+    environment = os.environ if environment is None else environment
+    configure(**{name: _parse(name, environment[ENVIRONMENT_PREFIX + name]) for name in list(globals())
+                 if name.isupper() and ENVIRONMENT_PREFIX + name in environment})
+
+
+def ensure_dirs():
+    """
+    DESCRIPTION:
+    Creates the data folders that don't exist
+    """
+    for path in [BASE_DIR, CACHE_DIR, FASTA_DIR, MEDIA_DIR, TREE_DIR]:
+        path.mkdir(parents=True, exist_ok=True)
+
+
+configure_from_environment()
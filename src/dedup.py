@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+
+
+def sequence_hash(sequence):
+    """
+    DESCRIPTION:
+    Hash of a sequence ignoring case, gaps and white space, so that records with the same
+    sequence get the same hash
+    :param sequence: [string] the sequence
+    :return: [string] the hash
+    """
+    normalized = ''.join(sequence.split()).upper().replace('-', '')
+    return hashlib.blake2b(normalized.encode('ascii'), digest_size=16).hexdigest()
+
+
+class DuplicateTable:
+    """
+    DESCRIPTION:
+    Groups records with identical sequences. The first record of every group is its
+    representative, the only one that is aligned, the rest are its members
+    """
+
+    def __init__(self, path=None):
+        """
+        DESCRIPTION:
+        Constructor of the DuplicateTable class, loads the table if the file exists
+        :param path: [pathlib] json file of the table, None for a table kept in memory only
+        :return: [DuplicateTable] the created object
+        """
+        self.path = path
+        self.representatives = {}
+        self.members = {}
+        if path is not None:
+            try:
+                with open(path, 'r') as file:
+                    json_table = json.load(file)
+                    self.representatives = json_table['representatives']
+                    self.members = json_table['members']
+            except FileNotFoundError:
+                pass
+        self._member_ids = {member for members in self.members.values() for member in members}
+
+    def __contains__(self, sequence_id):
+        """
+        DESCRIPTION:
+        Checks whether a record is known to be the duplicate of a representative
+        """
+        return sequence_id in self._member_ids
+
+    def add(self, sequence_id, key):
+        """
+        DESCRIPTION:
+        Adds a record to the table
+        :param sequence_id: [string] id of the record
+        :param key: [string] sequence_hash of the sequence of the record
+        :return: [boolean] true iff the record is the representative of its sequence
+        """
+        representative = self.representatives.setdefault(key, sequence_id)
+        if representative == sequence_id:
+            return True
+
+        if sequence_id not in self._member_ids:
+            self.members.setdefault(representative, []).append(sequence_id)
+            self._member_ids.add(sequence_id)
+        return False
+
+    def group(self, representative):
+        """
+        DESCRIPTION:
+        Returns the ids of all the records with the sequence of a representative
+        :param representative: [string] id of the representative
+        :return: [list] the representative followed by its members
+        """
+        return [representative] + self.members.get(representative, [])
+
+    def subset(self, representatives, path=None):
+        """
+        DESCRIPTION:
+        Returns the groups of some representatives, e.g. of the records selected for a tree
+        :param representatives: [iterable] ids of the representatives
+        :param path: [pathlib] json file of the new table, None for a table kept in memory only
+        :return: [DuplicateTable] the table with only the members of those representatives
+        """
+        table = DuplicateTable()
+        table.path = path
+        table.members = {representative: list(self.members[representative])
+                         for representative in representatives if representative in self.members}
+        table._member_ids = {member for members in table.members.values() for member in members}
+        return table
+
+    def save(self):
+        """
+        DESCRIPTION:
+        Writes the table to its file
+        """
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as file:
+            file.write(json.dumps({'representatives': self.representatives, 'members': self.members}))
+        os.replace(tmp_path, self.path)
+
+
+def expand_alignment(fasta_path, table, destname):
+    """
+    DESCRIPTION:
+    Writes an alignment of representatives with a copy of every row for each of its members. The
+    alignment is written under a temporary name and renamed to destname when it's complete
+    :param fasta_path: [pathlib] the aligned fasta file of the representatives
+    :param table: [DuplicateTable] the duplicates
+    :param destname: [pathlib] file for the expanded alignment
+    """
+    header = None
+    lines = []
+
+    def write_group(out_file):
+        representative = header[1:].split(maxsplit=1)[0] if header[1:].strip() else ''
+        out_file.write(header)
+        out_file.writelines(lines)
+        for member in table.members.get(representative, []):
+            out_file.write(f'>{member}\n')
+            out_file.writelines(lines)
+
+    tmp_name = destname.with_name(destname.name + '.tmp')
+    with open(fasta_path, 'r') as in_file, open(tmp_name, 'w') as out_file:
+        for line in in_file:
+            if line.startswith('>'):
+                if header is not None:
+                    write_group(out_file)
+                header = line if line.endswith('\n') else line + '\n'
+                lines = []
+            elif header is not None:
+                lines.append(line if line.endswith('\n') else line + '\n')
+        if header is not None:
+            write_group(out_file)
+    os.replace(tmp_name, destname)
+
+
+_NEWICK_TIP = re.compile(r'(?<=[(,])([^(),:;]+)(?=[:,);])')
+
+
+def expand_tree(newick, table, tip_name=None):
+    """
+    DESCRIPTION:
+    Replaces every tip of a representative by a zero length clade with the representative
+    and its members
+    :param newick: [string] the tree in newick format, with the representatives as tips
+    :param table: [DuplicateTable] the duplicates
+    :param tip_name: [function] name of a record in the tree, for programs that change the ids
+    :return: [string] the expanded tree in newick format
+    """
+    tip_name = tip_name or (lambda sequence_id: sequence_id)
+    members_by_tip = {tip_name(representative): [tip_name(member) for member in members]
+                      for representative, members in table.members.items()}
+
+    def expand(match):
+        tip = match.group(1)
+        members = members_by_tip.get(tip.strip())
+        if not members:
+            return tip
+        return '(' + ','.join(f'{name}:0' for name in [tip] + members) + ')'
+
+    return _NEWICK_TIP.sub(expand, newick)
@@ -1,24 +1,139 @@
+import math
 import os
-from config import MEDIA_DIR
-from ete3 import Tree, TreeStyle
+import shutil
+import config
+from manifest import file_checksum, hash_values
+import profiling
 
+# folder of the media folder with the renders, named after the tree and the render parameters
+RENDER_CACHE_DIRNAME = 'render_cache'
 
-def tree_viewer(treefolder):
+
+def _set_heights(tree):
+    """
+    DESCRIPTION:
+    Stores in every node the distance to its farthest leaf
+    """
+    for node in tree.traverse('postorder'):
+        node.add_feature('height', max((child.height + child.dist for child in node.children), default=0.0))
+
+
+def _collapse_cutoff(tree, collapse_height, max_tips):
+    """
+    DESCRIPTION:
+    Finds the lowest height from which clades are collapsed so that the tree has at most max_tips tips.
+    Collapsing every clade of height up to a cutoff leaves one tip per node whose height is within the
+    cutoff and whose parent's height isn't, so the number of tips only decreases with the cutoff
+    :return: [float] the cutoff
+    """
+    intervals = [(node.height, node.up.height if node.up else math.inf) for node in tree.traverse()]
+
+    def n_tips(cutoff):
+        return sum(1 for height, parent_height in intervals if height <= cutoff < parent_height)
+
+    heights = sorted({height for height, _ in intervals if height >= collapse_height})
+    if not heights or n_tips(collapse_height) <= max_tips:
+        return collapse_height
+    # binary search of the first height that leaves at most max_tips tips, or the last one
+    low, high = 0, len(heights) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if n_tips(heights[middle]) <= max_tips:
+            high = middle
+        else:
+            low = middle + 1
+    return heights[low]
+
+
+@profiling.hot
+def summarize_tree(tree, max_tips, min_support=0, collapse_height=0.0):
+    """
+    DESCRIPTION:
+    Reduces a tree to a size that can be drawn. The internal nodes with support under min_support are
+    removed (their children are joined to the parent), then the clades with all their tips within
+    collapse_height of their root, and as many of the next shallowest clades as needed to keep
+    max_tips tips, are replaced by a single summary tip named after their first tip and labeled
+    with their number of tips
+    :param tree: [Tree] the tree, modified in place
+    :param max_tips: [int] maximum number of tips of the summarized tree
+    :param min_support: [float] support under which internal nodes are removed
+    :param collapse_height: [float] height under which clades are always collapsed
+    :return: [int] number of collapsed clades
+    """
+    from ete3 import TextFace
+
+    if min_support:
+        for node in [node for node in tree.traverse() if not node.is_leaf() and not node.is_root()]:
+            if node.support < min_support:
+                node.delete(prevent_nondicotomic=False)
+
+    _set_heights(tree)
+    cutoff = _collapse_cutoff(tree, collapse_height, max_tips)
+    collapsed = [node for node in tree.traverse('preorder')
+                 if not node.is_leaf() and node.height <= cutoff and (node.up is None or node.up.height > cutoff)]
+    for node in collapsed:
+        leaf_names = node.get_leaf_names()
+        for child in list(node.children):
+            child.detach()
+        node.name = f'{leaf_names[0]} +{len(leaf_names) - 1}'
+        node.dist += node.height
+        node.img_style['shape'] = 'square'
+        node.img_style['size'] = min(40, 4 + int(4 * math.log2(len(leaf_names))))
+        node.add_face(TextFace(f' ({len(leaf_names)} tips)'), column=1, position='branch-right')
+    return len(collapsed)
+
+
+def tree_viewer(treefolder, max_tips=None, min_support=None, collapse_height=None, image_format=None,
+                zoom_levels=None):
     """
     DESCRIPTION:
     A function to create the representation of the tree with ete. Given the folder with the files in the tree folder it
-    creates the tree representation in the media folder.
+    creates the tree representation in the media folder. Large trees are summarized first, see summarize_tree.
+    Renders are kept in the render cache of the media folder by checksum of the tree file and render parameters,
+    so an unchanged tree is never rendered again.
     :param treefolder: [pathlib] route to the subfolder in the tree folder which contains the data of the inference.
+    :param max_tips: [int] maximum number of tips drawn, defaults to config.TREE_RENDER_MAX_TIPS
+    :param min_support: [float] support under which internal nodes are removed, defaults to config.TREE_RENDER_MIN_SUPPORT
+    :param collapse_height: [float] height under which clades are collapsed, defaults to config.TREE_RENDER_COLLAPSE_HEIGHT
+    :param image_format: [string] 'png', 'svg' or 'pdf', defaults to config.TREE_RENDER_FORMAT
+    :param zoom_levels: [list] numbers of tips of additional renders named {name}_{tips}tips, defaults to
+    config.TREE_RENDER_ZOOM_LEVELS
     :return: None. It writes the image in the media folder.
     """
-    filename = os.path.basename(os.path.normpath(treefolder)) + '.txt.treefile'
-    imagefile = os.path.basename(os.path.normpath(treefolder)) + '.png'
+    max_tips = max_tips or config.TREE_RENDER_MAX_TIPS
+    min_support = config.TREE_RENDER_MIN_SUPPORT if min_support is None else min_support
+    collapse_height = config.TREE_RENDER_COLLAPSE_HEIGHT if collapse_height is None else collapse_height
+    image_format = image_format or config.TREE_RENDER_FORMAT
+    zoom_levels = config.TREE_RENDER_ZOOM_LEVELS if zoom_levels is None else zoom_levels
+    # ete3 takes long to import, with PyQt, and is only needed here
+    from ete3 import Tree, TreeStyle
+
+    name = os.path.basename(os.path.normpath(treefolder))
+    filename = name + '.txt.treefile'
     treeroute = treefolder / filename
-    file = open(treeroute, 'r')
-    tree = file.read()
-    file.close()
-    tree = Tree(tree)
-    circular_style = TreeStyle()
-    circular_style.mode = "c"
-    circular_style.scale = 20
-    tree.render(str(MEDIA_DIR / imagefile), w=1024, units='mm', tree_style=circular_style)
+    cache_dir = config.MEDIA_DIR / RENDER_CACHE_DIRNAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    checksum = file_checksum(treeroute)
+
+    renders = [(f'{name}.{image_format}', max_tips)] + \
+        [(f'{name}_{tips}tips.{image_format}', tips) for tips in zoom_levels]
+    newick = None
+    for imagefile, tips in renders:
+        cached = cache_dir / f'{hash_values(checksum, tips, min_support, collapse_height, "c", 20, 1024)}.{image_format}'
+        if cached.exists():
+            print(f'{imagefile}: tree unchanged, rendering skipped')
+        else:
+            if newick is None:
+                with open(treeroute, 'r') as file:
+                    newick = file.read()
+            tree = Tree(newick)
+            n_collapsed = summarize_tree(tree, tips, min_support=min_support, collapse_height=collapse_height)
+            print(f'{imagefile}: rendering {len(tree)} tips, {n_collapsed} clades collapsed')
+            circular_style = TreeStyle()
+            circular_style.mode = "c"
+            circular_style.scale = 20
+            tmp_name = cached.with_name('tmp_' + cached.name)
+            with profiling.stage('ete.render', records=len(tree)):
+                tree.render(str(tmp_name), w=1024, units='mm', tree_style=circular_style)
+            os.replace(tmp_name, cached)
+        shutil.copyfile(cached, config.MEDIA_DIR / imagefile)
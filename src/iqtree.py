@@ -1,49 +1,946 @@
 
+import hashlib
+import heapq
+import json
 import os
+import re
+import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
 
-from config import MEDIA_DIR, TREE_DIR, FASTA_DIR
+import align_tools as at
+import config
+import mafft
+import profiling
+from catalog import CATALOG_FNAME, Catalog
+from dedup import DuplicateTable, expand_tree
+from manifest import Manifest, file_checksum, hash_values
 
+# number of alignment rows align_selector processes at once
+SELECTOR_ROWS_PER_BLOCK = 1000
+# column map and constant site counts of a compressed selection, next to it
+SITES_FNAME_PATTERN = '{selectname}.sites.json'
+# strategies of align_selector: 'quality' takes the best genomes by the ranking key, 'diverse' a
+# diverse set of good genomes, see _select_diverse
+SELECTION_STRATEGIES = ('quality', 'diverse')
+# metadata the 'diverse' selection can be stratified by
+STRATA = ('country', 'month')
+# tips placed and removed since the last inference of a tree, next to its selection
+PLACEMENT_FNAME_PATTERN = '{selectname}.placement.json'
+# duplicates of the selected records, next to the selection, and the trees they are added to
+DUPLICATES_FNAME_PATTERN = '{selectname}.duplicates.json'
+EXPANDED_TREE_SUFFIXES = {'.treefile': '.expanded.treefile', '.contree': '.expanded.contree'}
+TREE_PLACEMENT_METHODS = ('parsimony', 'iqtree')
 
-def tree_creator(selectname):
+
+def run_iqtree(arguments, prefix, threads=1):
+    """
+    DESCRIPTION:
+    Runs IQ-TREE writing all its files under a prefix. Its output is written to prefix.out
+    :param arguments: [list] IQ-TREE arguments, without the executable, -pre and -nt
+    :param prefix: [pathlib] prefix of the output files
+    :param threads: [int] number of threads IQ-TREE may use
+    :return: [dictionary] prefix, exit code, threads, seconds and log file of the run
+    """
+    log_name = prefix.with_name(prefix.name + '.out')
+    command = [config.IQTREE_DIR] + [str(argument) for argument in arguments] + \
+        ['-pre', str(prefix), '-nt', str(threads), '-redo']
+    start = time.perf_counter()
+    with open(log_name, 'w') as log_file, profiling.stage('iqtree'):
+        process = subprocess.run(command, stdout=log_file, stderr=subprocess.STDOUT)
+    return {'prefix': str(prefix), 'returncode': process.returncode, 'threads': threads,
+            'seconds': round(time.perf_counter() - start, 3), 'log': str(log_name)}
+
+
+def _best_score(prefix):
+    """
+    DESCRIPTION:
+    Reads the log-likelihood of the tree found by a search from its log
+    :return: [float] the log-likelihood or None if it isn't in the log
+    """
+    try:
+        with open(prefix.with_name(prefix.name + '.log'), 'r') as file:
+            scores = [float(line.split(':')[1]) for line in file if line.startswith('BEST SCORE FOUND')]
+    except (FileNotFoundError, ValueError, IndexError):
+        return None
+    return scores[-1] if scores else None
+
+
+def _site_arguments(alignment_file):
+    """
+    DESCRIPTION:
+    IQ-TREE arguments that add back the constant sites removed from a compressed selection
+    :return: [list] the arguments, empty if the selection isn't compressed
+    """
+    try:
+        with open(alignment_file.with_name(SITES_FNAME_PATTERN.format(selectname=alignment_file.name)), 'r') as file:
+            constant = json.load(file)['constant']
+    except FileNotFoundError:
+        return []
+    return ['-fconst', ','.join(str(constant[base]) for base in 'ACGT')]
+
+
+def _tree_jobs(alignment_file, searches, bootstrap, bootstrap_batches, constraint=None):
+    """
+    DESCRIPTION:
+    Splits the inference of a tree into independent IQ-TREE runs: one tree search per seed and
+    one run per batch of bootstrap replicates. With a constraint tree the searches keep its topology
+    :return: [list, list] (prefix, arguments) of the searches and of the bootstrap batches
+    """
+    seeds = [config.IQTREE_SEED + k for k in range(searches)]
+    sites = _site_arguments(alignment_file) + ([] if constraint is None else ['-g', constraint])
+    if searches == 1:
+        # a single search writes its files where IQ-TREE writes them by default
+        search_jobs = [(alignment_file, ['-s', alignment_file, '-seed', seeds[0]] + sites + config.IQTREE_ARGUMENTS)]
+    else:
+        search_jobs = [(alignment_file.with_name(f'{alignment_file.name}.seed{seed}'),
+                        ['-s', alignment_file, '-seed', seed] + sites + config.IQTREE_ARGUMENTS) for seed in seeds]
+
+    bootstrap_jobs = []
+    bootstrap_batches = max(1, min(bootstrap_batches, bootstrap))
+    for batch in range(bootstrap_batches if bootstrap else 0):
+        replicates = bootstrap // bootstrap_batches + (batch < bootstrap % bootstrap_batches)
+        # the same arguments as the searches, so that the replicates use the same model as the tree
+        bootstrap_jobs.append((alignment_file.with_name(f'{alignment_file.name}.boot{batch}'),
+                               ['-s', alignment_file, '-bo', replicates, '-seed', config.IQTREE_SEED + searches + batch]
+                               + sites + config.IQTREE_ARGUMENTS))
+    return search_jobs, bootstrap_jobs
+
+
+def _gather_trees(alignment_file, search_runs, bootstrap_runs):
+    """
+    DESCRIPTION:
+    Collects the results of the runs of a tree: the tree of the best search is copied to
+    alignment_file.treefile and the bootstrap trees of all the batches are summarized in
+    alignment_file.contree. The summary is made under a prefix of its own, alignment_file.consensus,
+    so that it doesn't overwrite the log of the search
+    :return: [list] the files written
+    """
+    outputs = []
+    treefile = alignment_file.with_name(alignment_file.name + '.treefile')
+    scored = [(_best_score(Path(run['prefix'])), run) for run in search_runs if run['returncode'] == 0]
+    scored = [(score, run) for score, run in scored if score is not None]
+    if scored:
+        score, best = max(scored, key=lambda scored_run: scored_run[0])
+        best_treefile = Path(best['prefix'] + '.treefile')
+        if best_treefile != treefile:
+            shutil.copyfile(best_treefile, treefile)
+        print(f'{alignment_file.name}: best tree {best_treefile.name} with log-likelihood {score}')
+        outputs.append(treefile)
+
+    if bootstrap_runs and all(run['returncode'] == 0 for run in bootstrap_runs):
+        boottrees = alignment_file.with_name(alignment_file.name + '.boottrees')
+        with open(boottrees, 'w') as out_file:
+            for run in bootstrap_runs:
+                with open(run['prefix'] + '.boottrees', 'r') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+        consensus_prefix = alignment_file.with_name(alignment_file.name + '.consensus')
+        consensus = run_iqtree(['-con', '-t', boottrees], consensus_prefix)
+        bootstrap_runs.append(consensus)
+        if consensus['returncode'] == 0:
+            contree = alignment_file.with_name(alignment_file.name + '.contree')
+            os.replace(consensus_prefix.with_name(consensus_prefix.name + '.contree'), contree)
+            outputs.append(contree)
+    return outputs
+
+
+def _tip_name(record_id):
+    # IQ-TREE replaces these characters of the sequence names in its trees
+    return re.sub(r'[^A-Za-z0-9_\-.|/]', '_', record_id)
+
+
+def _load_placement_state(alignment_file):
+    try:
+        with open(alignment_file.with_name(PLACEMENT_FNAME_PATTERN.format(selectname=alignment_file.name)), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def _save_placement_state(alignment_file, state):
+    with open(alignment_file.with_name(PLACEMENT_FNAME_PATTERN.format(selectname=alignment_file.name)), 'w') as file:
+        file.write(json.dumps(state))
+
+
+def _plan_update(alignment_file, placement, max_drift, max_updates):
+    """
+    DESCRIPTION:
+    Decides whether the tree of a selection can be updated instead of inferred again: there has to be
+    a tree from a previous run, and the tips placed onto it and removed from it since it was inferred
+    can't be more than max_drift of its tips, nor the updates more than max_updates
+    :return: [dictionary] the previous tree ('tree'), the records of the selection ('records', (tip name,
+    sequence) tuples), the names of the new tips ('new') and of the tips no longer selected
+    ('removed'), and the state of the updates ('state'). None for a full inference
+    """
+    treefile = alignment_file.with_name(alignment_file.name + '.treefile')
+    state = _load_placement_state(alignment_file)
+    if placement is None or state is None or not treefile.exists():
+        return None
+
+    from ete3 import Tree
+    tree = Tree(str(treefile), format=1)
+    tips = set(tree.get_leaf_names())
+    records = [(_tip_name(_record_id(header)), sequence) for header, sequence in at.iter_fasta_records(alignment_file)]
+    names = {name for name, _ in records}
+    new = [name for name, _ in records if name not in tips]
+    removed = tips - names
+    drift = (state['placed'] + state['removed'] + len(new) + len(removed)) / max(state['full_tips'], 1)
+    if drift > max_drift or state['updates'] >= max_updates or len(tips) - len(removed) < 3:
+        print(f'{alignment_file.name}: {drift:.0%} of the tips changed in {state["updates"] + 1} updates, '
+              f'the tree is inferred again')
+        return None
+
+    print(f'{alignment_file.name}: {len(new)} new and {len(removed)} removed tips, the tree is updated')
+    return {'tree': tree, 'records': records, 'new': new, 'removed': removed, 'state': state}
+
+
+def _write_constraint(alignment_file, update):
+    """
+    DESCRIPTION:
+    Writes the previous tree without the tips no longer selected, as the constraint of the searches
+    :return: [pathlib] the file
+    """
+    tree = update['tree']
+    if update['removed']:
+        tree.prune([name for name in tree.get_leaf_names() if name not in update['removed']],
+                   preserve_branch_length=True)
+    constraint = alignment_file.with_name(alignment_file.name + '.constraint')
+    tree.write(format=9, outfile=str(constraint))
+    return constraint
+
+
+# sets of bases of the IUPAC codes as bits of A, C, G and T, gaps and unknown bases are any base
+_STATE_SETS = np.full(256, 15, dtype=np.uint8)
+for _symbols, _bases in {'A': 1, 'C': 2, 'G': 4, 'TU': 8, 'M': 3, 'R': 5, 'W': 9, 'S': 6, 'Y': 10, 'K': 12,
+                         'V': 7, 'H': 11, 'D': 13, 'B': 14}.items():
+    for _symbol in _symbols:
+        _STATE_SETS[[ord(_symbol), ord(_symbol.lower())]] = _bases
+_SET_SIZES = np.array([bin(bases).count('1') for bases in range(16)], dtype=np.int32)
+
+
+def _fitch_states(tree, states):
+    """
+    DESCRIPTION:
+    Most parsimonious sets of bases of every node of a tree, with Fitch's algorithm: sets of the
+    subtrees from the tips up, then the sets of the root's assignment down to the tips
+    :param tree: [Tree] the tree
+    :param states: [dictionary] sets of bases (_STATE_SETS) of the sequence of every tip
+    :return: [list, np.ndarray] the nodes in preorder and their sets, one row per node
+    """
+    subtree = {}
+    for node in tree.traverse('postorder'):
+        if node.is_leaf():
+            subtree[node] = states[node.name]
+            continue
+        current = subtree[node.children[0]]
+        for child in node.children[1:]:
+            common = current & subtree[child]
+            current = np.where(common == 0, current | subtree[child], common)
+        subtree[node] = current
+
+    nodes = list(tree.traverse('preorder'))
+    assigned = {tree: subtree[tree]}
+    for node in nodes:
+        for child in node.children:
+            common = subtree[child] & assigned[node]
+            assigned[child] = np.where(common == 0, subtree[child], common)
+    return nodes, np.stack([assigned[node] for node in nodes])
+
+
+def _insert_tip(node, name, dist):
+    """
+    DESCRIPTION:
+    Attaches a new tip to the branch above a node, halving the branch, or to the root
+    """
+    parent = node.up
+    if parent is None:
+        inner = node.add_child(dist=0.0)
+        for child in list(node.children[:-1]):
+            inner.add_child(child.detach())
+        node.add_child(name=name, dist=dist)
+        return
+
+    node.detach()
+    node.dist /= 2
+    inner = parent.add_child(dist=node.dist)
+    inner.add_child(node)
+    inner.add_child(name=name, dist=dist)
+
+
+@profiling.hot
+def place_sequences(tree, records, new, removed=(), n_sites=None):
+    """
+    DESCRIPTION:
+    Updates a tree in place with maximum parsimony placement: the tips no longer selected are pruned
+    and every new sequence is attached to the branch where it adds the fewest substitutions, given
+    the most parsimonious states of the tree: the sites where its base is in neither the states of
+    the node under the branch nor the states of the node above count as substitutions. The new
+    sequences are placed independently of each other, on the tree as it was. Ties go to the node
+    with the fewest differences of its own, e.g. a tip with the same sequence, and then to the most
+    specific one. The branch of a new tip is its number of
+    substitutions per site
+    :param tree: [Tree] the tree, its tips named as the records
+    :param records: [list] (name, sequence) tuples of the aligned sequences of the tips and the new sequences
+    :param new: [list] names of the new sequences
+    :param removed: [iterable] names of the tips to prune
+    :param n_sites: [int] number of sites of the alignment the branch lengths are measured in, defaults
+    to the length of the sequences
+    :return: [list] (name, node the tip was attached to, substitutions) of every new sequence
+    """
+    removed = set(removed)
+    if removed:
+        tree.prune([name for name in tree.get_leaf_names() if name not in removed], preserve_branch_length=True)
+    states = {name: _STATE_SETS[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)] for name, sequence in records}
+    n_sites = n_sites or len(records[0][1])
+
+    nodes, assigned = _fitch_states(tree, {name: states[name] for name in tree.get_leaf_names()})
+    specificity = _SET_SIZES[assigned].sum(axis=1)
+    index = {node: i for i, node in enumerate(nodes)}
+    parents = np.array([index[node.up] if node.up is not None else i for i, node in enumerate(nodes)])
+    # states anywhere on the branch above every node
+    branches = assigned | assigned[parents]
+    placements = []
+    for name in new:
+        substitutions = ((branches & states[name]) == 0).sum(axis=1)
+        candidates = np.flatnonzero(substitutions == substitutions.min())
+        differences = ((assigned[candidates] & states[name]) == 0).sum(axis=1)
+        best = candidates[np.lexsort((specificity[candidates], differences))[0]]
+        placements.append((name, nodes[best], int(substitutions[best])))
+
+    for name, node, n_substitutions in placements:
+        _insert_tip(node, name, n_substitutions / n_sites)
+    return placements
+
+
+def _place_on_tree(alignment_file, update):
+    """
+    DESCRIPTION:
+    Updates the tree of a selection with place_sequences and writes it over the previous one
+    :return: [list] the files written
+    """
+    try:
+        with open(alignment_file.with_name(SITES_FNAME_PATTERN.format(selectname=alignment_file.name)), 'r') as file:
+            n_sites = json.load(file)['n_columns']
+    except FileNotFoundError:
+        n_sites = None
+    tree = update['tree']
+    place_sequences(tree, update['records'], update['new'], update['removed'], n_sites=n_sites)
+    treefile = alignment_file.with_name(alignment_file.name + '.treefile')
+    tmp_name = treefile.with_name('tmp_' + treefile.name)
+    tree.write(format=1, outfile=str(tmp_name))
+    os.replace(tmp_name, treefile)
+    return [treefile]
+
+
+def _record_update(alignment_file, update, n_tips):
+    """
+    DESCRIPTION:
+    Saves the number of tips placed and removed since the last inference of a tree
+    :param update: [dictionary] the update, see _plan_update, None after a full inference
+    :param n_tips: [int] number of tips of the tree
+    """
+    if update is None:
+        state = {'full_tips': n_tips, 'placed': 0, 'removed': 0, 'updates': 0}
+    else:
+        state = update['state']
+        state = dict(state, placed=state['placed'] + len(update['new']),
+                     removed=state['removed'] + len(update['removed']), updates=state['updates'] + 1)
+    _save_placement_state(alignment_file, state)
+
+
+def _expand_duplicates(alignment_file):
+    """
+    DESCRIPTION:
+    Writes the trees of a selection again with the duplicates of their tips, see expand_tree, if
+    config.EXPAND_DUPLICATES and the selected records have duplicates. Expanded trees left from a
+    previous selection are removed otherwise
+    :return: [list] the files written
+    """
+    duplicates_file = alignment_file.with_name(DUPLICATES_FNAME_PATTERN.format(selectname=alignment_file.name))
+    table = DuplicateTable(duplicates_file) if config.EXPAND_DUPLICATES and duplicates_file.exists() else None
+    outputs = []
+    for suffix, expanded_suffix in EXPANDED_TREE_SUFFIXES.items():
+        treefile = alignment_file.with_name(alignment_file.name + suffix)
+        expanded = alignment_file.with_name(alignment_file.name + expanded_suffix)
+        if table is None or not table.members or not treefile.exists():
+            if expanded.exists():
+                expanded.unlink()
+            continue
+        with open(treefile, 'r') as file:
+            newick = file.read()
+        with open(expanded, 'w') as file:
+            file.write(expand_tree(newick, table, tip_name=_tip_name))
+        outputs.append(expanded)
+    return outputs
+
+
+def create_trees(selectnames, searches=None, bootstrap=None, bootstrap_batches=None, cpu_budget=None,
+                 placement=None):
+    """
+    DESCRIPTION:
+    Infers the trees of several selections at the same time. Every tree is split into
+    independent IQ-TREE jobs (one per search seed and per batch of bootstrap replicates) and all
+    the jobs share a budget of threads. The timing and log of every job is written to
+    {subfolder}_jobs.json in the tree subfolder.
+    With a placement method (none by default, see config.TREE_PLACEMENT), a tree without bootstrap
+    that changed little since it was inferred is updated instead: the new
+    genomes are placed onto it in-process with place_sequences, or by IQ-TREE constrained to its
+    topology. It's inferred again once config.TREE_PLACEMENT_MAX_DRIFT of its tips changed or after
+    config.TREE_PLACEMENT_MAX_UPDATES updates. The duplicates of the tips are then added to a copy of
+    every tree, see _expand_duplicates
+    :param selectnames: [list] names of the files in the tree folder, the same as the names of their subfolders
+    :param searches: [int] number of tree searches per tree, defaults to config.IQTREE_SEARCHES
+    :param bootstrap: [int] number of bootstrap replicates per tree, defaults to config.IQTREE_BOOTSTRAP
+    :param bootstrap_batches: [int] number of jobs the replicates are split in, defaults to config.IQTREE_BOOTSTRAP_BATCHES
+    :param cpu_budget: [int] total number of IQ-TREE threads, defaults to config.IQTREE_CPU_BUDGET
+    :param placement: [string] one of TREE_PLACEMENT_METHODS or 'none' to always infer the trees, defaults
+    to config.TREE_PLACEMENT
+    :return: [dictionary] the runs of every selection, selections that didn't change or were updated
+    in-process are left out
+    """
+    searches = searches or config.IQTREE_SEARCHES
+    bootstrap = config.IQTREE_BOOTSTRAP if bootstrap is None else bootstrap
+    bootstrap_batches = bootstrap_batches or config.IQTREE_BOOTSTRAP_BATCHES
+    placement = placement or config.TREE_PLACEMENT
+    if placement == 'none' or bootstrap:
+        # the bootstrap support of an updated tree would be out of date
+        placement = None
+    elif placement not in TREE_PLACEMENT_METHODS:
+        raise ValueError(f'unknown placement method {placement}')
+
+    trees = {}
+    for selectname in selectnames:
+        subfolder = selectname.split('.')[0]
+        alignment_file = config.TREE_DIR / subfolder / selectname
+        stage_manifest = Manifest(subfolder, config.TREE_DIR / subfolder)
+        parameters = {'arguments': config.IQTREE_ARGUMENTS + _site_arguments(alignment_file), 'searches': searches, 'seed': config.IQTREE_SEED,
+                      'bootstrap': bootstrap, 'bootstrap_batches': bootstrap_batches, 'placement': placement}
+        inputs_hash = hash_values(file_checksum(alignment_file), parameters)
+        outputs = [alignment_file.with_name(alignment_file.name + '.treefile')]
+        if bootstrap:
+            outputs.append(alignment_file.with_name(alignment_file.name + '.contree'))
+        if stage_manifest.is_unchanged('tree', inputs_hash, outputs=outputs):
+            print(f'{subfolder}: selection unchanged, tree inference skipped')
+            _expand_duplicates(alignment_file)
+            continue
+
+        update = _plan_update(alignment_file, placement, config.TREE_PLACEMENT_MAX_DRIFT,
+                              config.TREE_PLACEMENT_MAX_UPDATES)
+        if update is not None and placement == 'parsimony':
+            outputs = _place_on_tree(alignment_file, update)
+            _record_update(alignment_file, update, len(update['records']))
+            stage_manifest.record('tree', inputs_hash, outputs=outputs, parameters=dict(parameters, update=True))
+            _expand_duplicates(alignment_file)
+            continue
+        constraint = None if update is None else _write_constraint(alignment_file, update)
+        trees[selectname] = (alignment_file, stage_manifest, inputs_hash, parameters, update,
+                             _tree_jobs(alignment_file, searches, bootstrap, bootstrap_batches, constraint))
+
+    if not trees:
+        return {}
+
+    def job(prefix, arguments):
+        return lambda threads: run_iqtree(arguments, prefix, threads=threads)
+
+    jobs = [job(prefix, arguments) for *_, (search_jobs, bootstrap_jobs) in trees.values()
+            for prefix, arguments in search_jobs + bootstrap_jobs]
+    print(f'Executing tree inference: {len(jobs)} jobs for {len(trees)} trees')
+    runs = iter(mafft.run_jobs(jobs, cpu_budget=cpu_budget or config.IQTREE_CPU_BUDGET))
+
+    results = {}
+    for selectname, (alignment_file, stage_manifest, inputs_hash, parameters, update, tree_jobs) in trees.items():
+        search_jobs, bootstrap_jobs = tree_jobs
+        search_runs = [next(runs) for _ in search_jobs]
+        bootstrap_runs = [next(runs) for _ in bootstrap_jobs]
+        outputs = _gather_trees(alignment_file, search_runs, bootstrap_runs)
+        failed = [run for run in search_runs + bootstrap_runs if run['returncode'] != 0]
+        for run in failed:
+            print(f'IQ-TREE failed with exit code {run["returncode"]}, see {run["log"]}')
+
+        subfolder = selectname.split('.')[0]
+        with open(config.TREE_DIR / subfolder / f'{subfolder}_jobs.json', 'w') as file:
+            file.write(json.dumps({'searches': search_runs, 'bootstrap': bootstrap_runs}, indent=1))
+        if not failed and outputs:
+            _record_update(alignment_file, update, sum(1 for _ in at.iter_fasta_records(alignment_file)))
+            stage_manifest.record('tree', inputs_hash, outputs=outputs,
+                                  parameters=dict(parameters, update=update is not None))
+        _expand_duplicates(alignment_file)
+        print(f'{subfolder}: tree inference completed, {len(failed)} failed jobs, '
+              f'{sum(run["seconds"] for run in search_runs + bootstrap_runs):.1f} s of IQ-TREE runs')
+        results[selectname] = search_runs + bootstrap_runs
+    return results
+
+
+def tree_creator(selectname, searches=None, bootstrap=None, bootstrap_batches=None, cpu_budget=None, placement=None):
     """
     DESCRIPTION:
     A function create the tree inference and store the results in a subfolder within covid_phylo/tree/
     :param selectname: [string] name of the file to be put in the tree folder. The same as the name of the subfolder.
+    :param searches: [int] number of tree searches, see create_trees
+    :param bootstrap: [int] number of bootstrap replicates, see create_trees
+    :param bootstrap_batches: [int] number of jobs the replicates are split in, see create_trees
+    :param cpu_budget: [int] total number of IQ-TREE threads, see create_trees
+    :param placement: [string] how the tree is updated, see create_trees
     :return: None
     """
-    print('Executing tree inference')
-    filename = selectname
-    subfolder = selectname.split('.')[0]
-    process = subprocess.run(['iqtree', '-s', f'{TREE_DIR / subfolder / filename}', '-bnni', '-nt', 'AUTO'])
-    print('Tree inference completed with exit code %d' % process.returncode)
+    create_trees([selectname], searches=searches, bootstrap=bootstrap, bootstrap_batches=bootstrap_batches,
+                 cpu_budget=cpu_budget, placement=placement)
+
+
+def _counted_symbols(excluded):
+    table = np.ones(256, dtype=bool)
+    table[list(excluded.encode('ascii'))] = False
+    return table
+
+
+# symbols counted by each ranking key of align_selector, a genome is better the fewer it has
+RANKING_KEYS = {'gaps': ~_counted_symbols('-'),
+                'ambiguous': _counted_symbols('ACGTacgt-'),
+                'gaps+ambiguous': _counted_symbols('ACGTacgt'),
+                }
+
+
+def _record_id(header):
+    return header.split(maxsplit=1)[0] if header.strip() else header
+
+
+def _select_from_matrix(alignment, n_genomes, counted, distinct):
+    """
+    DESCRIPTION:
+    Selects the best genomes of a memory mapped alignment, scoring a few rows at a time
+    :return: [list] (header, sequence) tuples of the selected genomes, best first
+    """
+    scores = np.zeros(len(alignment), dtype=np.int64)
+    for i in range(0, len(alignment), SELECTOR_ROWS_PER_BLOCK):
+        scores[i:i + SELECTOR_ROWS_PER_BLOCK] = counted[alignment.matrix[i:i + SELECTOR_ROWS_PER_BLOCK]].sum(axis=1)
+    ids = np.array([_record_id(header) for header in alignment.headers])
+
+    selected = []
+    seen = set()
+    for i in np.lexsort((ids, scores)):
+        if len(selected) >= n_genomes:
+            break
+        if distinct:
+            row_hash = hashlib.blake2b(alignment.matrix[i].tobytes(), digest_size=16).digest()
+            if row_hash in seen:
+                continue
+            seen.add(row_hash)
+        selected.append((alignment.headers[i], alignment.sequence(i)))
+    return selected
+
+
+# code of every base, 4 for gaps and ambiguous bases
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate('ACGT'):
+    _BASE_CODES[[ord(_base), ord(_base.lower())]] = _code
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(words):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+else:
+    _POPCOUNT8 = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        return _POPCOUNT8[words.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def _score_rows(alignment, counted, threads):
+    """
+    DESCRIPTION:
+    Scores every genome of an alignment matrix by its number of counted symbols and counts the bases of
+    every column, by blocks of rows on several threads
+    :return: [np.ndarray, np.ndarray] the scores, and the 4 x L counts of A, C, G and T
+    """
+    n_sequences, length = alignment.matrix.shape
+    scores = np.zeros(n_sequences, dtype=np.int64)
+    starts = range(0, n_sequences, SELECTOR_ROWS_PER_BLOCK)
+
+    def score(thread_starts):
+        counts = np.zeros((4, length), dtype=np.int64)
+        for start in thread_starts:
+            block = alignment.matrix[start:start + SELECTOR_ROWS_PER_BLOCK]
+            scores[start:start + len(block)] = counted[block].sum(axis=1)
+            codes = _BASE_CODES[block]
+            for code in range(4):
+                counts[code] += (codes == code).sum(axis=0)
+        return counts
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        counts = sum(executor.map(score, [starts[k::threads] for k in range(threads)]))
+    return scores, counts
+
+
+def _variant_sites(counts, max_sites):
+    """
+    DESCRIPTION:
+    Chooses the sites the genomes are compared on: the ones with bases other than the consensus,
+    at most max_sites of them, those with more genomes off the consensus first
+    :return: [np.ndarray, np.ndarray] the sites and their consensus base codes
+    """
+    minor = counts.sum(axis=0) - counts.max(axis=0)
+    sites = np.flatnonzero(minor)
+    if len(sites) > max_sites:
+        sites = np.sort(sites[np.argsort(-minor[sites], kind='stable')[:max_sites]])
+    return sites, counts.argmax(axis=0)[sites]
+
+
+def _variant_bits(alignment, rows, sites, consensus, threads):
+    """
+    DESCRIPTION:
+    Packs for every genome one bit per site, set where it has a base other than the consensus. Gaps and
+    ambiguous bases are taken as the consensus, so missing data doesn't make genomes look different
+    :return: [np.ndarray] the bits, one row of uint64 words per genome
+    """
+    n_words = max(1, -(-len(sites) // 64))
+    packed = np.zeros((len(rows), n_words * 8), dtype=np.uint8)
+
+    def pack(start):
+        block_rows = rows[start:start + SELECTOR_ROWS_PER_BLOCK]
+        # whole rows then the sites, faster than picking both at once
+        codes = _BASE_CODES[np.take(alignment.matrix[block_rows], sites, axis=1)]
+        bits = np.packbits((codes < 4) & (codes != consensus), axis=1)
+        packed[start:start + len(block_rows), :bits.shape[1]] = bits
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(pack, range(0, len(rows), SELECTOR_ROWS_PER_BLOCK)))
+    return packed.view(np.uint64)
+
+
+def farthest_point_order(packed, k, threads=1):
+    """
+    DESCRIPTION:
+    Greedy farthest point sampling: starting with the first genome, repeatedly selects the genome
+    with the most differences to its closest selected genome. The differences are counted on packed
+    bits, see _variant_bits, a share of the genomes per thread. A genome only gets closer to a new
+    genome if its closest selected genome is less than twice its distance away from it (triangle
+    inequality), so most genomes are skipped once a few are selected. Ties go to the first genome,
+    so genomes ordered best first are preferred
+    :param packed: [np.ndarray] bits of the genomes, one row of uint64 words per genome
+    :param k: [int] number of genomes to select
+    :param threads: [int] number of threads
+    :return: [list] indexes of the selected genomes, fewer than k if the rest are identical to them
+    """
+    n_genomes = len(packed)
+    distance = np.zeros(n_genomes, dtype=np.int64)
+    closest = np.zeros(n_genomes, dtype=np.int64)
+    selected = []
+    current = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while n_genomes and len(selected) < k:
+            row = packed[current]
+            if selected:
+                to_selected = _popcount(packed[selected] ^ row)
+                rows = np.flatnonzero(to_selected[closest] < 2 * distance)
+            else:
+                rows = np.arange(n_genomes)
+            selected.append(current)
+
+            parts = np.array_split(rows, min(threads, max(1, len(rows) // SELECTOR_ROWS_PER_BLOCK)))
+            for part, differences in zip(parts, executor.map(lambda part: _popcount(packed[part] ^ row), parts)):
+                closer = (differences < distance[part]) | (len(selected) == 1)
+                distance[part[closer]] = differences[closer]
+                closest[part[closer]] = len(selected) - 1
+
+            current = int(np.argmax(distance))
+            if distance[current] == 0:
+                break
+    return selected
+
+
+def _stratum_quotas(sizes, n_genomes):
+    """
+    DESCRIPTION:
+    Shares n_genomes among strata in proportion to their sizes, by largest remainder. Strata
+    smaller than their share are taken whole and the rest is shared among the others
+    :param sizes: [dictionary] number of genomes of every stratum
+    :return: [dictionary] number of genomes to select from every stratum
+    """
+    quotas = {}
+    pending = dict(sizes)
+    remaining = n_genomes
+    while pending and remaining > 0:
+        total = sum(pending.values())
+        shares = {stratum: remaining * size / total for stratum, size in pending.items()}
+        whole = [stratum for stratum in pending if shares[stratum] >= pending[stratum]]
+        if whole:
+            for stratum in whole:
+                quotas[stratum] = pending.pop(stratum)
+                remaining -= quotas[stratum]
+            continue
+        for stratum in pending:
+            quotas[stratum] = int(shares[stratum])
+        by_remainder = sorted(pending, key=lambda stratum: (quotas[stratum] - shares[stratum], str(stratum)))
+        for stratum in by_remainder[:remaining - sum(quotas[stratum] for stratum in pending)]:
+            quotas[stratum] += 1
+        break
+    return quotas
+
+
+def _strata(ids, stratify):
+    """
+    DESCRIPTION:
+    Stratum of every genome by its metadata in the catalog of the record store
+    :param ids: [list] record ids of the genomes
+    :param stratify: [list] names from STRATA
+    :return: [list] tuples of the values of every genome, None if there is no stratification
+    """
+    if not stratify:
+        return None
+    unknown = [name for name in stratify if name not in STRATA]
+    if unknown:
+        raise ValueError(f'unknown strata {unknown}')
+    path = config.CACHE_DIR / config.RECORD_STORE_DIRNAME / CATALOG_FNAME
+    if not path.exists():
+        print('no catalog of the records, the selection is not stratified')
+        return None
+
+    with Catalog(path) as catalog:
+        values = catalog.values(['country', 'collection_date'])
+
+    def stratum(record_id):
+        country, date = values.get(record_id, (None, None))
+        metadata = {'country': country, 'month': date[:7] if date else None}
+        return tuple(metadata[name] for name in stratify)
+
+    return [stratum(record_id) for record_id in ids]
+
+
+def _select_diverse(alignment, n_genomes, counted, distinct, stratify=(), max_missing=None, max_sites=None,
+                    threads=None):
+    """
+    DESCRIPTION:
+    Selects a diverse set of good genomes of a memory mapped alignment. The candidates are the genomes
+    with at most max_missing counted symbols per site, or the n_genomes best ones if there are fewer.
+    The genomes are compared on the max_sites most variable sites, and chosen by farthest point sampling
+    (see farthest_point_order) in every stratum, with quotas in proportion to the candidates of the
+    stratum. When the strata run out of different genomes, the best remaining candidates are added
+    :param stratify: [list] names from STRATA, defaults to no stratification
+    :param max_missing: [float] defaults to config.TREE_SELECTION_MAX_MISSING
+    :param max_sites: [int] defaults to config.TREE_SELECTION_MAX_SITES
+    :param threads: [int] defaults to config.ANALYSIS_THREADS
+    :return: [list] (header, sequence) tuples of the selected genomes, best first
+    """
+    max_missing = config.TREE_SELECTION_MAX_MISSING if max_missing is None else max_missing
+    max_sites = max_sites or config.TREE_SELECTION_MAX_SITES
+    threads = threads or config.ANALYSIS_THREADS
+    n_sequences, length = alignment.matrix.shape
+    if n_genomes <= 0 or n_sequences == 0:
+        return []
+
+    scores, counts = _score_rows(alignment, counted, threads)
+    ids = np.array([_record_id(header) for header in alignment.headers])
+    order = np.lexsort((ids, scores))
+    limit = max(max_missing * length, scores[order[min(n_genomes, n_sequences) - 1]])
+    candidates = order[scores[order] <= limit]
+    sites, consensus = _variant_sites(counts, max_sites)
+    packed = _variant_bits(alignment, candidates, sites, consensus, threads)
+    print(f'{len(candidates)} candidate genomes compared on {len(sites)} sites')
+
+    groups = {}
+    for position, stratum in enumerate(_strata(ids[candidates], stratify) or [()] * len(candidates)):
+        groups.setdefault(stratum, []).append(position)
+    quotas = _stratum_quotas({stratum: len(positions) for stratum, positions in groups.items()}, n_genomes)
+    chosen = []
+    for stratum, positions in groups.items():
+        positions = np.array(positions)
+        chosen += positions[farthest_point_order(packed[positions], quotas.get(stratum, 0), threads)].tolist()
+
+    if len(chosen) < n_genomes:
+        seen = None
+        if distinct:
+            seen = {hashlib.blake2b(alignment.matrix[candidates[position]].tobytes(), digest_size=16).digest()
+                    for position in chosen}
+        chosen_set = set(chosen)
+        for position in range(len(candidates)):
+            if len(chosen) >= n_genomes:
+                break
+            if position in chosen_set:
+                continue
+            if distinct:
+                row_hash = hashlib.blake2b(alignment.matrix[candidates[position]].tobytes(), digest_size=16).digest()
+                if row_hash in seen:
+                    continue
+                seen.add(row_hash)
+            chosen.append(position)
+
+    return [(alignment.headers[i], alignment.sequence(i)) for i in candidates[sorted(chosen)]]
+
+
+class _Worst:
+    """
+    DESCRIPTION:
+    Reverses the order of a ranking key, so that heapq keeps the worst selected genome on top
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
 
 
-def align_selector(origname, destname, n_genomes):
+def _select_from_fasta(path, n_genomes, counted, distinct):
     """
     DESCRIPTION:
-    Function to select the n alignments with the lowest number of gaps.
+    Selects the best genomes of an aligned fasta file reading one record at a time and
+    keeping only the best n_genomes in a heap. With distinct, identical aligned sequences
+    count once, the one with the lowest id is kept
+    :return: [list] (header, sequence) tuples of the selected genomes, best first
+    """
+    if n_genomes <= 0:
+        return []
+
+    best = {}   # identity of the sequence -> (key, header, sequence) of the selected genomes
+    heap = []   # (_Worst(key), identity), entries replaced in best are left behind and skipped
+    for n_record, (header, sequence) in enumerate(at.iter_fasta_records(path)):
+        key = (int(counted[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)].sum()), _record_id(header))
+        identity = hashlib.blake2b(sequence.encode('ascii'), digest_size=16).digest() if distinct else n_record
+        current = best.get(identity)
+        if current is not None:
+            if key < current[0]:
+                best[identity] = (key, header, sequence)
+                heapq.heappush(heap, (_Worst(key), identity))
+            continue
+
+        if len(best) >= n_genomes:
+            while best.get(heap[0][1], (None,))[0] != heap[0][0].key:
+                heapq.heappop(heap)
+            if not key < heap[0][0].key:
+                continue
+            del best[heapq.heappop(heap)[1]]
+
+        best[identity] = (key, header, sequence)
+        heapq.heappush(heap, (_Worst(key), identity))
+
+    return [(header, sequence) for _, header, sequence in sorted(best.values())]
+
+
+# symbols of no information, a column with only these is left out
+_MISSING = ~_counted_symbols('-N?')
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def compress_sites(selected):
+    """
+    DESCRIPTION:
+    Removes the columns of a selection that don't change the tree: the columns with only gaps
+    and N, and the constant columns, whose counts per base are kept for IQ-TREE's -fconst. The
+    identical site patterns of the remaining columns are counted too, all of them are kept as
+    IQ-TREE needs every site
+    :param selected: [list] (header, sequence) tuples of aligned sequences
+    :return: [list, dictionary] (header, sequence) tuples with the remaining columns, and the
+    sites information: number of columns, remaining columns (1-based, the reference coordinates
+    in the 'reference' alignment mode), their site pattern, and the counts of removed columns
+    """
+    matrix = np.frombuffer(''.join(sequence for _, sequence in selected).upper().encode('ascii'),
+                           dtype=np.uint8).reshape(len(selected), -1)
+    missing = _MISSING[matrix].all(axis=0)
+    constant = (matrix == matrix[0]).all(axis=0) & np.isin(matrix[0], _BASES)
+    kept = ~(missing | constant)
+    if not kept.any():
+        return selected, None
+
+    compressed = matrix[:, kept]
+    patterns, pattern_ids = np.unique(compressed.T, axis=0, return_inverse=True)
+    sites = {'n_columns': matrix.shape[1],
+             'columns': (np.flatnonzero(kept) + 1).tolist(),
+             'patterns': pattern_ids.ravel().tolist(),
+             'n_patterns': len(patterns),
+             'missing': int(missing.sum()),
+             'constant': {chr(base): int((constant & (matrix[0] == base)).sum()) for base in _BASES}}
+    rows = [(header, compressed[i].tobytes().decode('ascii')) for i, (header, _) in enumerate(selected)]
+    return rows, sites
+
+
+@profiling.hot
+def align_selector(origname, destname, n_genomes, use_matrix=True, rank_by=None, distinct=None, compress=None,
+                   strategy=None, stratify=None):
+    """
+    DESCRIPTION:
+    Function to select the n alignments with the lowest number of gaps (or of another ranking key), or
+    with the 'diverse' strategy a diverse set of good alignments, see _select_diverse.
+    Ties are broken by record id so the selection is deterministic.
     :param origname: [string] name of the file with the complete list of alignments in the fasta folder.
     :param destname: [string] name of the file to be put in the tree folder. The same as the name of the subfolder.
     :param n_genomes: [integer] number of alignments to be taken.
+    :param use_matrix: [boolean] whether to work on the memory mapped alignment matrix. Otherwise the fasta
+    file is streamed.
+    :param rank_by: [string] one of RANKING_KEYS: 'gaps', 'ambiguous' (N and other IUPAC codes) or
+    'gaps+ambiguous'. Defaults to 'gaps' for the 'quality' strategy and 'gaps+ambiguous' for 'diverse'.
+    :param distinct: [boolean] whether identical aligned sequences are selected only once, defaults to
+    config.DEDUPLICATE_SEQUENCES
+    :param compress: [boolean] whether the constant and all-gap columns are left out, see compress_sites.
+    Defaults to config.TREE_COMPRESS_SITES
+    :param strategy: [string] one of SELECTION_STRATEGIES, defaults to config.TREE_SELECTION. 'diverse'
+    needs the alignment matrix
+    :param stratify: [list] names from STRATA the 'diverse' selection is stratified by, defaults to
+    config.TREE_SELECTION_STRATIFY
     :return: None. It writes the selected aignments in the destname folder.
     """
-    # Part to take the alignments with lowest number of gaps
-    file = open(FASTA_DIR / origname, 'r')
+    strategy = strategy or config.TREE_SELECTION
+    if strategy not in SELECTION_STRATEGIES:
+        raise ValueError(f'unknown selection strategy {strategy}')
+    stratify = list(config.TREE_SELECTION_STRATIFY if stratify is None else stratify)
+    rank_by = rank_by or ('gaps' if strategy == 'quality' else 'gaps+ambiguous')
+    counted = RANKING_KEYS[rank_by]
+    if distinct is None:
+        distinct = config.DEDUPLICATE_SEQUENCES
+    if compress is None:
+        compress = config.TREE_COMPRESS_SITES
 
-    # Read the information
-    data = file.read()
-    file.close()
-    data = data.split('>')[1::]  # The first element is an empty string
+    sel_dir = config.TREE_DIR / destname.split('.')[0]
+    sel_dir.mkdir(parents=True, exist_ok=True)
+    sites_file = sel_dir / SITES_FNAME_PATTERN.format(selectname=destname)
+    # the duplicates of the records aligned under a tag, whose alignment is {tag}_aligned
+    duplicates = None
+    if origname.endswith('_aligned'):
+        duplicates = config.FASTA_DIR / at.SequenceAligner.duplicates_pattern.format(tag=origname[:-len('_aligned')])
+    if duplicates is not None and not duplicates.exists():
+        duplicates = None
+    duplicates_file = sel_dir / DUPLICATES_FNAME_PATTERN.format(selectname=destname)
+    stage_manifest = Manifest(destname.split('.')[0], sel_dir)
+    selection = {'strategy': strategy}
+    if strategy == 'diverse':
+        selection.update({'stratify': stratify, 'max_missing': config.TREE_SELECTION_MAX_MISSING,
+                          'max_sites': config.TREE_SELECTION_MAX_SITES})
+    inputs_hash = hash_values(file_checksum(config.FASTA_DIR / origname), n_genomes, rank_by, distinct, compress,
+                              selection, file_checksum(duplicates) if duplicates is not None else None)
+    outputs = [sel_dir / destname] + ([sites_file] if compress else []) + ([duplicates_file] if duplicates else [])
+    if stage_manifest.is_unchanged('select', inputs_hash, outputs=outputs):
+        print('Alignment unchanged, selection skipped')
+        return
 
-    # Take the best n models
-    gaps = list(enumerate([model.count('-') for model in data]))
-    data = '\n'.join(['>' + data[element[0]] for element in sorted(gaps, key=lambda x: x[1])[0:n_genomes]])
+    alignment = at.open_alignment_matrix(config.FASTA_DIR / origname) if use_matrix or strategy == 'diverse' else None
+    if alignment is not None and strategy == 'diverse':
+        selected = _select_diverse(alignment, n_genomes, counted, distinct, stratify=stratify)
+    elif alignment is not None:
+        selected = _select_from_matrix(alignment, n_genomes, counted, distinct)
+    else:
+        selected = _select_from_fasta(config.FASTA_DIR / origname, n_genomes, counted, distinct)
 
-    # Write the selected data into another file
-    sel_dir = TREE_DIR / destname.split('.')[0]
-    sel_dir.mkdir(exist_ok=True)
-    file = open(sel_dir / destname, 'w')
-    file.write(data)
-    file.close()
+    sites = None
+    if compress and selected:
+        selected, sites = compress_sites(selected)
+    if sites is not None:
+        print(f'{len(sites["columns"])} of {sites["n_columns"]} columns kept, {sites["n_patterns"]} site patterns')
+        with open(sites_file, 'w') as file:
+            file.write(json.dumps(sites))
+    elif sites_file.exists():
+        sites_file.unlink()
 
+    if duplicates is not None:
+        DuplicateTable(duplicates).subset((_record_id(header) for header, _ in selected), duplicates_file).save()
+    elif duplicates_file.exists():
+        duplicates_file.unlink()
+
+    # Write the selected data into another file
+    with open(sel_dir / destname, 'w') as file:
+        for header, sequence in selected:
+            file.write(f'>{header}\n{sequence}\n')
+    stage_manifest.record('select', inputs_hash, outputs=[path for path in outputs if path.exists()],
+                          parameters=dict(selection, origname=origname, n_genomes=n_genomes, rank_by=rank_by,
+                                          distinct=distinct, compress=compress))
@@ -0,0 +1,165 @@
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import profiling
+
+
+def run_mafft(arguments, destname, threads=1):
+    """
+    DESCRIPTION:
+    Runs MAFFT streaming its output straight to a file. The output is written under a temporary
+    name and only renamed to destname if MAFFT succeeds, so a failed run never replaces a
+    previous file. MAFFT's messages are written to destname.log
+    :param arguments: [list] MAFFT arguments, without the executable and --thread
+    :param destname: [pathlib] file for the alignment
+    :param threads: [int] number of threads MAFFT may use
+    :return: None. Raises RuntimeError if MAFFT fails, or OSError if it can't be run
+    """
+    tmp_name = destname.with_name(destname.name + '.tmp')
+    log_name = destname.with_name(destname.name + '.log')
+    command = [config.MAFFT_DIR, '--thread', str(threads)] + [str(argument) for argument in arguments]
+    try:
+        with open(tmp_name, 'w') as out_file, open(log_name, 'w') as log_file, profiling.stage('mafft'):
+            process = subprocess.run(command, stdout=out_file, stderr=log_file)
+
+        if process.returncode != 0:
+            raise RuntimeError(f'MAFFT failed with exit code {process.returncode}, see {log_name}')
+
+        os.replace(tmp_name, destname)
+    finally:
+        # left behind when MAFFT fails or can't be run
+        if tmp_name.exists():
+            tmp_name.unlink()
+
+
+def threads_per_job(n_jobs, cpu_budget=None):
+    """
+    DESCRIPTION:
+    Splits a CPU budget among jobs that run at the same time
+    :param n_jobs: [int] number of jobs
+    :param cpu_budget: [int] total number of threads, defaults to config.MAFFT_CPU_BUDGET
+    :return: [int, int] threads for every job and number of jobs to run at the same time
+    """
+    cpu_budget = cpu_budget or config.MAFFT_CPU_BUDGET
+    n_jobs = max(1, min(n_jobs, cpu_budget))
+    threads = max(1, cpu_budget // n_jobs)
+    return threads, max(1, cpu_budget // threads)
+
+
+def run_jobs(jobs, cpu_budget=None):
+    """
+    DESCRIPTION:
+    Runs several jobs at the same time, sharing a CPU budget among them
+    :param jobs: [list] functions taking the number of threads they may use as only argument
+    :param cpu_budget: [int] total number of threads, defaults to config.MAFFT_CPU_BUDGET
+    :return: [list] what the jobs returned. The first exception of a job is raised after
+    all the jobs are finished
+    """
+    if not jobs:
+        return []
+
+    threads, max_workers = threads_per_job(len(jobs), cpu_budget)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(job, threads) for job in jobs]
+    return [future.result() for future in futures]
+
+
+def _split_fasta(path, chunk_size, chunk_dir):
+    """
+    DESCRIPTION:
+    Splits a fasta file into files of at most chunk_size records
+    :return: [list] the paths of the chunk files
+    """
+    chunks = []
+    out_file = None
+    n_records = 0
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            if line.startswith('>'):
+                if n_records % chunk_size == 0:
+                    if out_file is not None:
+                        out_file.close()
+                    chunks.append(chunk_dir / f'chunk_{len(chunks)}')
+                    out_file = open(chunks[-1], 'w')
+                n_records += 1
+            if out_file is not None:
+                out_file.write(line)
+    if out_file is not None:
+        out_file.close()
+    return chunks
+
+
+def _copy_records(in_name, out_file, skip):
+    """
+    DESCRIPTION:
+    Appends the records of a fasta file to an open file, leaving out the first skip records
+    """
+    n_records = 0
+    with open(in_name, 'r') as in_file:
+        for line in in_file:
+            if line.startswith('>'):
+                n_records += 1
+            if n_records > skip:
+                out_file.write(line)
+
+
+def align_to_reference(unaligned_file, reference_file, destname, insertions_file, previous_file=None,
+                       chunk_size=None, cpu_budget=None):
+    """
+    DESCRIPTION:
+    Aligns every sequence of a fasta file to a fixed reference, keeping the reference coordinates.
+    The sequences are split in chunks aligned by MAFFT jobs running at the same time
+    (--addfragments --keeplength); the insertions relative to the reference MAFFT removes are
+    written to insertions_file. The rows are appended after the rows of previous_file, which are
+    copied unchanged, so the cost only depends on the number of new sequences
+    :param unaligned_file: [pathlib] fasta file with the new sequences
+    :param reference_file: [pathlib] fasta file with the reference sequence
+    :param destname: [pathlib] file for the alignment
+    :param insertions_file: [pathlib] file for the insertion maps of the new sequences
+    :param previous_file: [pathlib] alignment in reference coordinates to extend, None to start a new one
+    :param chunk_size: [int] number of sequences per MAFFT job, defaults to config.REFERENCE_CHUNK_SIZE
+    :param cpu_budget: [int] total number of MAFFT threads, defaults to config.MAFFT_CPU_BUDGET
+    :return: None. Raises RuntimeError if a MAFFT job fails, destname is then left untouched
+    """
+    if not reference_file.exists():
+        raise FileNotFoundError(f'reference sequence {reference_file} not found')
+
+    with open(reference_file, 'r') as file:
+        n_reference = sum(1 for line in file if line.startswith('>'))
+    chunk_dir = destname.with_name(destname.name + '.chunks')
+    chunk_dir.mkdir(exist_ok=True)
+    try:
+        chunks = _split_fasta(unaligned_file, chunk_size or config.REFERENCE_CHUNK_SIZE, chunk_dir)
+
+        def chunk_job(chunk):
+            def align(threads):
+                run_mafft(['--6merpair', '--keeplength', '--mapout', '--addfragments', chunk, reference_file],
+                          chunk.with_name(chunk.name + '_aligned'), threads=threads)
+            return align
+
+        run_jobs([chunk_job(chunk) for chunk in chunks], cpu_budget=cpu_budget)
+
+        tmp_name = destname.with_name(destname.name + '.tmp')
+        with open(tmp_name, 'w') as out_file:
+            if previous_file is not None:
+                with open(previous_file, 'r') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+            for chunk in chunks:
+                _copy_records(chunk.with_name(chunk.name + '_aligned'), out_file, skip=n_reference)
+
+        with open(insertions_file, 'w') as out_file:
+            for chunk in chunks:
+                # --mapout writes the insertions next to the input file
+                map_file = chunk.with_name(chunk.name + '.map')
+                if map_file.exists():
+                    with open(map_file, 'r') as in_file:
+                        out_file.write(in_file.read())
+
+        os.replace(tmp_name, destname)
+    finally:
+        for path in chunk_dir.iterdir():
+            path.unlink()
+        chunk_dir.rmdir()
@@ -1,49 +1,59 @@
-import ncbi, config, iqtree, ete
-from align_tools import SequenceAligner, Filter
-
-def get_sequences():
-    return ncbi.get_all_covid_nucleotide_seqs(cache_dir=config.CACHE_DIR)
+import argparse
+import ncbi, config, iqtree, ete, profiling
+from align_tools import SequenceAligner, make_alignments
+from catalog import CatalogQuery
 
+# catalog query of the records aligned under each tag
+ALIGNMENT_TAGS = {'complete': CatalogQuery(complete=True),
+                  'china': CatalogQuery(country='China', complete=True),
+                  'spain': CatalogQuery(country='Spain', complete=True),
+                  }
 
-def align_complete(data):
-    my_aligner = SequenceAligner.from_tag(tag='complete', data=data)
-    complete_filter = Filter(['complete genome']).all_filter
-    my_aligner.add_filter(complete_filter)
-    my_aligner.make_alignment()
+def get_sequences():
+    since = 'last' if config.NCBI_SEARCH_SINCE_LAST_RUN else None
+    return ncbi.get_all_covid_nucleotide_seqs(cache_dir=config.CACHE_DIR, stream=True, since=since)
 
-    # for a copy without timestamp
-    my_aligner.copy_aligned_file_unstamped()
 
-def align_china(data):
-    china_aligner = SequenceAligner.from_tag(tag='china', data=data)
-    china_filter = Filter(['CHN', 'complete genome']).all_filter
-    china_aligner.add_filter(china_filter)
-    china_aligner.make_alignment()
+def align_all(data):
+    aligners = []
+    for tag, query in ALIGNMENT_TAGS.items():
+        aligner = SequenceAligner.from_tag(tag=tag, data=data)
+        aligner.set_query(query)
+        aligners.append(aligner)
 
     # for a copy without timestamp
-    my_aligner.copy_aligned_file_unstamped()
+    make_alignments(aligners, data.get('seqrecords'), make_copy=True)
 
-def align_spain(data):
-    aligner = SequenceAligner.from_tag(tag='spain', data=data)
-    filt = Filter(['ESP', 'complete genome']).all_filter
-    aligner.add_filter(filt)
-    aligner.make_alignment()
+def parse_arguments(argv=None):
+    """
+    DESCRIPTION:
+    Reads the command line
+    :param argv: [list] the arguments, defaults to sys.argv
+    :return: [argparse.Namespace] the arguments
+    """
+    parser = argparse.ArgumentParser(description='Retrieves the SARS-CoV-2 sequences and aligns them by tag')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='changes a setting of config, e.g. --set MAFFT_CPU_BUDGET=8')
+    return parser.parse_args(argv)
 
-    # for a copy without timestamp
-    aligner.copy_aligned_file_unstamped()
 
-def main():
+def main(argv=None):
     """
     DESCRIPTION:
     Main method of the program.
+    :param argv: [list] the command line arguments, defaults to sys.argv
     :return: None.
     """
-    print('retrieving records')
-    result = get_sequences()
-    
-    align_complete(data=result)
-    align_china(data=result)
-    align_spain(data=result)
+    config.configure_from_strings(parse_arguments(argv).set)
+    config.ensure_dirs()
+    try:
+        with profiling.stage('main'):
+            print('retrieving records')
+            result = get_sequences()
+
+            align_all(data=result)
+    finally:
+        print(f'profiling report written to {profiling.write_report()}')
 
 
 if __name__ == '__main__':
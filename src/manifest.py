@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import config
+
+
+def file_checksum(path):
+    """
+    DESCRIPTION:
+    Computes the sha256 of a file reading it in blocks
+    :param path: [pathlib] the file
+    :return: [string] the checksum or None if the file doesn't exist
+    """
+    checksum = hashlib.sha256()
+    try:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                checksum.update(block)
+    except FileNotFoundError:
+        return None
+    return checksum.hexdigest()
+
+
+def hash_values(*values):
+    """
+    DESCRIPTION:
+    Hashes json serializable values, e.g. the inputs and parameters of a stage
+    :return: [string] the hash
+    """
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def hash_ids(ids):
+    """
+    DESCRIPTION:
+    Hashes a set of record ids, independently of their order
+    :param ids: [iterable] the ids
+    :return: [string] the hash
+    """
+    checksum = hashlib.sha256()
+    for sequence_id in sorted(ids):
+        checksum.update(sequence_id.encode('utf-8') + b'\n')
+    return checksum.hexdigest()
+
+
+class Manifest:
+    """
+    DESCRIPTION:
+    Record of the pipeline stages run for a tag: for every stage the hash of its inputs,
+    its parameters and the checksums of the files it wrote. A stage whose inputs hash to
+    the recorded ones and whose outputs are unchanged doesn't need to run again
+    """
+
+    pattern = '{name}_manifest.json'
+
+    def __init__(self, name, directory=None):
+        """
+        DESCRIPTION:
+        Constructor of the Manifest class, loads the manifest if it exists
+        :param name: [string] name of the manifest, usually the tag
+        :param directory: [pathlib] directory of the manifest file, defaults to config.FASTA_DIR
+        :return: [Manifest] the created object
+        """
+        directory = directory or config.FASTA_DIR
+        self.path = directory / Manifest.pattern.format(name=name)
+        try:
+            with open(self.path, 'r') as file:
+                self.stages = json.load(file)
+        except FileNotFoundError:
+            self.stages = {}
+
+    @staticmethod
+    def _output_entry(path):
+        stat = path.stat()
+        return {'checksum': file_checksum(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @staticmethod
+    def _output_unchanged(path, entry):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        # only read the file when it may have been rewritten
+        return stat.st_mtime == entry['mtime'] or file_checksum(path) == entry['checksum']
+
+    def is_unchanged(self, stage, inputs_hash, outputs=()):
+        """
+        DESCRIPTION:
+        Checks whether a stage already ran with the same inputs and its outputs are still there
+        :param stage: [string] name of the stage, e.g. 'align' or 'tree'
+        :param inputs_hash: [string] hash of the inputs and parameters of the stage
+        :param outputs: [list] paths of the files the stage writes
+        :return: [boolean] true iff the stage can be skipped
+        """
+        entry = self.stages.get(stage)
+        if entry is None or entry['inputs'] != inputs_hash:
+            return False
+        return all(str(path) in entry['outputs'] and Manifest._output_unchanged(path, entry['outputs'][str(path)])
+                   for path in outputs)
+
+    def outputs(self, stage):
+        """
+        DESCRIPTION:
+        Returns the files written by the last recorded run of a stage, e.g. to reuse them when
+        their names change between runs
+        :param stage: [string] name of the stage
+        :return: [list] the paths of the files, empty if the stage wasn't recorded
+        """
+        entry = self.stages.get(stage)
+        return [Path(path) for path in entry['outputs']] if entry is not None else []
+
+    def record(self, stage, inputs_hash, outputs=(), parameters=None):
+        """
+        DESCRIPTION:
+        Records a run of a stage and saves the manifest
+        :param stage: [string] name of the stage
+        :param inputs_hash: [string] hash of the inputs and parameters of the stage
+        :param outputs: [list] paths of the files the stage wrote
+        :param parameters: [dictionary] parameters of the stage, kept for reference
+        """
+        self.stages[stage] = {'inputs': inputs_hash,
+                              'outputs': {str(path): Manifest._output_entry(path) for path in outputs},
+                              'parameters': parameters or {},
+                              'time': time.time()}
+        self.save()
+
+    def save(self):
+        """
+        DESCRIPTION:
+        Writes the manifest to its file
+        """
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as file:
+            file.write(json.dumps(self.stages, indent=1))
+        os.replace(tmp_path, self.path)
@@ -3,10 +3,20 @@ from pprint import pprint
 import time
 import shelve
 import io, sys
-import requests
-from Bio import SeqIO
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import profiling
+from record_store import RecordStore, iter_json_lines
 
-ENTREZ_COVID_SEARCH_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=nucleotide&term=txid2697049[Organism:noexp]&retmode=json&retmax=10000'
+ENTREZ_SEARCH_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
+
+COVID_SEARCH_TERM = 'txid2697049[Organism:noexp]'
+
+SEARCH_CHECKPOINT_DIRNAME = 'search_checkpoint'
+SEARCH_STATE_FNAME = 'search_state.json'
+SEARCH_UIDS_FNAME = 'search_uids.txt'
 
 ENTREZ_NUCL_DOWNLOAD_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=nucleotide&id={uids}&retmode=text&rettype={format}'
 
@@ -36,61 +46,632 @@ def update_progress(progress):
     sys.stdout.flush()
 
 
-def _get_raw_sequence(uid, cache_dir=None, format='gb'):
-	if cache_dir is not None:
-		shelve_path = cache_dir / config.RAW_SEQUENCE_SHELVE_FNAME
-		shelved_raw_seqs = shelve.open(str(shelve_path))
-		if uid in shelved_raw_seqs:
-			# print('uid: ' + str(uid) + ' already in cache')
-			return shelved_raw_seqs[uid]
+class _RateLimiter:
+	"""
+	DESCRIPTION:
+	Spaces out requests shared by several threads so that no more than
+	max_per_second requests are started per second
+	"""
+
+	def __init__(self, max_per_second):
+		self.interval = 1 / max_per_second if max_per_second else 0
+		self.lock = threading.Lock()
+		self.next_time = 0
+
+	def wait(self):
+		with self.lock:
+			now = time.monotonic()
+			delay = self.next_time - now
+			self.next_time = max(now, self.next_time) + self.interval
+		if delay > 0:
+			time.sleep(delay)
+
+	def backoff(self, seconds):
+		"""
+		DESCRIPTION:
+		Delays the next request, e.g. after an error
+		:param seconds: [float] the delay
+		"""
+		with self.lock:
+			self.next_time = max(time.monotonic(), self.next_time) + seconds
+
+
+def _make_session(max_concurrent):
+	"""
+	DESCRIPTION:
+	Creates a requests session with a connection pool big enough for max_concurrent
+	simultaneous requests and retries for the transient errors NCBI is known for
+	:param max_concurrent: [int] number of requests that may run at the same time
+	:return: [requests.Session] the session
+	"""
+	# requests is only imported by the processes that download
+	import requests
+	from requests.adapters import HTTPAdapter
+	from urllib3.util.retry import Retry
+
+	retry = Retry(total=config.NCBI_MAX_RETRIES, backoff_factor=config.NCBI_RETRY_BACKOFF,
+				  status_forcelist=[429, 500, 502, 503, 504])
+	adapter = HTTPAdapter(pool_connections=max_concurrent, pool_maxsize=max_concurrent, max_retries=retry)
+	session = requests.Session()
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
 
-	#print('uid: ' + str(uid) + ' not in cache, proceding to download')
-	nucl_download_url = ENTREZ_NUCL_DOWNLOAD_URL.format(uids=','.join([uid]), format=format)
 
-	response = requests.get(nucl_download_url)
+def _split_raw_records(raw_text, format='gb'):
+	"""
+	DESCRIPTION:
+	Splits the text of a multi-record efetch response into one string per record
+	:param raw_text: [string] the response text
+	:param format: [string] 'gb' or 'fasta'
+	:return: [list] the raw records in the order they appear in the response
+	"""
+	records = []
+	lines = []
+	for line in raw_text.splitlines(keepends=True):
+		if not lines and not line.strip():
+			continue
+		if format == 'fasta' and line.startswith('>') and lines:
+			records.append(''.join(lines))
+			lines = []
+		lines.append(line)
+		if format != 'fasta' and line.rstrip() == '//':
+			records.append(''.join(lines))
+			lines = []
+
+	if lines and format == 'fasta':
+		records.append(''.join(lines))
+
+	return records
+
+
+def _record_ids(raw_seq, format='gb'):
+	"""
+	DESCRIPTION:
+	Reads the identifiers of a raw record, its accession and accession.version
+	:param raw_seq: [string] the raw record
+	:param format: [string] 'gb' or 'fasta'
+	:return: [set] the identifiers
+	"""
+	ids = set()
+	for line in raw_seq.splitlines():
+		if format == 'fasta':
+			fields = line[1:].split()
+			if fields:
+				ids.update([fields[0], fields[0].split('.')[0]])
+			break
+		if line.startswith('ACCESSION') or line.startswith('VERSION'):
+			fields = line.split()
+			if len(fields) > 1:
+				ids.add(fields[1])
+		elif line.startswith('FEATURES') or line.startswith('ORIGIN'):
+			break
+	return ids
+
+
+def _fetch_batch(session, rate_limiter, uids, format, download_url):
+	"""
+	DESCRIPTION:
+	Downloads several records with one efetch request. The records are matched to the uids by their
+	accession.version, see search_uids, the uids without a record of their own (e.g. withdrawn ones,
+	or uids that aren't accessions) are asked for one by one. A uid that still doesn't get exactly one
+	record is left out with a warning, so it's retried by a later run
+	:param session: [requests.Session] session used for the request
+	:param rate_limiter: [_RateLimiter] limiter shared by all the requests of a download
+	:param uids: [list] uids of the records to download
+	:param format: [string] format of the records, e.g. 'gb'
+	:param download_url: [string] url template with {uids} and {format} fields
+	:return: [list] list of (uid, raw_seq) tuples
+	"""
+	rate_limiter.wait()
+	with profiling.stage('ncbi.fetch', records=len(uids)) as counters:
+		response = session.get(download_url.format(uids=','.join(uids), format=format))
+		counters['bytes'] = len(response.content)
 	if response.status_code != 200:
 		msg = 'Something went wrong downloading the nucleotide sequences. '
-		msg += 'response status: {response.status_code}'
+		msg += f'response status: {response.status_code}'
 		raise RuntimeError(msg)
 
-	raw_seq = response.text
+	raw_seqs = _split_raw_records(response.text, format=format)
+	if len(uids) == 1:
+		uid = uids[0]
+		# the only record of a uid that isn't an accession, e.g. a GI, can only be its own
+		if len(raw_seqs) == 1 and (uid.isdigit() or uid in _record_ids(raw_seqs[0], format)):
+			return [(uid, raw_seqs[0])]
+		print(f'warning: {len(raw_seqs)} records found for uid {uid}, it is left for the next run')
+		return []
 
-	if cache_dir is not None:
-		shelved_raw_seqs[uid] = raw_seq
+	records = {}
+	for raw_seq in raw_seqs:
+		for record_id in _record_ids(raw_seq, format):
+			records.setdefault(record_id, raw_seq)
+	result = [(uid, records[uid]) for uid in uids if uid in records]
+	for uid in uids:
+		if uid not in records:
+			result += _fetch_batch(session, rate_limiter, [uid], format, download_url)
+	return result
 
-	return raw_seq
 
+def download_raw_sequences(uids, format='gb', batch_size=None, max_concurrent=None,
+						   max_requests_per_second=None, download_url=None):
+	"""
+	DESCRIPTION:
+	Downloads the records of the given uids, several of them per efetch request and several
+	requests at the same time
+	:param uids: [list] uids of the records to download
+	:param format: [string] format of the records, e.g. 'gb'
+	:param batch_size: [int] number of uids per request, defaults to config.NCBI_BATCH_SIZE
+	:param max_concurrent: [int] number of simultaneous requests, defaults to config.NCBI_MAX_CONCURRENT
+	:param max_requests_per_second: [float] rate limit, defaults to config.NCBI_MAX_REQUESTS_PER_SECOND
+	:param download_url: [string] url template with {uids} and {format} fields,
+	defaults to ENTREZ_NUCL_DOWNLOAD_URL
+	:return: [generator] yields (uid, raw_seq) tuples as the batches complete
+	"""
+	download_url = download_url or ENTREZ_NUCL_DOWNLOAD_URL
+	batch_size = batch_size or config.NCBI_BATCH_SIZE
+	max_concurrent = max_concurrent or config.NCBI_MAX_CONCURRENT
+	if max_requests_per_second is None:
+		max_requests_per_second = config.NCBI_MAX_REQUESTS_PER_SECOND
 
-def get_all_covid_nucleotide_seqs(cache_dir=None):
-	if cache_dir is not None:
-		cache_dir.mkdir(exist_ok=True)
+	batches = iter([uids[i:i + batch_size] for i in range(0, len(uids), batch_size)])
+
+	session = _make_session(max_concurrent)
+	rate_limiter = _RateLimiter(max_requests_per_second)
+	with session, ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+		# only a couple of batches per worker are in flight at any time, so the memory used
+		# doesn't depend on the number of uids
+		pending = set()
+		try:
+			while True:
+				for batch in batches:
+					pending.add(executor.submit(_fetch_batch, session, rate_limiter, batch, format, download_url))
+					if len(pending) >= 2 * max_concurrent:
+						break
+				if not pending:
+					break
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					yield from future.result()
+		finally:
+			for future in pending:
+				future.cancel()
+
+
+class RawSequenceCache:
+	"""
+	DESCRIPTION:
+	Cache of raw records by uid backed by a shelve that is opened once and kept open
+	until close() is called. Writes are buffered and written in batches.
+	"""
+
+	def __init__(self, cache_dir=None, write_batch_size=None):
+		"""
+		DESCRIPTION:
+		Constructor of the RawSequenceCache class
+		:param cache_dir: [pathlib] directory of the cache, None for a cache kept in memory only
+		:param write_batch_size: [int] number of buffered writes that triggers a flush,
+		defaults to config.RAW_SEQUENCE_CACHE_WRITE_BATCH
+		:return: [RawSequenceCache] the created object
+		"""
+		if cache_dir is None:
+			self._shelf = {}
+		else:
+			cache_dir.mkdir(parents=True, exist_ok=True)
+			self._shelf = shelve.open(str(cache_dir / config.RAW_SEQUENCE_SHELVE_FNAME))
+		self._pending = {}
+		self.write_batch_size = write_batch_size or config.RAW_SEQUENCE_CACHE_WRITE_BATCH
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __contains__(self, uid):
+		return uid in self._pending or uid in self._shelf
+
+	def __getitem__(self, uid):
+		if uid in self._pending:
+			return self._pending[uid]
+		return self._shelf[uid]
+
+	def get(self, uid, default=None):
+		try:
+			return self[uid]
+		except KeyError:
+			return default
+
+	def missing(self, uids):
+		"""
+		DESCRIPTION:
+		Finds the uids that are not in the cache with a single pass over its keys
+		:param uids: [list] uids to check
+		:return: [list] the uids not in the cache, in the given order
+		"""
+		cached_uids = set(self._shelf.keys())
+		cached_uids.update(self._pending)
+		return [uid for uid in uids if uid not in cached_uids]
+
+	def put(self, uid, raw_seq):
+		"""
+		DESCRIPTION:
+		Adds a record to the cache. It's written to disk on the next flush
+		:param uid: [string] uid of the record
+		:param raw_seq: [string] the raw record
+		"""
+		self._pending[uid] = raw_seq
+		if len(self._pending) >= self.write_batch_size:
+			self.flush()
+
+	def flush(self):
+		"""
+		DESCRIPTION:
+		Writes the buffered records to disk
+		"""
+		if self._shelf is None:
+			return
+		self._shelf.update(self._pending)
+		self._pending.clear()
+		if hasattr(self._shelf, 'sync'):
+			self._shelf.sync()
+
+	def close(self):
+		"""
+		DESCRIPTION:
+		Flushes the buffered records and closes the shelve. The cache can't be used afterwards
+		"""
+		if self._shelf is None:
+			return
+		self.flush()
+		if hasattr(self._shelf, 'close'):
+			self._shelf.close()
+		self._shelf = None
+
+
+def _parse_raw_record(raw_seq, timings):
+	"""
+	DESCRIPTION:
+	Parses a raw GenBank record, adding its time to timings, see profiling.add
+	:param raw_seq: [string] the raw record
+	:param timings: [dictionary] wall, cpu, records and n_bytes of the records parsed so far
+	:return: [SeqRecord] the record
+	"""
+	from Bio import SeqIO
+
+	wall_start = time.perf_counter()
+	cpu_start = time.thread_time()
+	fhand = io.StringIO(raw_seq)
+	record = list(SeqIO.parse(fhand, 'gb'))[0]
+	timings['wall'] += time.perf_counter() - wall_start
+	timings['cpu'] += time.thread_time() - cpu_start
+	timings['records'] += 1
+	timings['n_bytes'] += len(raw_seq)
+	return record
 
-	response = requests.get(ENTREZ_COVID_SEARCH_URL)
+
+def iter_nucleotide_seqs(uids, cache_dir=None, format='gb'):
+	"""
+	DESCRIPTION:
+	Yields the records of the given uids one at a time, first the ones already in the cache
+	and then the ones that have to be downloaded, as their batches arrive
+	:param uids: [list] uids of the records
+	:param cache_dir: [pathlib] directory of the cache, None to download everything
+	:param format: [string] format of the records, e.g. 'gb'
+	:return: [generator] yields SeqRecord objects
+	"""
+	store = None if cache_dir is None else RecordStore(cache_dir / config.RECORD_STORE_DIRNAME)
+	n_done = 0
+	# the parsing is timed record by record and added to the profile once, see profiling.add
+	timings = {'wall': 0.0, 'cpu': 0.0, 'records': 0, 'n_bytes': 0}
+	try:
+		with RawSequenceCache(cache_dir) as cache:
+			missing_uids = cache.missing([uid for uid in uids if store is None or uid not in store])
+			missing_set = set(missing_uids)
+			for uid in uids:
+				if uid in missing_set:
+					continue
+				record = None if store is None else store.get_record(uid)
+				if record is None:
+					record = _parse_raw_record(cache[uid], timings)
+					if store is not None:
+						store.add(uid, record)
+				n_done += 1
+				update_progress(n_done / len(uids))
+				yield record
+
+			if missing_uids:
+				print(f'downloading {len(missing_uids)} records')
+			for uid, raw_seq in download_raw_sequences(missing_uids, format=format):
+				cache.put(uid, raw_seq)
+				record = _parse_raw_record(raw_seq, timings)
+				if store is not None:
+					store.add(uid, record)
+				n_done += 1
+				update_progress(n_done / len(uids))
+				yield record
+	finally:
+		if timings['records']:
+			profiling.add('genbank.parse', **timings)
+		if store is not None:
+			store.close()
+
+
+class SeqRecordStream:
+	"""
+	DESCRIPTION:
+	Re-iterable sequence of the records of a list of uids. Every iteration streams the records
+	with iter_nucleotide_seqs, so they are never all in memory at the same time. Only the first
+	iteration downloads, later ones read from the cache (if there is one).
+	"""
+
+	def __init__(self, uids, cache_dir=None):
+		self.uids = uids
+		self.cache_dir = cache_dir
+
+	def __iter__(self):
+		return iter_nucleotide_seqs(self.uids, cache_dir=self.cache_dir, format='gb')
+
+	def __len__(self):
+		return len(self.uids)
+
+	def subset(self, uids):
+		"""
+		DESCRIPTION:
+		Stream of some of the records, with the same cache
+		:param uids: [list] uids of the records
+		:return: [SeqRecordStream] the stream
+		"""
+		return SeqRecordStream(uids, cache_dir=self.cache_dir)
+
+
+def _esearch(session, term, retstart, retmax, webenv=None, query_key=None, search_url=None):
+	"""
+	DESCRIPTION:
+	Sends one esearch request, keeping the result in NCBI's history server. The uids are
+	accession.version ids, so the downloaded records can be matched to them
+	:param session: [requests.Session] session used for the request
+	:param term: [string] the query
+	:param retstart: [int] position of the first uid to return
+	:param retmax: [int] number of uids to return
+	:param webenv: [string] history of a previous search to page through, with query_key
+	:param query_key: [string] key of the previous search in its history
+	:param search_url: [string] url of esearch, defaults to ENTREZ_SEARCH_URL
+	:return: [dictionary] the esearchresult of the response
+	"""
+	import requests
+
+	params = {'db': 'nucleotide', 'term': term, 'retmode': 'json', 'usehistory': 'y', 'idtype': 'acc',
+			  'retstart': retstart, 'retmax': retmax}
+	if webenv is not None:
+		params.update({'WebEnv': webenv, 'query_key': query_key})
+	try:
+		response = session.get(search_url or ENTREZ_SEARCH_URL, params=params)
+	except requests.RequestException as error:
+		raise RuntimeError(f'esearch failed: {error}') from error
 	if response.status_code != 200:
 		msg = 'Something went wrong searching for the SARS-CoV-2 nucleotide sequences. '
-		msg += 'response status: {response.status_code}'
+		msg += f'response status: {response.status_code}'
 		raise RuntimeError(msg)
 
-	ncbi_search_result = response.json()['esearchresult']
+	result = response.json()['esearchresult']
+	if 'ERROR' in result:
+		raise RuntimeError(f'esearch failed: {result["ERROR"]}')
+	return result
 
-	n_seqs_found = int(ncbi_search_result['count'])
 
-	print('found ' + str(n_seqs_found) + ' sequences')
+class SearchCheckpoint:
+	"""
+	DESCRIPTION:
+	On-disk state of a paged search: the query, its history on NCBI's side, its count and the
+	uids of the pages already retrieved, so that an interrupted search continues where it stopped
+	"""
 
-	uids = ncbi_search_result['idlist']
+	def __init__(self, checkpoint_dir, term, page_size):
+		"""
+		DESCRIPTION:
+		Constructor of the SearchCheckpoint class, loads the checkpoint of the same search if there is one
+		:param checkpoint_dir: [pathlib] directory of the checkpoint, None for a checkpoint kept in memory only
+		:param term: [string] the query
+		:param page_size: [int] number of uids per page
+		:return: [SearchCheckpoint] the created object
+		"""
+		self.checkpoint_dir = checkpoint_dir
+		self.term = term
+		self.page_size = page_size
+		self.search = None
+		self.pages = {}
+		if checkpoint_dir is None:
+			return
 
-	if n_seqs_found > len(uids):
-		msg = 'Some sequences were not retrieved, you should implement the search with usehistory'
-		raise NotImplementedError(msg)
+		checkpoint_dir.mkdir(parents=True, exist_ok=True)
+		try:
+			with open(checkpoint_dir / 'search.json', 'r') as file:
+				search = json.load(file)
+		except (FileNotFoundError, ValueError):
+			search = None
+		if search is None or search['term'] != term or search['page_size'] != page_size:
+			self.clear()
+			return
 
-	seq_records = []
-	for uid in uids:
-		raw_seq = _get_raw_sequence(uid, cache_dir=cache_dir, format='gb')
-		#print('retrieving record ' + str(len(seq_records)+1) + '/' + str(n_seqs_found))
-		update_progress((len(seq_records)+1)/n_seqs_found)
-		fhand = io.StringIO(raw_seq)
-		record = list(SeqIO.parse(fhand, 'gb'))[0]
-		seq_records.append(record)  # used to be .append(seq_records) resulting in the list containing itself an exponetial number of times...
+		self.search = search
+		for page in iter_json_lines(checkpoint_dir / 'pages.jsonl'):
+			self.pages[page['page']] = page['uids']
+
+	def start(self, count, webenv, query_key):
+		"""
+		DESCRIPTION:
+		Records the history of a new search. The pages already retrieved are kept if the count is the same
+		:param count: [int] number of uids found
+		:param webenv: [string] history of the search
+		:param query_key: [string] key of the search in its history
+		"""
+		if self.search is not None and self.search['count'] != count:
+			self.clear()
+		self.search = {'term': self.term, 'page_size': self.page_size, 'count': count,
+					   'webenv': webenv, 'query_key': query_key}
+		if self.checkpoint_dir is not None:
+			with open(self.checkpoint_dir / 'search.json', 'w') as file:
+				file.write(json.dumps(self.search))
+
+	def add_page(self, page, uids):
+		"""
+		DESCRIPTION:
+		Records the uids of a page
+		:param page: [int] number of the page
+		:param uids: [list] its uids
+		"""
+		self.pages[page] = uids
+		if self.checkpoint_dir is not None:
+			with open(self.checkpoint_dir / 'pages.jsonl', 'a') as file:
+				file.write(json.dumps({'page': page, 'uids': uids}) + '\n')
+
+	def clear(self):
+		"""
+		DESCRIPTION:
+		Forgets the search, e.g. once it's complete
+		"""
+		self.search = None
+		self.pages = {}
+		if self.checkpoint_dir is not None:
+			for fname in ['search.json', 'pages.jsonl']:
+				if (self.checkpoint_dir / fname).exists():
+					os.remove(self.checkpoint_dir / fname)
+
+
+def search_uids(term, cache_dir=None, page_size=None, search_url=None):
+	"""
+	DESCRIPTION:
+	Retrieves all the uids of a query, however many they are. The search is kept in NCBI's history
+	server (usehistory/WebEnv) and its uids are retrieved in pages, every page is saved to a checkpoint
+	in the cache, so an interrupted search continues with the pages left. If a page fails, e.g. because
+	the history expired or the connection dropped, the query is searched again and the pages already retrieved are kept if the
+	count didn't change. After config.NCBI_MAX_RETRIES failures in a row, with growing delays, the error
+	is raised and the checkpoint is kept for the next call
+	:param term: [string] the query
+	:param cache_dir: [pathlib] directory of the cache where the checkpoint is kept, None for no checkpoint
+	:param page_size: [int] number of uids per request, defaults to config.NCBI_SEARCH_PAGE_SIZE
+	:param search_url: [string] url of esearch, defaults to ENTREZ_SEARCH_URL
+	:return: [list] the uids (accession.version ids), without repetitions
+	"""
+	page_size = page_size or config.NCBI_SEARCH_PAGE_SIZE
+	checkpoint = SearchCheckpoint(None if cache_dir is None else cache_dir / SEARCH_CHECKPOINT_DIRNAME,
+								  term, page_size)
+	if checkpoint.pages:
+		print(f'resuming search, {len(checkpoint.pages)} pages already retrieved')
+
+	rate_limiter = _RateLimiter(config.NCBI_MAX_REQUESTS_PER_SECOND)
+	session = _make_session(1)
+
+	def new_search():
+		rate_limiter.wait()
+		result = _esearch(session, term, 0, page_size, search_url=search_url)
+		checkpoint.start(int(result['count']), result['webenv'], result['querykey'])
+		if 0 not in checkpoint.pages:
+			checkpoint.add_page(0, result['idlist'])
+
+	with session:
+		if checkpoint.search is None:
+			new_search()
+		n_pages = -(-checkpoint.search['count'] // page_size)
+		page = 0
+		failures = 0
+		search_again = False
+		while page < n_pages:
+			if page in checkpoint.pages and not search_again:
+				page += 1
+				continue
+			try:
+				if search_again:
+					new_search()
+					n_pages = -(-checkpoint.search['count'] // page_size)
+					page = 0
+					search_again = False
+					continue
+				rate_limiter.wait()
+				result = _esearch(session, term, page * page_size, page_size, webenv=checkpoint.search['webenv'],
+								  query_key=checkpoint.search['query_key'], search_url=search_url)
+			except RuntimeError as error:
+				failures += 1
+				if failures > config.NCBI_MAX_RETRIES:
+					raise RuntimeError(f'{error}, search stopped after {config.NCBI_MAX_RETRIES} retries, '
+									   f'it continues from its checkpoint in the next run') from error
+				print(f'{error}, searching again')
+				rate_limiter.backoff(config.NCBI_RETRY_BACKOFF * 2 ** (failures - 1))
+				search_again = True
+				continue
+			checkpoint.add_page(page, result['idlist'])
+			print(f'search: {len(checkpoint.pages)} of {n_pages} pages')
+			page += 1
+			failures = 0
+
+	uids = list(dict.fromkeys(uid for page in sorted(checkpoint.pages) for uid in checkpoint.pages[page]))
+	if len(uids) < checkpoint.search['count']:
+		print(f'warning: {checkpoint.search["count"]} sequences found but {len(uids)} uids retrieved')
+	checkpoint.clear()
+	return uids
+
+
+def _load_search_state(cache_dir):
+	try:
+		with open(cache_dir / SEARCH_STATE_FNAME, 'r') as file:
+			return json.load(file)
+	except FileNotFoundError:
+		return {}
+
+
+def _pending_uids(cache_dir):
+	"""
+	DESCRIPTION:
+	Uids of the previous search whose records aren't in the cache yet, e.g. because its download was interrupted
+	"""
+	try:
+		with open(cache_dir / SEARCH_UIDS_FNAME, 'r') as file:
+			uids = file.read().split()
+	except FileNotFoundError:
+		return []
+
+	with RecordStore(cache_dir / config.RECORD_STORE_DIRNAME) as store, RawSequenceCache(cache_dir) as cache:
+		return cache.missing([uid for uid in uids if uid not in store])
+
+
+def get_all_covid_nucleotide_seqs(cache_dir=None, stream=False, since=None):
+	"""
+	DESCRIPTION:
+	Searches all the SARS-CoV-2 nucleotide sequences and retrieves their records
+	:param cache_dir: [pathlib] directory of the cache, None to download everything
+	:param stream: [boolean] whether to return the records as a SeqRecordStream instead of a list
+	:param since: [string] only the sequences published (config.NCBI_DATE_FIELD) from this date on,
+	'YYYY/MM/DD'. 'last' for the ones since the last search saved in the cache, plus the ones of that
+	search whose records weren't retrieved. None for all of them
+	:return: [dictionary] request_timestamp and seqrecords
+	"""
+	search_date = time.strftime('%Y/%m/%d')
+	pending_uids = []
+	if since == 'last':
+		since = None if cache_dir is None else _load_search_state(cache_dir).get('last_search_date')
+		if since is not None:
+			pending_uids = _pending_uids(cache_dir)
+
+	term = COVID_SEARCH_TERM
+	if since is not None:
+		print(f'searching the sequences since {since}')
+		term += f' AND ("{since}"[{config.NCBI_DATE_FIELD}] : "3000"[{config.NCBI_DATE_FIELD}])'
+	with profiling.stage('ncbi.search') as counters:
+		uids = search_uids(term, cache_dir=cache_dir)
+		counters['records'] = len(uids)
+
+	print('found ' + str(len(uids)) + ' sequences')
+	uids = list(dict.fromkeys(pending_uids + uids))
+
+	if cache_dir is not None:
+		with open(cache_dir / SEARCH_UIDS_FNAME, 'w') as file:
+			file.write('\n'.join(uids))
+		with open(cache_dir / SEARCH_STATE_FNAME, 'w') as file:
+			file.write(json.dumps({'last_search_date': search_date, 'term': COVID_SEARCH_TERM}))
+
+	seq_records = SeqRecordStream(uids, cache_dir=cache_dir)
+	if not stream:
+		seq_records = list(seq_records)
 
 	search_result = {'request_timestamp': time.time(),
 					 'seqrecords': seq_records
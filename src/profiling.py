@@ -0,0 +1,217 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import config
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peaks of RSS are left out of the report there
+    resource = None
+
+REPORT_PATTERN = 'profile_{timestamp}.json'
+
+_lock = threading.Lock()
+_stages = {}
+_hot = {}
+_started = time.time()
+_hot_running = threading.Lock()
+
+
+def _io_counters():
+    """
+    DESCRIPTION:
+    Reads the bytes read and written by the process so far, files and sockets included
+    :return: [int, int] bytes read and written, None, None where /proc isn't available
+    """
+    try:
+        with open('/proc/self/io', 'r') as file:
+            counters = dict(line.split(':') for line in file)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _children_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def _peak_rss(totals):
+    """
+    DESCRIPTION:
+    Sets the peak RSS of the process and of the external programs in totals, where it can be read
+    """
+    if resource is None:
+        return
+    for key, who in [('peak_rss_kb', resource.RUSAGE_SELF), ('children_peak_rss_kb', resource.RUSAGE_CHILDREN)]:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(who).ru_maxrss
+        totals[key] = peak // 1024 if sys.platform == 'darwin' else peak
+
+
+@contextmanager
+def stage(name, records=0):
+    """
+    DESCRIPTION:
+    Measures a stage of the pipeline: wall time, CPU time of the thread and of the external programs
+    that finished during the stage, peak RSS of the process and of the external programs, and bytes
+    read and written by the process. Runs of a stage with the same name are added up in the report.
+    Stages can be nested and can run on several threads at the same time, the process wide figures
+    (bytes, peak RSS, external programs) of overlapping stages then overlap too
+    :param name: [string] name of the stage, e.g. 'ncbi.fetch'
+    :param records: [int] number of records the stage processes, if known in advance
+    :return: [dictionary] counters of the run the stage can increase: 'records' and 'bytes', e.g. the
+    size of a download
+    """
+    counters = {'records': records, 'bytes': 0}
+    read_start, written_start = _io_counters()
+    children_start = _children_cpu()
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start + _children_cpu() - children_start
+        read_end, written_end = _io_counters()
+        with _lock:
+            totals = _add(name, wall, cpu, counters['records'], counters['bytes'])
+            if read_start is not None:
+                totals['bytes_read'] += read_end - read_start
+                totals['bytes_written'] += written_end - written_start
+            _peak_rss(totals)
+
+
+def _add(name, wall, cpu, records, n_bytes):
+    totals = _stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'records': 0, 'bytes': 0,
+                                       'bytes_read': 0, 'bytes_written': 0})
+    totals['calls'] += 1
+    totals['wall'] += wall
+    totals['cpu'] += cpu
+    totals['records'] += records
+    totals['bytes'] += n_bytes
+    return totals
+
+
+def add(name, wall, cpu, records=0, n_bytes=0):
+    """
+    DESCRIPTION:
+    Adds a run timed by the caller to a stage, for work done a little at a time in a loop that does
+    other things in between, e.g. parsing the records of a download as they arrive, where a stage per
+    step would cost about as much as the step. Only the times, records and bytes are added
+    :param name: [string] name of the stage
+    :param wall: [float] wall time of the run, in seconds
+    :param cpu: [float] CPU time of the run, in seconds
+    :param records: [int] number of records processed
+    :param n_bytes: [int] number of bytes processed
+    """
+    with _lock:
+        _add(name, wall, cpu, records, n_bytes)
+
+
+def hot(function):
+    """
+    DESCRIPTION:
+    Decorator for the functions that can be profiled in detail. If the name of the function is in
+    config.PROFILE_HOT_FUNCTIONS, every call runs under cProfile and tracemalloc and the report gets
+    its slowest callees and its peak of traced memory. Otherwise the function is only timed as a stage
+    :param function: [function] the function
+    :return: [function] the decorated function
+    """
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # cProfile can only profile one function at a time
+        if function.__name__ not in config.PROFILE_HOT_FUNCTIONS or not _hot_running.acquire(blocking=False):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        try:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                # Python 3.9+, before it the peak of a tracing started elsewhere includes earlier allocations
+                tracemalloc.reset_peak()
+            profile = cProfile.Profile()
+            wall_start = time.perf_counter()
+            try:
+                with stage(name):
+                    return profile.runcall(function, *args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall_start
+                peak = tracemalloc.get_traced_memory()[1]
+                if not tracing:
+                    tracemalloc.stop()
+                _add_hot_run(name, profile, wall, peak)
+        finally:
+            _hot_running.release()
+
+    return wrapper
+
+
+def _add_hot_run(name, profile, wall, peak):
+    stats = pstats.Stats(profile)
+    callees = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    top = [{'function': f'{filename}:{line}({function_name})', 'calls': n_calls, 'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6)}
+           for (filename, line, function_name), (_, n_calls, tottime, cumtime, _) in callees[:config.PROFILE_TOP_FUNCTIONS]]
+    with _lock:
+        _hot.setdefault(name, []).append({'wall': wall, 'peak_traced_bytes': peak, 'top': top})
+
+
+def report():
+    """
+    DESCRIPTION:
+    Builds the report of the stages measured since the start of the run
+    :return: [dictionary] the report
+    """
+    with _lock:
+        stages = {name: dict(totals) for name, totals in _stages.items()}
+        hot_runs = {name: list(runs) for name, runs in _hot.items()}
+    for totals in stages.values():
+        has_rate = totals['records'] and totals['wall'] > 0
+        totals['records_per_second'] = totals['records'] / totals['wall'] if has_rate else None
+
+    run = {'argv': sys.argv,
+           'started': _started,
+           'finished': time.time(),
+           'wall': time.time() - _started,
+           'cpu': time.process_time() + _children_cpu()}
+    _peak_rss(run)
+    return dict(run, stages=stages, hot=hot_runs)
+
+
+def write_report(path=None):
+    """
+    DESCRIPTION:
+    Writes the report of the run as json
+    :param path: [pathlib] the file, defaults to profile_{timestamp}.json in config.BASE_DIR
+    :return: [pathlib] the file written
+    """
+    path = path or config.BASE_DIR / REPORT_PATTERN.format(timestamp=time.strftime('%Y%m%d%H%M%S'))
+    with open(path, 'w') as file:
+        file.write(json.dumps(report(), indent=1))
+    return path
+
+
+def reset():
+    """
+    DESCRIPTION:
+    Forgets the stages measured so far, e.g. to profile several runs in the same process
+    """
+    global _started
+    with _lock:
+        _stages.clear()
+        _hot.clear()
+        _started = time.time()
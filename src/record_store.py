@@ -0,0 +1,287 @@
+import json
+import os
+import numpy as np
+from catalog import CATALOG_FNAME, Catalog, catalog_entry
+
+# symbols that can be stored, pure ACGT sequences use the first table with 2 bits per base,
+# everything else the second one with 4 bits per base
+ALPHABET_2BIT = 'ACGT'
+ALPHABET_4BIT = '-ACGTRYSWKMBDHVN'
+
+SEQUENCES_FNAME = 'sequences.bin'
+METADATA_FNAME = 'metadata.jsonl'
+
+
+def _encoding_table(alphabet):
+    table = np.full(256, 255, dtype=np.uint8)
+    for code, symbol in enumerate(alphabet):
+        table[ord(symbol)] = code
+    return table
+
+
+_ENCODE_2BIT = _encoding_table(ALPHABET_2BIT)
+_ENCODE_4BIT = _encoding_table(ALPHABET_4BIT)
+_DECODE = {2: np.frombuffer(ALPHABET_2BIT.encode(), dtype=np.uint8),
+           4: np.frombuffer(ALPHABET_4BIT.encode(), dtype=np.uint8)}
+
+
+def pack_sequence(sequence):
+    """
+    DESCRIPTION:
+    Packs a nucleotide sequence with 2 bits per base if it only contains ACGT, with 4 bits
+    per base otherwise
+    :param sequence: [string] the sequence, upper case
+    :return: [bytes, int] the packed sequence and the number of bits per base, or
+    (None, None) if the sequence contains symbols that can't be packed
+    """
+    symbols = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+    codes = _ENCODE_2BIT[symbols]
+    bits = 2
+    if (codes == 255).any():
+        codes = _ENCODE_4BIT[symbols]
+        bits = 4
+        if (codes == 255).any():
+            return None, None
+
+    per_byte = 8 // bits
+    padded = np.zeros(-(-len(codes) // per_byte) * per_byte, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    padded = padded.reshape(-1, per_byte)
+    packed = np.zeros(len(padded), dtype=np.uint8)
+    for k in range(per_byte):
+        packed |= padded[:, k] << (8 - bits * (k + 1))
+    return packed.tobytes(), bits
+
+
+def unpack_sequence(packed, length, bits):
+    """
+    DESCRIPTION:
+    Inverse of pack_sequence
+    :param packed: [bytes or np.ndarray] the packed sequence
+    :param length: [int] number of bases of the sequence
+    :param bits: [int] number of bits per base, 2 or 4
+    :return: [string] the sequence
+    """
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    per_byte = 8 // bits
+    shifts = np.array([8 - bits * (k + 1) for k in range(per_byte)], dtype=np.uint8)
+    codes = ((packed[:, None] >> shifts) & ((1 << bits) - 1)).ravel()[:length]
+    return _DECODE[bits][codes].tobytes().decode('ascii')
+
+
+def iter_json_lines(path):
+    """
+    DESCRIPTION:
+    Reads a json lines file that is appended to. The partial last line left by an interrupted run is
+    cut off the file first, so the lines appended afterwards start on a line of their own, and lines
+    that can't be parsed are skipped
+    :param path: [pathlib] the file
+    :return: [generator] yields the parsed lines, nothing if the file doesn't exist
+    """
+    try:
+        file = open(path, 'rb+')
+    except FileNotFoundError:
+        return
+    with file:
+        size = file.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            file.truncate(end)
+
+        file.seek(0)
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def record_metadata(record):
+    """
+    DESCRIPTION:
+    Extracts the metadata the pipeline uses from a parsed GenBank record
+    :param record: [SeqRecord] the record
+    :return: [dictionary] id, name, description, country and collection date of the record
+    """
+    qualifiers = {}
+    for feature in record.features:
+        if feature.type == 'source':
+            qualifiers = feature.qualifiers
+            break
+
+    return {'id': record.id,
+            'name': record.name,
+            'description': record.description,
+            'country': qualifiers.get('country', [None])[0],
+            'collection_date': qualifiers.get('collection_date', [None])[0]}
+
+
+class RecordStore:
+    """
+    DESCRIPTION:
+    On-disk store of the records already parsed from GenBank. The sequences are kept packed
+    in a single file that is memory mapped on first use, their metadata in a json lines file
+    and in the catalog, the SQLite table records are selected with.
+    Records are appended as they arrive, so the store can be filled incrementally. They are looked up
+    by their uid or by their accession.version, the uid of the searches that ask for accessions, so
+    the records stored under their GI aren't downloaded again.
+    """
+
+    def __init__(self, store_dir, catalog=True):
+        """
+        DESCRIPTION:
+        Constructor of the RecordStore class, loads the metadata of the stored records and adds
+        the ones missing in the catalog, e.g. the records stored before there was a catalog
+        :param store_dir: [pathlib] directory of the store, created if it doesn't exist
+        :param catalog: [boolean] whether to keep the catalog of the store up to date
+        :return: [RecordStore] the created object
+        """
+        store_dir.mkdir(parents=True, exist_ok=True)
+        self.sequences_path = store_dir / SEQUENCES_FNAME
+        self.metadata_path = store_dir / METADATA_FNAME
+        self.metadata = {}
+        # uid of the record of every accession.version
+        self._uids = {}
+        self._sequences = None
+        self._sequences_file = None
+        self._metadata_file = None
+        self._load_metadata()
+        self.catalog = None
+        if catalog:
+            self.catalog = Catalog(store_dir / CATALOG_FNAME)
+            self._complete_catalog()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, uid):
+        return uid in self.metadata or uid in self._uids
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def _load_metadata(self):
+        size = self.sequences_path.stat().st_size if self.sequences_path.exists() else 0
+        for entry in iter_json_lines(self.metadata_path):
+            if entry['offset'] + entry['n_bytes'] <= size:
+                self.metadata[entry['uid']] = entry
+                self._uids[entry['id']] = entry['uid']
+
+    def _complete_catalog(self):
+        if len(self.catalog) >= len(self.metadata):
+            return
+        catalogued = self.catalog.ids()
+        # sequences packed with 2 bits per base have no N, so only the others are read
+        self.catalog.add_many(catalog_entry(uid, entry, '' if entry['bits'] == 2 else self.get_sequence(uid))
+                              for uid, entry in self.metadata.items() if uid not in catalogued)
+        self.catalog.flush()
+
+    def _sequence_bytes(self, entry):
+        # the memory map only covers the file as it was when it was mapped, records added since
+        # then are mapped again on their first read
+        if self._sequences is None or entry['offset'] + entry['n_bytes'] > len(self._sequences):
+            if self._sequences_file is not None:
+                self._sequences_file.flush()
+            self._sequences = np.memmap(self.sequences_path, dtype=np.uint8, mode='r')
+        return self._sequences[entry['offset']:entry['offset'] + entry['n_bytes']]
+
+    def add(self, uid, record):
+        """
+        DESCRIPTION:
+        Adds a parsed record to the store
+        :param uid: [string] uid of the record
+        :param record: [SeqRecord] the record as parsed from GenBank
+        :return: [boolean] whether the record could be stored
+        """
+        sequence = str(record.seq)
+        packed, bits = pack_sequence(sequence)
+        if packed is None:
+            return False
+
+        if self._sequences_file is None:
+            self._sequences_file = open(self.sequences_path, 'ab')
+            self._metadata_file = open(self.metadata_path, 'a')
+
+        entry = record_metadata(record)
+        entry.update({'uid': uid, 'length': len(sequence), 'bits': bits,
+                      'offset': self._sequences_file.tell(), 'n_bytes': len(packed),
+                      'n_count': 0 if bits == 2 else sequence.count('N')})
+        self._sequences_file.write(packed)
+        self._metadata_file.write(json.dumps(entry) + '\n')
+        self.metadata[uid] = entry
+        self._uids[entry['id']] = uid
+        if self.catalog is not None:
+            self.catalog.add(catalog_entry(uid, entry, sequence))
+        return True
+
+    def _entry(self, uid):
+        entry = self.metadata.get(uid)
+        if entry is None and uid in self._uids:
+            entry = self.metadata[self._uids[uid]]
+        return entry
+
+    def get_sequence(self, uid):
+        """
+        DESCRIPTION:
+        Returns the sequence of a stored record
+        :param uid: [string] uid or accession.version of the record
+        :return: [string] the sequence
+        """
+        entry = self._entry(uid)
+        if entry is None:
+            raise KeyError(uid)
+        return unpack_sequence(self._sequence_bytes(entry), entry['length'], entry['bits'])
+
+    def get_record(self, uid):
+        """
+        DESCRIPTION:
+        Builds a SeqRecord with the id, description and sequence of a stored record
+        :param uid: [string] uid or accession.version of the record
+        :return: [SeqRecord] the record or None if it isn't in the store
+        """
+        # Biopython is only imported by the processes that build records
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+
+        entry = self._entry(uid)
+        if entry is None:
+            return None
+        return SeqRecord(Seq(self.get_sequence(uid)), id=entry['id'], name=entry['name'],
+                         description=entry['description'])
+
+    def flush(self):
+        """
+        DESCRIPTION:
+        Writes the added records to disk
+        """
+        if self._sequences_file is not None:
+            self._sequences_file.flush()
+            self._metadata_file.flush()
+        if self.catalog is not None:
+            self.catalog.flush()
+
+    def close(self):
+        """
+        DESCRIPTION:
+        Flushes and closes the files of the store
+        """
+        if self._sequences_file is not None:
+            self._sequences_file.close()
+            self._metadata_file.close()
+            self._sequences_file = None
+            self._metadata_file = None
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+        self._sequences = None
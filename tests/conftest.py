@@ -0,0 +1,66 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import config
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """
+    DESCRIPTION:
+    Moves the data folders to a temporary folder. The settings a test changes are restored after it
+    :return: [pathlib] the base folder of the data
+    """
+    for name in [name for name in dir(config) if name.isupper()]:
+        monkeypatch.setattr(config, name, getattr(config, name))
+    config.configure(BASE_DIR=tmp_path / 'covid_phylo_data')
+    config.ensure_dirs()
+    return config.BASE_DIR
+
+
+@pytest.fixture(scope='session')
+def stub_executables(tmp_path_factory):
+    """
+    DESCRIPTION:
+    Writes the MAFFT and IQ-TREE stand-ins of the benchmark, see benchmark.write_stub_executables
+    :return: [pathlib, pathlib] the mafft and iqtree executables
+    """
+    import benchmark
+    return benchmark.write_stub_executables(tmp_path_factory.mktemp('bin'))
+
+
+@pytest.fixture
+def stub_tools(data_dir, stub_executables):
+    """
+    DESCRIPTION:
+    Makes the pipeline run the MAFFT and IQ-TREE stand-ins, with the data in a temporary folder
+    :return: [pathlib, pathlib] the mafft and iqtree executables
+    """
+    mafft, iqtree = stub_executables
+    config.configure(MAFFT_DIR=str(mafft), IQTREE_DIR=str(iqtree))
+    return stub_executables
+
+
+@pytest.fixture
+def entrez_stub(data_dir, monkeypatch):
+    """
+    DESCRIPTION:
+    Serves a small synthetic corpus in place of NCBI's E-utilities, see benchmark.start_entrez_stub
+    :return: [SyntheticCorpus, ThreadingHTTPServer] the corpus and the server
+    """
+    import benchmark
+    import ncbi
+    corpus = benchmark.SyntheticCorpus(dict(benchmark.DEFAULT_PARAMETERS, genomes=7, length=300, partial_rate=0.3))
+    server, base_url = benchmark.start_entrez_stub(corpus)
+    monkeypatch.setattr(ncbi, 'ENTREZ_SEARCH_URL', f'{base_url}/esearch')
+    monkeypatch.setattr(ncbi, 'ENTREZ_NUCL_DOWNLOAD_URL',
+                        f'{base_url}/efetch?db=nucleotide&id={{uids}}&retmode=text&rettype={{format}}')
+    monkeypatch.setattr(ncbi, 'update_progress', lambda progress: None)
+    config.configure(NCBI_MAX_REQUESTS_PER_SECOND=0, NCBI_RETRY_BACKOFF=0)
+    yield corpus, server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+import config
+import mafft
+import ncbi
+from align_tools import (SequenceAligner, _load_site_counts, analyse_alignment, make_alignments,
+                         open_alignment_matrix, site_symbol_counts, snp_distance_matrix, update_site_counts,
+                         write_alignment_matrix)
+from catalog import CatalogQuery
+
+
+def _records(n_records, length=60, seed=0):
+    rng = np.random.default_rng(seed)
+    return [SeqRecord(Seq(''.join(rng.choice(list('ACGT'), length))), id=f'MW{k:06d}.1',
+                      description=f'MW{k:06d}.1 complete genome') for k in range(n_records)]
+
+
+def test_interrupted_alignment_is_reused(stub_tools, monkeypatch):
+    records = _records(5)
+    make_alignments([SequenceAligner('complete', '1', records=records)], records)
+    # as if the run had stopped before writing the information file
+    (config.FASTA_DIR / SequenceAligner.information_pattern.format(tag='complete')).unlink()
+
+    def run_mafft(*args, **kwargs):
+        raise AssertionError('MAFFT ran again')
+    monkeypatch.setattr(mafft, 'run_mafft', run_mafft)
+    make_alignments([SequenceAligner('complete', '2', records=records)], records)
+    aligned = (config.FASTA_DIR / 'complete_1_aligned').read_text()
+    assert (config.FASTA_DIR / 'complete_2_aligned').read_text() == aligned
+    assert SequenceAligner.get_actual('complete') == ('2', [record.id for record in records])
+
+
+def _matrix(rows):
+    return np.frombuffer(''.join(rows).encode('ascii'), dtype=np.uint8).reshape(len(rows), -1)
+
+
+def test_site_counts_keep_the_symbols_that_appear(data_dir):
+    rng = np.random.default_rng(1)
+    rows = [''.join(rng.choice(list('acgt-n'), 30)) for _ in range(10)]
+    first_file = config.FASTA_DIR / 'complete_1_aligned'
+    first_file.write_text(''.join(f'>S{k}\n{row}\n' for k, row in enumerate(rows[:6])))
+    update_site_counts('complete', '1', first_file)
+    second_file = config.FASTA_DIR / 'complete_2_aligned'
+    second_file.write_text(''.join(f'>S{k}\n{row}\n' for k, row in enumerate(rows)))
+    counts = update_site_counts('complete', '2', second_file, previous_file_id='1',
+                                new_ids={f'S{k}' for k in range(6, 10)})
+
+    expected = site_symbol_counts(_matrix(rows))
+    assert (counts.to_array() == expected).all()
+    assert counts.counts.dtype == np.uint32 and list(counts.symbols) == sorted(b'acgtn-')
+    saved, info = _load_site_counts('complete')
+    assert (saved.to_array() == expected).all() and info['n_rows'] == 10
+
+
+def test_stored_records_left_unaligned_are_aligned_in_the_next_run(entrez_stub, stub_tools):
+    corpus, _ = entrez_stub
+    mafft_executable = config.MAFFT_DIR
+    data = ncbi.get_all_covid_nucleotide_seqs(cache_dir=config.CACHE_DIR, stream=True, since='last')
+    config.MAFFT_DIR = str(config.BASE_DIR / 'missing_mafft')
+    aligner = SequenceAligner('complete', '1', records=data['seqrecords'])
+    aligner.set_query(CatalogQuery(complete=True))
+    with pytest.raises(OSError):
+        make_alignments([aligner], data['seqrecords'])
+
+    # the next search finds nothing new, the records of the failed run are aligned anyway
+    config.MAFFT_DIR = mafft_executable
+    records = ncbi.SeqRecordStream([], cache_dir=config.CACHE_DIR)
+    aligner = SequenceAligner('complete', '2', records=records)
+    aligner.set_query(CatalogQuery(complete=True))
+    make_alignments([aligner], records)
+    complete = [f'{corpus.genome(uid)["accession"]}.1' for uid in corpus.uids if corpus.genome(uid)['complete']]
+    assert sorted(SequenceAligner.get_actual('complete')[1]) == complete
+
+
+def _analyse_alignment_per_site(aligned_records):
+    # the per site implementation analyse_alignment replaced, kept as reference
+    sequences = [record['sequence'] for record in aligned_records]
+    num_gaps = np.zeros(len(sequences[0]), dtype=int)
+    num_variation_det = np.zeros(len(sequences[0]), dtype=int)
+    num_variation_all = np.zeros(len(sequences[0]), dtype=int)
+    for site in range(len(sequences[0])):
+        num_nucleotides_det = {}
+        num_nucleotides_undet = {}
+        for seq in sequences:
+            c = seq[site]
+            if c == '-':
+                num_gaps[site] += 1
+            elif c == 'a' or c == 't' or c == 'g' or c == 'c':
+                num_nucleotides_det[c] = True
+            else:
+                num_nucleotides_undet[c] = True
+        num_variation_det[site] = len(num_nucleotides_det)
+        num_variation_all[site] = num_variation_det[site] + len(num_nucleotides_undet)
+    return num_gaps, num_variation_det, num_variation_all
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_analyse_alignment_matches_the_per_site_implementation(seed, data_dir):
+    rng = np.random.default_rng(seed)
+    symbols = list('acgt-nryACGTN*')
+    n_sequences, length = rng.integers(1, 40), rng.integers(1, 80)
+    weights = rng.dirichlet(np.ones(len(symbols)) * 0.3)
+    records = [{'id': f'S{k}', 'sequence': ''.join(rng.choice(symbols, length, p=weights))}
+               for k in range(n_sequences)]
+
+    expected = _analyse_alignment_per_site(records)
+    # small blocks to go through several blocks of columns
+    for block_size in [None, 1, int(rng.integers(2, 200))]:
+        result = analyse_alignment(records, block_size=block_size)
+        for values, expected_values in zip(result, expected):
+            assert values.tolist() == expected_values.tolist()
+
+    fasta_path = config.FASTA_DIR / 'complete_aligned'
+    fasta_path.write_text(''.join(f'>{record["id"]}\n{record["sequence"]}\n' for record in records))
+    write_alignment_matrix(fasta_path)
+    for values, expected_values in zip(analyse_alignment(open_alignment_matrix(fasta_path)), expected):
+        assert values.tolist() == expected_values.tolist()
+
+
+def _snp_distances_per_pair(sequences):
+    determined = set('ACGTacgt')
+    return [[sum(a.upper() != b.upper() for a, b in zip(first, second) if a in determined and b in determined)
+             for second in sequences] for first in sequences]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_snp_distances_match_a_count_per_pair(seed, data_dir):
+    rng = np.random.default_rng(seed)
+    symbols = list('acgtACGT-nNryk')
+    n_sequences, length = rng.integers(1, 30), rng.integers(1, 120)
+    weights = rng.dirichlet(np.ones(len(symbols)))
+    records = [{'id': f'S{k}', 'sequence': ''.join(rng.choice(symbols, length, p=weights))}
+               for k in range(n_sequences)]
+    expected = _snp_distances_per_pair([record['sequence'] for record in records])
+
+    # tiles of a few rows, the last ones not square, and blocks of one or a few columns
+    for block_rows, block_size in [(None, None), (1, 1), (4, 10), (int(rng.integers(2, 8)), int(rng.integers(20, 300)))]:
+        distances = snp_distance_matrix(records, block_rows=block_rows, block_size=block_size, threads=3)
+        assert distances.dtype == np.uint16 and distances.tolist() == expected
+
+    distances = snp_distance_matrix(records, path=data_dir / 'distances.npy', block_rows=3, block_size=50)
+    assert isinstance(distances, np.memmap) and distances.tolist() == expected
+
+
+def test_snp_distances_of_long_alignments_are_not_truncated(data_dir):
+    length = 2 ** 16 + 10
+    records = [{'id': 'A', 'sequence': 'a' * length}, {'id': 'C', 'sequence': 'c' * length},
+               {'id': 'N', 'sequence': 'n' * 10 + 'c' * (length - 10)}]
+    distances = snp_distance_matrix(records)
+    assert distances.dtype == np.uint32
+    assert distances.tolist() == [[0, length, length - 10], [length, 0, 0], [length - 10, 0, 0]]
@@ -0,0 +1,97 @@
+import itertools
+
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqFeature import FeatureLocation, SeqFeature
+from Bio.SeqRecord import SeqRecord
+
+import config
+import ncbi
+from align_tools import SequenceAligner, select_records
+from catalog import Catalog, CatalogQuery, catalog_entry, normalize_country, normalize_date
+from record_store import RecordStore
+
+
+@pytest.mark.parametrize('country, expected', [('Spain: Madrid', 'Spain'), ('USA', 'USA'), (' India :Delhi', 'India'),
+                                               ('', None), (None, None)])
+def test_countries_are_normalized(country, expected):
+    assert normalize_country(country) == expected
+
+
+@pytest.mark.parametrize('date, expected', [('2020-03-15', '2020-03-15'), ('2020-03', '2020-03'), ('2020', '2020'),
+                                            ('15-Mar-2020', '2020-03-15'), ('Mar-2020', '2020-03'),
+                                            (' 2020-03-15\n', '2020-03-15'), ('2020-13', None),
+                                            ('spring 2020', None), ('', None), (None, None)])
+def test_dates_are_normalized_with_their_precision(date, expected):
+    assert normalize_date(date) == expected
+
+
+def _entries():
+    countries = ['Spain: Madrid', 'USA', None]
+    dates = ['2020-03-15', 'Mar-2020', '2020', '2021-01-02', None]
+    entries = []
+    for k, (country, date, complete) in enumerate(itertools.product(countries, dates, [True, False])):
+        metadata = {'id': f'MW{k:06d}.1', 'country': country, 'collection_date': date,
+                    'description': 'complete genome' if complete else 'partial genome'}
+        entries.append(catalog_entry(str(k), metadata, 'ACGT' * (k + 1) + 'N' * (k % 4)))
+    return entries
+
+
+QUERIES = [CatalogQuery(),
+           CatalogQuery(country='Spain'),
+           CatalogQuery(country=['Spain', 'USA'], complete=True),
+           CatalogQuery(complete=False, min_length=40),
+           CatalogQuery(date_from='2020-03-01'),
+           CatalogQuery(date_from='2020-03', date_to='2020-03-31'),
+           CatalogQuery(date_to='2020-12-31', max_n=1),
+           CatalogQuery(country='Spain', date_from='2020-01-01', date_to='2021-12-31', max_n=2)]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_catalog_selects_the_records_the_query_matches(tmp_path, query):
+    entries = _entries()
+    with Catalog(tmp_path / 'catalog.sqlite') as catalog:
+        catalog.add_many(entries)
+        catalog.flush()
+        assert len(catalog) == len(entries)
+        selected = catalog.select(query)
+    assert selected == {entry['uid']: entry['id'] for entry in entries if query.matches(entry)}
+
+
+def test_dates_of_lower_precision_sort_before_the_days_they_contain():
+    march = {'country': 'Spain', 'complete': True, 'length': 10, 'n_count': 0, 'collection_date': '2020-03'}
+    assert not CatalogQuery(date_from='2020-03-01').matches(march)
+    assert CatalogQuery(date_from='2020-03', date_to='2020-03-31').matches(march)
+    assert not CatalogQuery(date_to='2020-12-31').matches(dict(march, collection_date=None))
+
+
+def test_signature_changes_with_the_query():
+    signatures = [query.signature() for query in QUERIES]
+    assert all(signatures.count(signature) == 1 for signature in signatures)
+    assert CatalogQuery(country='Spain').signature() == CatalogQuery(country=['Spain']).signature()
+
+
+def _record(uid, complete=True):
+    record = SeqRecord(Seq('ACGT' * 5 + 'ACGT'[int(uid) % 4] * 3), id=f'MW{int(uid) % 1000:06d}.1',
+                       description='complete genome' if complete else 'partial genome')
+    record.features.append(SeqFeature(FeatureLocation(0, len(record)), type='source', qualifiers={}))
+    return record
+
+
+def test_select_records_leaves_out_the_records_already_aligned(data_dir):
+    with RecordStore(config.CACHE_DIR / config.RECORD_STORE_DIRNAME) as store:
+        for uid in ['0', '1', '3']:
+            store.add(uid, _record(uid))
+        store.add('2', _record('2', complete=False))
+        # stored under its GI by an earlier search, listed by its accession
+        store.add('2000004', _record('2000004'))
+
+    records = ncbi.SeqRecordStream(['0', '1', '2', 'MW000004.1', '2000004', 'MW000005.1'], cache_dir=config.CACHE_DIR)
+    aligner = SequenceAligner('complete', '2', records=records, already_aligned_sequence_ids=['MW000000.1'])
+    aligner.set_query(CatalogQuery(complete=True))
+    selected = select_records([aligner], records)
+    # the records not stored yet are read too, record 3 wasn't aligned by an earlier run
+    assert selected.uids == ['1', 'MW000004.1', 'MW000005.1', '3']
+
+    # without a query, every record is read
+    assert select_records([SequenceAligner('complete', '2', records=records)], records) is records
@@ -0,0 +1,48 @@
+import config
+import iqtree
+from dedup import DuplicateTable, expand_alignment, expand_tree, sequence_hash
+
+
+def _table(path=None):
+    table = DuplicateTable(path)
+    for sequence_id, sequence in [('A.1', 'ACGT'), ('B.1', 'acg-t'), ('C.1', 'TTTT'), ('D.1', 'ACGT\n')]:
+        table.add(sequence_id, sequence_hash(sequence))
+    return table
+
+
+def test_duplicates_are_grouped_under_the_first_record(tmp_path):
+    table = _table(tmp_path / 'duplicates.json')
+    assert table.group('A.1') == ['A.1', 'B.1', 'D.1']
+    assert table.group('C.1') == ['C.1']
+    assert 'B.1' in table and 'A.1' not in table
+
+    table.save()
+    assert DuplicateTable(tmp_path / 'duplicates.json').members == {'A.1': ['B.1', 'D.1']}
+    assert _table().subset(['C.1']).members == {}
+
+
+def test_expand_alignment_repeats_the_rows_of_representatives(tmp_path):
+    fasta = tmp_path / 'aligned'
+    fasta.write_text('>A.1 first\nAC\nGT\n>C.1\nTTTT\n')
+    expand_alignment(fasta, _table(), tmp_path / 'expanded')
+    assert (tmp_path / 'expanded').read_text() == '>A.1 first\nAC\nGT\n>B.1\nAC\nGT\n>D.1\nAC\nGT\n>C.1\nTTTT\n'
+
+
+def test_expand_tree_adds_the_duplicates_as_a_clade():
+    expanded = expand_tree('((A.1:0.1,C.1:0.2)0.9:0.3,E.1:0.4);', _table())
+    assert expanded == '(((A.1:0,B.1:0,D.1:0):0.1,C.1:0.2)0.9:0.3,E.1:0.4);'
+
+
+def test_tree_of_a_selection_is_expanded(data_dir):
+    alignment_file = config.TREE_DIR / 'complete' / 'complete.txt'
+    alignment_file.parent.mkdir()
+    alignment_file.with_name('complete.txt.treefile').write_text('(A.1:0.1,C.1:0.2);\n')
+    _table().subset(['A.1'], alignment_file.with_name('complete.txt.duplicates.json')).save()
+
+    expanded = alignment_file.with_name('complete.txt.expanded.treefile')
+    assert iqtree._expand_duplicates(alignment_file) == [expanded]
+    assert expanded.read_text() == '((A.1:0,B.1:0,D.1:0):0.1,C.1:0.2);\n'
+
+    config.EXPAND_DUPLICATES = False
+    assert iqtree._expand_duplicates(alignment_file) == []
+    assert not expanded.exists()
@@ -0,0 +1,72 @@
+import pytest
+
+import ete
+from ete3 import Tree
+
+
+def _random_tree(n_tips, seed):
+    import random
+    random.seed(seed)
+    tree = Tree()
+    tree.populate(n_tips, random_branches=True)
+    return tree
+
+
+def _collapsed_tips(tree, cutoff):
+    # the tips left by collapsing every clade of height up to cutoff
+    tree = tree.copy()
+    ete._set_heights(tree)
+    for node in [node for node in tree.traverse('preorder')
+                 if node.height <= cutoff and (node.up is None or node.up.height > cutoff)]:
+        for child in list(node.children):
+            child.detach()
+    return len(tree)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_collapse_cutoff_is_the_lowest_that_keeps_the_tips_under_the_cap(seed):
+    tree = _random_tree(5 + seed * 7, seed)
+    ete._set_heights(tree)
+    heights = sorted({node.height for node in tree.traverse()})
+    for max_tips in [1, 2, len(tree) // 3, len(tree) - 1, len(tree)]:
+        for collapse_height in [0.0, heights[len(heights) // 2]]:
+            cutoff = ete._collapse_cutoff(tree, collapse_height, max_tips)
+            assert _collapsed_tips(tree, cutoff) <= max_tips
+            lower = [height for height in heights if collapse_height <= height < cutoff]
+            if lower:
+                assert _collapsed_tips(tree, lower[-1]) > max_tips
+            else:
+                assert cutoff == collapse_height
+
+
+def _text_face_available():
+    try:
+        from ete3 import TextFace  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+needs_treeview = pytest.mark.skipif(not _text_face_available(), reason='ete3 drawing needs PyQt')
+
+
+@needs_treeview
+@pytest.mark.parametrize('seed', range(5))
+def test_summarized_tree_has_at_most_max_tips(seed):
+    tree = _random_tree(200, seed)
+    leaf_names = set(tree.get_leaf_names())
+    n_collapsed = ete.summarize_tree(tree, 30)
+    assert len(tree) <= 30 and n_collapsed > 0
+    # every tip is kept, itself or in the name of a summary tip
+    represented = {leaf.name.split(' +')[0] for leaf in tree}
+    assert represented <= leaf_names
+    assert sum(int(leaf.name.split(' +')[1]) + 1 if ' +' in leaf.name else 1 for leaf in tree) == len(leaf_names)
+
+
+@needs_treeview
+def test_nodes_of_low_support_become_polytomies():
+    tree = Tree('((A:1,B:1)0.9:1,((C:1,D:1)0.2:1,E:1)0.4:1);')
+    assert ete.summarize_tree(tree, 10, min_support=0.5) == 0
+    assert sorted(len(node.children) for node in tree.traverse() if not node.is_leaf()) == [2, 4]
+    assert sorted(child.name for child in tree.children if child.is_leaf()) == ['C', 'D', 'E']
+    assert len(tree) == 5
@@ -0,0 +1,106 @@
+import sys
+
+import numpy as np
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+import config
+import mafft
+from align_tools import SequenceAligner, make_alignments
+
+
+def _records(first, n_records, length=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return [SeqRecord(Seq(''.join(rng.choice(list('ACGT'), length))), id=f'MW{k:06d}.1',
+                      description=f'MW{k:06d}.1 complete genome') for k in range(first, first + n_records)]
+
+
+@pytest.fixture
+def failing_mafft(tmp_path):
+    # writes part of an alignment before failing
+    path = tmp_path / 'failing_mafft'
+    path.write_text(f'#!{sys.executable}\nimport sys\nprint(">MW000000.1")\nprint("acg")\n'
+                    f'sys.stderr.write("out of memory")\nsys.exit(3)\n')
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_failed_mafft_leaves_the_previous_file(data_dir, failing_mafft):
+    destname = data_dir / 'aligned'
+    destname.write_text('>previous\nacgt\n')
+    config.MAFFT_DIR = failing_mafft
+    with pytest.raises(RuntimeError, match='exit code 3'):
+        mafft.run_mafft(['input'], destname)
+    assert destname.read_text() == '>previous\nacgt\n'
+    assert not destname.with_name('aligned.tmp').exists()
+    assert destname.with_name('aligned.log').read_text() == 'out of memory'
+
+    config.MAFFT_DIR = str(data_dir / 'missing_mafft')
+    with pytest.raises(OSError):
+        mafft.run_mafft(['input'], destname)
+    assert destname.read_text() == '>previous\nacgt\n'
+    assert not destname.with_name('aligned.tmp').exists()
+
+
+def test_failed_alignment_keeps_the_previous_alignment_and_its_information(stub_tools, failing_mafft):
+    records = _records(0, 4)
+    make_alignments([SequenceAligner('complete', '1', records=records)], records)
+    information_file = config.FASTA_DIR / SequenceAligner.information_pattern.format(tag='complete')
+    information = information_file.read_text()
+    aligned = (config.FASTA_DIR / 'complete_1_aligned').read_text()
+
+    mafft_executable = config.MAFFT_DIR
+    config.MAFFT_DIR = failing_mafft
+    records += _records(4, 3, seed=1)
+    aligner = SequenceAligner.from_tag('complete', {'request_timestamp': 0, 'seqrecords': records})
+    with pytest.raises(RuntimeError):
+        make_alignments([aligner], records)
+    assert information_file.read_text() == information
+    assert (config.FASTA_DIR / 'complete_1_aligned').read_text() == aligned
+    assert not (config.FASTA_DIR / f'complete_{aligner.file_id}_aligned').exists()
+
+    # the next run aligns the new records
+    config.MAFFT_DIR = mafft_executable
+    aligner = SequenceAligner.from_tag('complete', {'request_timestamp': 0, 'seqrecords': records})
+    make_alignments([aligner], records)
+    assert sorted(SequenceAligner.get_actual('complete')[1]) == [record.id for record in records]
+
+
+def _read_fasta(path):
+    records = {}
+    for line in path.read_text().splitlines():
+        if line.startswith('>'):
+            header = line[1:].split()[0]
+            records[header] = ''
+        else:
+            records[header] += line
+    return records
+
+
+def test_reference_mode_appends_every_chunk_to_the_previous_rows(stub_tools):
+    config.ALIGNMENT_MODE = 'reference'
+    config.REFERENCE_CHUNK_SIZE = 2
+    reference = _records(1000, 1, length=60)[0]
+    (config.FASTA_DIR / config.REFERENCE_FASTA_FNAME).write_text(f'>reference\n{reference.seq}\n')
+
+    records = _records(0, 3)
+    make_alignments([SequenceAligner('complete', '1', records=records)], records)
+    first = _read_fasta(config.FASTA_DIR / 'complete_1_aligned')
+    assert list(first) == ['MW000000.1', 'MW000001.1', 'MW000002.1']
+
+    records += _records(3, 3, length=70, seed=1)
+    aligner = SequenceAligner.from_tag('complete', {'request_timestamp': 0, 'seqrecords': records})
+    make_alignments([aligner], records)
+    aligned_file = config.FASTA_DIR / f'complete_{aligner.file_id}_aligned'
+    second = _read_fasta(aligned_file)
+    # the previous rows are copied unchanged, the new ones of both chunks follow them, all in reference coordinates
+    assert list(second) == [record.id for record in records]
+    assert all(second[header] == sequence for header, sequence in first.items())
+    assert {len(sequence) for sequence in second.values()} == {60}
+
+    # the insertion maps of both chunks, one entry per new sequence
+    insertions = (config.FASTA_DIR / f'complete_{aligner.file_id}_insertions').read_text()
+    assert [line.split()[0] for line in insertions.splitlines() if line.startswith('>')] == \
+        ['>MW000003.1', '>MW000004.1', '>MW000005.1']
+    assert not aligned_file.with_name(aligned_file.name + '.chunks').exists()
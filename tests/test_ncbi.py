@@ -0,0 +1,173 @@
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import benchmark
+import config
+import ncbi
+import profiling
+
+
+class _StubHandler(benchmark._EntrezStubHandler):
+    # counts the requests, and can fail a page of the search, drop its connection, leave out a
+    # record of every batch, answer the batches in reverse order or leave out withdrawn records
+    def do_GET(self):
+        self.server.requests += 1
+        if getattr(self.server, 'failing', False) and 'retstart=4&' in self.path:
+            self._send(json.dumps({'esearchresult': {'ERROR': 'history expired'}}))
+            return
+        if getattr(self.server, 'dropping', False) and 'retstart=4&' in self.path:
+            self.close_connection = True
+            return
+        ids = parse_qs(urlparse(self.path).query).get('id', [''])[0].split(',')
+        if 'efetch' not in self.path or ids == ['']:
+            super().do_GET()
+            return
+        if getattr(self.server, 'short_batches', False) and len(ids) > 1:
+            ids = ids[1:]
+        if getattr(self.server, 'reversed_batches', False):
+            ids = ids[::-1]
+        ids = [record_id for record_id in ids if record_id not in getattr(self.server, 'withdrawn', ())]
+        corpus = self.server.corpus
+        self._send(''.join(corpus.genbank(corpus.uid(record_id)) for record_id in ids))
+
+    def _send(self, body):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub_server(entrez_stub):
+    corpus, server = entrez_stub
+    server.RequestHandlerClass = _StubHandler
+    server.requests = 0
+    return corpus, server
+
+
+def _expected_records(corpus, uids):
+    return {corpus.accession(uid): corpus.genbank(uid).rstrip() + '\n' for uid in uids}
+
+
+@pytest.mark.parametrize('reversed_batches', [False, True])
+def test_records_are_downloaded_in_concurrent_batches(stub_server, reversed_batches):
+    corpus, server = stub_server
+    server.reversed_batches = reversed_batches
+    accessions = [corpus.accession(uid) for uid in corpus.uids]
+    downloaded = dict(ncbi.download_raw_sequences(accessions, batch_size=3, max_concurrent=2))
+    assert downloaded == _expected_records(corpus, corpus.uids)
+    assert server.requests == 3
+
+
+def test_records_missing_from_a_batch_are_downloaded_one_by_one(stub_server):
+    corpus, server = stub_server
+    server.short_batches = True
+    accessions = [corpus.accession(uid) for uid in corpus.uids]
+    downloaded = dict(ncbi.download_raw_sequences(accessions, batch_size=4))
+    assert downloaded == _expected_records(corpus, corpus.uids)
+    # the first uid of both batches
+    assert server.requests == 2 + 2
+
+    # uids that aren't accessions can't be matched, every one gets a request of its own
+    server.requests = 0
+    downloaded = dict(ncbi.download_raw_sequences(corpus.uids[:4], batch_size=4))
+    assert downloaded == {uid: corpus.genbank(uid).rstrip() + '\n' for uid in corpus.uids[:4]}
+    assert server.requests == 1 + 4
+
+
+def test_withdrawn_records_are_left_for_the_next_run(stub_server):
+    corpus, server = stub_server
+    accessions = [corpus.accession(uid) for uid in corpus.uids]
+    server.withdrawn = {accessions[1]}
+    downloaded = dict(ncbi.download_raw_sequences(accessions, batch_size=4))
+    assert downloaded == _expected_records(corpus, corpus.uids[:1] + corpus.uids[2:])
+
+    with ncbi.RawSequenceCache(config.CACHE_DIR) as cache:
+        for accession, raw_seq in downloaded.items():
+            cache.put(accession, raw_seq)
+        assert cache.missing(accessions) == [accessions[1]]
+
+
+def test_records_are_only_downloaded_once(stub_server):
+    corpus, server = stub_server
+    profiling.reset()
+    records = ncbi.SeqRecordStream([corpus.accession(uid) for uid in corpus.uids], cache_dir=config.CACHE_DIR)
+    ids = [record.id for record in records]
+    assert ids == [corpus.accession(uid) for uid in corpus.uids]
+    # the parsing of the stream is added to the profile once
+    assert profiling.report()['stages']['genbank.parse']['calls'] == 1
+    assert profiling.report()['stages']['genbank.parse']['records'] == len(corpus.uids)
+    n_requests = server.requests
+    assert [record.id for record in records] == ids
+    assert server.requests == n_requests
+
+
+def test_failing_search_stops_and_resumes_from_its_checkpoint(stub_server):
+    corpus, server = stub_server
+    server.failing = True
+    config.NCBI_MAX_RETRIES = 2
+    with pytest.raises(RuntimeError, match='history expired'):
+        ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2)
+    # the first search, page 1, then page 2 failing three times with a new search before each retry
+    assert server.requests == 1 + 1 + 3 + 2
+
+    server.failing = False
+    server.requests = 0
+    assert ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2) == [corpus.accession(uid) for uid in corpus.uids]
+    # only pages 2 and 3 are asked for, in the history of the saved search
+    assert server.requests == 2
+
+
+def test_search_continues_after_a_dropped_connection(stub_server):
+    corpus, server = stub_server
+    server.dropping = True
+    config.NCBI_MAX_RETRIES = 1
+    with pytest.raises(RuntimeError, match='continues from its checkpoint in the next run'):
+        ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2)
+
+    server.dropping = False
+    server.requests = 0
+    assert ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2) == [corpus.accession(uid) for uid in corpus.uids]
+    assert server.requests == 2
+
+
+def test_pages_retrieved_after_an_interrupted_run_are_kept(stub_server):
+    corpus, server = stub_server
+    server.failing = True
+    config.NCBI_MAX_RETRIES = 0
+    with pytest.raises(RuntimeError):
+        ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2)
+    # the run stopped while it was writing page 1
+    pages_path = config.CACHE_DIR / ncbi.SEARCH_CHECKPOINT_DIRNAME / 'pages.jsonl'
+    pages_path.write_bytes(pages_path.read_bytes()[:-10])
+    with pytest.raises(RuntimeError):
+        ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2)
+
+    server.failing = False
+    server.requests = 0
+    assert ncbi.search_uids('covid', cache_dir=config.CACHE_DIR, page_size=2) == [corpus.accession(uid) for uid in corpus.uids]
+    assert server.requests == 2
+
+
+def test_raw_sequence_cache_writes_in_batches_and_reopens(data_dir):
+    cache = ncbi.RawSequenceCache(data_dir / 'cache', write_batch_size=3)
+    for k in range(4):
+        cache.put(f'MW{k:06d}.1', f'record {k}')
+    # the first three were written when the batch filled up, the fourth is still buffered
+    assert set(cache._shelf.keys()) == {'MW000000.1', 'MW000001.1', 'MW000002.1'}
+    assert cache['MW000003.1'] == 'record 3' and 'MW000003.1' in cache
+    assert cache.missing(['MW000004.1', 'MW000003.1', 'MW000000.1']) == ['MW000004.1']
+    cache.close()
+    cache.close()
+
+    with ncbi.RawSequenceCache(data_dir / 'cache') as cache:
+        assert cache.missing([f'MW{k:06d}.1' for k in range(6)]) == ['MW000004.1', 'MW000005.1']
+        assert cache.get('MW000003.1') == 'record 3' and cache.get('MW000005.1') is None
+
+    # a cache without a directory is kept in memory only
+    with ncbi.RawSequenceCache() as cache:
+        cache.put('MW000000.1', 'record 0')
+        assert cache.missing(['MW000000.1', 'MW000001.1']) == ['MW000001.1']
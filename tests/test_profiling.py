@@ -0,0 +1,67 @@
+import json
+import time
+
+import pytest
+
+import config
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def clean_profile():
+    profiling.reset()
+    yield
+    profiling.reset()
+
+
+def test_runs_of_a_stage_are_added_up():
+    for k in range(3):
+        with profiling.stage('test.stage', records=2) as counters:
+            counters['bytes'] = 10
+            with profiling.stage('test.nested'):
+                time.sleep(0.01)
+    stages = profiling.report()['stages']
+    totals = stages['test.stage']
+    assert (totals['calls'], totals['records'], totals['bytes']) == (3, 6, 30)
+    assert totals['wall'] >= stages['test.nested']['wall'] >= 0.03
+    assert totals['records_per_second'] == pytest.approx(6 / totals['wall'])
+    assert stages['test.nested']['records_per_second'] is None
+
+
+def test_stage_is_measured_when_it_fails():
+    with pytest.raises(KeyError):
+        with profiling.stage('test.failing', records=1):
+            raise KeyError('missing')
+    assert profiling.report()['stages']['test.failing']['calls'] == 1
+
+
+def test_runs_timed_by_the_caller_are_added_to_a_stage():
+    profiling.add('test.loop', 0.5, 0.25, records=100, n_bytes=1000)
+    profiling.add('test.loop', 0.5, 0.25, records=100, n_bytes=1000)
+    totals = profiling.report()['stages']['test.loop']
+    assert (totals['calls'], totals['wall'], totals['cpu'], totals['records'], totals['bytes']) == (2, 1, 0.5, 200, 2000)
+    assert totals['records_per_second'] == 200
+    assert totals['bytes_read'] == totals['bytes_written'] == 0
+
+
+def _busy(n):
+    return sum(sorted(range(n)))
+
+
+def test_hot_functions_are_profiled_when_configured(data_dir):
+    hot_busy = profiling.hot(_busy)
+    assert hot_busy(1000) == _busy(1000)
+    assert 'test_profiling._busy' not in profiling.report()['hot']
+
+    config.PROFILE_HOT_FUNCTIONS = ('_busy',)
+    config.PROFILE_TOP_FUNCTIONS = 3
+    assert hot_busy(1000) == _busy(1000)
+    report = profiling.report()
+    assert report['stages']['_busy']['calls'] == 2
+    runs = report['hot']['_busy']
+    assert len(runs) == 1 and len(runs[0]['top']) == 3 and runs[0]['peak_traced_bytes'] > 0
+    assert any('sorted' in entry['function'] for entry in runs[0]['top'])
+
+    path = profiling.write_report(data_dir / 'profile.json')
+    with open(path, 'r') as file:
+        assert set(json.load(file)['stages']) == {'_busy'}
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqFeature import FeatureLocation, SeqFeature
+from Bio.SeqRecord import SeqRecord
+
+from record_store import METADATA_FNAME, RecordStore, pack_sequence, unpack_sequence
+
+
+def _record(uid, sequence):
+    record = SeqRecord(Seq(sequence), id=f'{uid}.1', name=uid, description=f'record {uid}')
+    record.features.append(SeqFeature(FeatureLocation(0, len(sequence)), type='source',
+                                      qualifiers={'country': ['Spain: Madrid'], 'collection_date': ['2020-03']}))
+    return record
+
+
+@pytest.mark.parametrize('length', [1, 3, 4, 5, 30001])
+def test_sequences_are_packed_with_the_fewest_bits(length):
+    rng = np.random.default_rng(length)
+    sequence = ''.join(rng.choice(list('ACGT'), length))
+    packed, bits = pack_sequence(sequence)
+    assert bits == 2 and len(packed) == -(-length // 4)
+    assert unpack_sequence(packed, length, bits) == sequence
+
+    sequence = ''.join(rng.choice(list('-ACGTRYSWKMBDHVN'), length - 1)) + 'N'
+    packed, bits = pack_sequence(sequence)
+    assert bits == 4 and len(packed) == -(-length // 2)
+    assert unpack_sequence(packed, length, bits) == sequence
+
+
+def test_sequences_with_unknown_symbols_are_not_packed():
+    assert pack_sequence('ACGTX') == (None, None)
+    assert pack_sequence('acgt') == (None, None)
+
+
+def test_stored_records_are_read_after_reopening(tmp_path):
+    with RecordStore(tmp_path / 'store') as store:
+        assert store.add('0', _record('0', 'ACGTACGTA'))
+        assert store.add('1', _record('1', 'ACGNNNRT'))
+        assert not store.add('2', _record('2', 'ACGX'))
+        # read before the files are flushed
+        assert store.get_sequence('1') == 'ACGNNNRT'
+
+    with RecordStore(tmp_path / 'store') as store:
+        assert len(store) == 2 and '2' not in store
+        record = store.get_record('0')
+        assert (record.id, str(record.seq), record.description) == ('0.1', 'ACGTACGTA', 'record 0')
+        assert store.metadata['1']['n_count'] == 3 and store.metadata['1']['country'] == 'Spain: Madrid'
+        assert store.get_record('2') is None
+        assert store.catalog.ids() == {'0': '0.1', '1': '1.1'}
+
+
+def test_records_added_after_an_interrupted_run_are_kept(tmp_path):
+    with RecordStore(tmp_path / 'store', catalog=False) as store:
+        for uid in '012':
+            store.add(uid, _record(uid, 'ACGT' * 10))
+    metadata_path = tmp_path / 'store' / METADATA_FNAME
+    metadata = metadata_path.read_bytes()
+    metadata_path.write_bytes(metadata[:-20])
+
+    with RecordStore(tmp_path / 'store', catalog=False) as store:
+        assert sorted(store.metadata) == ['0', '1']
+        for uid in '345':
+            store.add(uid, _record(uid, 'TTGCA' * 4))
+
+    with RecordStore(tmp_path / 'store', catalog=False) as store:
+        assert sorted(store.metadata) == ['0', '1', '3', '4', '5']
+        assert store.get_sequence('5') == 'TTGCA' * 4
+
+
+def test_records_stored_under_their_gi_are_found_by_accession(tmp_path):
+    with RecordStore(tmp_path / 'store', catalog=False) as store:
+        store.add('2000001', _record('MW000001', 'ACGT'))
+    with RecordStore(tmp_path / 'store', catalog=False) as store:
+        assert '2000001' in store and 'MW000001.1' in store and 'MW000002.1' not in store
+        assert store.get_record('MW000001.1').id == 'MW000001.1'
+        assert store.get_sequence('MW000001.1') == 'ACGT'
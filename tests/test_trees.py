@@ -0,0 +1,181 @@
+import json
+
+import numpy as np
+import pytest
+
+import config
+import iqtree
+
+
+def _write_selection(n_records, length=40, seed=0):
+    rng = np.random.default_rng(seed)
+    alignment_file = config.TREE_DIR / 'complete' / 'complete.txt'
+    alignment_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(alignment_file, 'w') as file:
+        for k in range(n_records):
+            file.write(f'>MW{k:06d}.1\n{"".join(rng.choice(list("ACGT"), length))}\n')
+    return alignment_file
+
+
+def test_bootstrap_jobs_use_the_arguments_of_the_search(data_dir):
+    config.IQTREE_ARGUMENTS = ['-m', 'GTR+G', '-bnni']
+    search_jobs, bootstrap_jobs = iqtree._tree_jobs(_write_selection(4), 2, 10, 3)
+    assert len(search_jobs) == 2 and len(bootstrap_jobs) == 3
+    assert sum(arguments[arguments.index('-bo') + 1] for _, arguments in bootstrap_jobs) == 10
+    for _, arguments in search_jobs + bootstrap_jobs:
+        assert arguments[-3:] == ['-m', 'GTR+G', '-bnni']
+    seeds = [arguments[arguments.index('-seed') + 1] for _, arguments in search_jobs + bootstrap_jobs]
+    assert len(set(seeds)) == len(seeds)
+
+
+def test_bootstrap_consensus_keeps_the_log_of_the_search(stub_tools):
+    alignment_file = _write_selection(8)
+    runs = iqtree.create_trees(['complete.txt'], searches=1, bootstrap=6, bootstrap_batches=2, cpu_budget=2)
+    assert [run['returncode'] for run in runs['complete.txt']] == [0, 0, 0, 0]
+
+    assert iqtree._best_score(alignment_file) is not None
+    with open(alignment_file.with_name('complete.txt.boottrees'), 'r') as file:
+        assert len(file.readlines()) == 6
+    assert alignment_file.with_name('complete.txt.contree').exists()
+    assert runs['complete.txt'][-1]['prefix'] == str(alignment_file) + '.consensus'
+    with open(alignment_file.with_name('complete_jobs.json'), 'r') as file:
+        assert len(json.load(file)['bootstrap']) == 3
+
+    # nothing changed, so nothing runs again
+    assert iqtree.create_trees(['complete.txt'], searches=1, bootstrap=6, bootstrap_batches=2) == {}
+
+
+def test_place_sequences_attaches_a_new_tip_next_to_its_closest_tip():
+    from ete3 import Tree
+    tree = Tree('((A:1,B:1):1,(C:1,D:1):1);', format=1)
+    records = [('A', 'AAAAAAAA'), ('B', 'AAAACCCC'), ('C', 'GGGGTTTT'), ('D', 'GGGGGGGG'), ('E', 'GGGGTTTC')]
+    placements = iqtree.place_sequences(tree, records, ['E'], removed=['B'])
+
+    assert [(name, node.name, substitutions) for name, node, substitutions in placements] == [('E', 'C', 1)]
+    assert sorted(tree.get_leaf_names()) == ['A', 'C', 'D', 'E']
+    assert sorted(leaf.name for leaf in (tree & 'E').up.get_leaves()) == ['C', 'E']
+    assert (tree & 'E').dist == 1 / 8
+
+
+def _append_records(alignment_file, n_records, length=40, seed=1):
+    rng = np.random.default_rng(seed)
+    n_selected = sum(1 for _ in iqtree.at.iter_fasta_records(alignment_file))
+    with open(alignment_file, 'a') as file:
+        for k in range(n_selected, n_selected + n_records):
+            file.write(f'>MW{k:06d}.1\n{"".join(rng.choice(list("ACGT"), length))}\n')
+    return [iqtree._tip_name(f'MW{k:06d}.1') for k in range(n_selected, n_selected + n_records)]
+
+
+def test_new_genomes_are_placed_on_the_previous_tree(stub_tools, monkeypatch):
+    alignment_file = _write_selection(20)
+    treefile = alignment_file.with_name('complete.txt.treefile')
+    assert len(iqtree.create_trees(['complete.txt'], searches=1, bootstrap=0, placement='parsimony')) == 1
+    state_file = alignment_file.with_name(iqtree.PLACEMENT_FNAME_PATTERN.format(selectname='complete.txt'))
+
+    def no_inference(*args, **kwargs):
+        raise AssertionError('IQ-TREE ran for a small update')
+
+    run_iqtree = iqtree.run_iqtree
+    monkeypatch.setattr(iqtree, 'run_iqtree', no_inference)
+    new = _append_records(alignment_file, 2)
+    assert iqtree.create_trees(['complete.txt'], searches=1, bootstrap=0, placement='parsimony') == {}
+    from ete3 import Tree
+    tips = Tree(str(treefile), format=1).get_leaf_names()
+    assert len(tips) == 22 and set(new) <= set(tips)
+    with open(state_file, 'r') as file:
+        assert json.load(file) == {'full_tips': 20, 'placed': 2, 'removed': 0, 'updates': 1}
+
+    # 6 of the 20 tips of the inferred tree changed, more than config.TREE_PLACEMENT_MAX_DRIFT
+    monkeypatch.setattr(iqtree, 'run_iqtree', run_iqtree)
+    _append_records(alignment_file, 4, seed=2)
+    runs = iqtree.create_trees(['complete.txt'], searches=1, bootstrap=0, placement='parsimony')
+    assert [run['returncode'] for run in runs['complete.txt']] == [0]
+    assert len(Tree(str(treefile), format=1).get_leaf_names()) == 26
+    with open(state_file, 'r') as file:
+        assert json.load(file) == {'full_tips': 26, 'placed': 0, 'removed': 0, 'updates': 0}
+
+
+def test_trees_are_inferred_again_by_default(stub_tools):
+    alignment_file = _write_selection(20)
+    assert len(iqtree.create_trees(['complete.txt'], searches=1, bootstrap=0)) == 1
+    _append_records(alignment_file, 1)
+    runs = iqtree.create_trees(['complete.txt'], searches=1, bootstrap=0)
+    assert [run['returncode'] for run in runs['complete.txt']] == [0]
+
+
+def _farthest_point_order_brute_force(bits, k):
+    selected = [0]
+    while len(selected) < k:
+        distances = [min(int((bits[i] != bits[j]).sum()) for j in selected) for i in range(len(bits))]
+        farthest = int(np.argmax(distances))
+        if distances[farthest] == 0:
+            break
+        selected.append(farthest)
+    return selected
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_farthest_point_order_matches_brute_force(seed, monkeypatch):
+    # genomes around a few centers, so that most distances can be pruned, with repeated genomes
+    rng = np.random.default_rng(seed)
+    n_genomes, n_bits = int(rng.integers(1, 80)), 64 * int(rng.integers(1, 4))
+    centers = rng.random((int(rng.integers(1, 6)), n_bits)) < 0.5
+    bits = centers[rng.integers(len(centers), size=n_genomes)] ^ (rng.random((n_genomes, n_bits)) < rng.random() * 0.2)
+    bits[rng.integers(n_genomes, size=n_genomes // 4)] = bits[0]
+    packed = np.packbits(bits, axis=1).view(np.uint64)
+
+    monkeypatch.setattr(iqtree, 'SELECTOR_ROWS_PER_BLOCK', 4)
+    for k in [1, 2, int(rng.integers(1, n_genomes + 1)), n_genomes + 5]:
+        expected = _farthest_point_order_brute_force(bits, k)
+        for threads in [1, 3]:
+            assert iqtree.farthest_point_order(packed, k, threads=threads) == expected
+
+
+def test_stratum_quotas_are_proportional():
+    assert iqtree._stratum_quotas({'a': 1, 'b': 10, 'c': 30}, 10) == {'a': 0, 'b': 3, 'c': 7}
+    assert iqtree._stratum_quotas({'a': 1, 'b': 10}, 20) == {'a': 1, 'b': 10}
+    assert iqtree._stratum_quotas({}, 5) == {}
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_stratum_quotas_add_up_to_the_genomes_selected(seed):
+    rng = np.random.default_rng(seed)
+    sizes = {(f'country {k}',): int(size) for k, size in enumerate(rng.integers(1, 50, size=rng.integers(1, 12)))}
+    n_genomes = int(rng.integers(0, sum(sizes.values()) + 10))
+    quotas = iqtree._stratum_quotas(sizes, n_genomes)
+    assert sum(quotas.values()) == min(n_genomes, sum(sizes.values()))
+    total = sum(sizes.values())
+    for stratum, size in sizes.items():
+        assert 0 <= quotas.get(stratum, 0) <= size
+        if n_genomes < total:
+            assert abs(quotas[stratum] - n_genomes * size / total) < 1
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_selection_from_fasta_matches_the_matrix(seed, data_dir):
+    from align_tools import open_alignment_matrix, write_alignment_matrix
+    rng = np.random.default_rng(seed)
+    n_records, length = int(rng.integers(1, 60)), int(rng.integers(1, 30))
+    # few distinct rows, so that there are ties and identical sequences, with the ids out of order
+    rows = [''.join(rng.choice(list('acgt-nry'), length, p=[0.3, 0.2, 0.2, 0.1, 0.1, 0.05, 0.025, 0.025]))
+            for _ in range(int(rng.integers(1, 10)))]
+    records = [(f'MW{k:06d}.1 record {k}', rows[rng.integers(len(rows))]) for k in rng.permutation(n_records)]
+    fasta_path = config.FASTA_DIR / 'complete_aligned'
+    fasta_path.write_text(''.join(f'>{header}\n{sequence}\n' for header, sequence in records))
+    write_alignment_matrix(fasta_path)
+    alignment = open_alignment_matrix(fasta_path)
+
+    for rank_by, counted in iqtree.RANKING_KEYS.items():
+        ranked = sorted(records, key=lambda record: (int(counted[np.frombuffer(record[1].encode(), np.uint8)].sum()),
+                                                     record[0].split()[0]))
+        for distinct in [False, True]:
+            expected = ranked
+            if distinct:
+                first = {}
+                for header, sequence in ranked:
+                    first.setdefault(sequence, (header, sequence))
+                expected = list(first.values())
+            for n_genomes in [0, 1, int(rng.integers(1, n_records + 1)), n_records + 3]:
+                from_fasta = iqtree._select_from_fasta(fasta_path, n_genomes, counted, distinct)
+                assert from_fasta == iqtree._select_from_matrix(alignment, n_genomes, counted, distinct)
+                assert from_fasta == expected[:n_genomes]